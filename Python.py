@@ -4,13 +4,188 @@
 ### Update process for static Feature/Vector Tile services in ArcGIS Portal
 ### Reads from config (.ini) file to get details of service
 
-import os, sys, datetime, traceback, arcpy, shutil, time, json, urllib, socket, zipfile
+import os
+import sys
+import datetime
+import traceback
+import arcpy
+import shutil
+import time
+import json
+import urllib
+import socket
+import zipfile
+import queue
+import hashlib
+import gzip
+import threading
+import random
+import re
+import math
+import sqlite3
+import mmap
+import ssl
+import uuid
+import http.client
+import urllib.parse
+import urllib.request
+import contextlib
+import cProfile
+import pstats
+import io
+import functools
+import ctypes
 import multiprocessing as mp
-from arcgis.gis import GIS
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from arcgis.gis import GIS, Item
+from vector_tile_package import vtpk_style_member, vtpk_bundle_dim, read_tiling_scheme, \
+    get_changed_tiles, list_package_bundles, read_bundle_tiles, write_bundle, get_vtpk_shards, merge_vtpk_shards, \
+    count_tile_differences, count_tile_map_differences
 
 debug = False   # True for local Development/Testing
 rebuild_data = True
 
+# Run Settings
+# Defaults by section; settings.ini in the script folder overrides them with [section] lines followed by
+# key = value lines, and --set section.key=value arguments override both ([retry.portal] and retry.portal.attempts
+# for the retry policies)
+config = {
+    "services": {
+        "incremental": True,   # Skip services/layers whose sources have not changed since the last publish
+        "max_concurrent": 3,   # Services extracting and staging (or packaging) at the same time
+        "max_concurrent_publishes": 3,   # Services uploading and publishing at the same time
+        "max_per_portal": 2,   # Services uploading and publishing at the same time against one portal
+        "queue_depth": 2,   # Staged services waiting to publish, no more services start extracting while this many wait
+    },
+    "sync": {
+        "threads": 8,   # Files copied at the same time between the network and local data folders
+        "verify_hash": True,   # Compare contents when a file's size matches but its modified time does not
+        "ignore_suffixes": (".lock",),   # Files that are never copied or removed
+    },
+    "history": {
+        "generations": 7,   # Runs kept in History
+        "byte_budget": 50 * 1073741824,   # Compressed bytes kept in History before the oldest runs are dropped
+        "compress_level": 6,
+    },
+    "pool": {
+        "workers": 0,   # Warm worker processes every service hands its layer tasks to, 0 matches the layer processes
+        "memory_limit_mb": 2048,   # Memory a pool worker may hold after a task before a fresh worker replaces it
+    },
+    "logging": {
+        "batch_lines": 200,   # Lines buffered by the log writer before writing
+        "flush_seconds": 2,   # Longest time a line waits in the log writer before writing
+        "echo": True,   # Print log lines to the console
+    },
+    "tracing": {
+        "spans": True,   # Record a timing span for every stage in a JSON-lines trace file in the logs folder
+        "metrics_path": None,   # Folder for the Prometheus textfile metrics of each run, the logs folder when None
+        "metrics_file_name": "portal_update.prom",
+    },
+    "profiling": {
+        "run": False,   # Profile every service of the run, also set by the --profile argument
+        "top_functions": 40,   # Functions listed in each ordering of a profile summary
+    },
+    "checkpoints": {
+        "resume": False,   # Continue an interrupted run from its checkpoint journal, also set by the --resume argument
+    },
+    "portal": {
+        "token_minutes": 60,   # Lifetime of a portal token
+        "token_refresh_minutes": 10,   # Sign in again this long before a token expires
+        "verify_cert": True,   # False for a local stand-in portal with a self-signed certificate
+        "token_referer": "http",   # Referer the pipeline's own REST requests send and their token is issued for
+        "inventory_page_size": 100,   # Items per request when reading an owner's portal content
+    },
+    "upload": {
+        "part_bytes": 32 * 1048576,   # Size of each part of a multipart item upload
+        "threads": 4,   # Parts of one upload sent at the same time
+        "timeout": 300,   # Seconds without a response before a part is sent again
+        "progress_percent": 10,   # Upload progress is logged each time this much more of the file is sent
+        "status_seconds": 5,   # Wait between checks that a committed upload has been assembled
+    },
+    # attempts: tries including the first, delay/max_delay: first and longest wait, deadline: seconds for all tries
+    "retry": {
+        "portal": {"attempts": 5, "delay": 5, "max_delay": 120, "deadline": 600},   # Item delete/share/update
+        "upload": {"attempts": 4, "delay": 15, "max_delay": 300, "deadline": 3600},   # Adding SD/VTPK items
+        "publish": {"attempts": 3, "delay": 30, "max_delay": 300, "deadline": 3600},   # Publishing services
+        "geoprocessing": {"attempts": 2, "delay": 30, "max_delay": 60, "deadline": 7200},   # StageService, VTPK builds
+    },
+    "delta": {
+        "publish": True,   # Send only changed rows to the hosted layers of services with a DELTAKEY in their .ini
+        "max_share": 0.5,   # Share of a service's rows changed above which it is overwritten instead
+        "batch_rows": 1000,   # Adds, updates and deletes sent in one applyEdits request
+        "lookup_keys": 200,   # Key values looked up in one query for their hosted object ids
+    },
+    "extract": {
+        "rows_per_second": 20000,   # Rows copied per second, to rank layers with no extraction history
+        "share": True,   # Extract a source used by several layers or services once per run, the others copy it
+        "store_poll_seconds": 2,   # Wait between checks on a shared extract another process is making
+        "store_wait_seconds": 3600,   # Longest wait for a shared extract another process is making
+        "prune_fields": True,   # Extract only the fields a layer uses, KEEPFIELDS in an .ini adds fields or is ALL
+        "optimize": True,   # Rebuild spatial indexes, index query and key fields and compact the extract GDBs
+    },
+    "vector_tiles": {
+        "shards": 4,   # Extent strips of a full package built at the same time, 1 builds the package in one call
+        "verify_shards": False,   # Also build full packages in one call, publish that and log tiles that differ
+        "incremental": True,   # Rebuild only the tiles touched by changed features, merged into the last package
+        "full_rebuild_days": 7,   # Longest time between full package builds
+        "incremental_max_tiles": 20000,   # Changed tiles above which a full build is used instead
+        "incremental_max_bundles": 6,   # Changed bundles (one package call each) above which a full build is used
+        "tile_buffer": 0.25,   # Share of a tile added around changed features, for symbols/labels across tile edges
+    },
+}
+settings_file_name = "settings.ini"   # Settings file in the script folder
+
+# Worker Pool
+pool_task_queue = None
+pool_reply_queues = None   # Reply queue of each process handing tasks to the pool, by client number
+pool_client = 0   # Client number of this process, 0 is the main process
+pool_task_count = 0   # Last task id this process handed out
+pool_processes = []   # Worker processes by slot, in the main process
+pool_running = None   # Client and task id of the task each worker slot is running, task id -1 when idle
+pool_watcher = None
+pool_stopping = None
+worker_projects = None   # Projects a pool worker has open, {project path: (modified time, project)}
+worker_connections = None   # SDE workspaces a pool worker holds open, {connection file path: workspace description}
+
+# Logging
+log_queue = None
+log_ack_queue = None
+log_process = None
+
+# Tracing
+trace_run_variable = "PORTAL_UPDATE_RUN_ID"   # Environment variable carrying the run id to child processes
+trace_run_id = None
+trace_file = None
+trace_service = None   # Service this process is running stages for
+
+# Profiling
+profile_folder = None   # Folder the processes of the service being profiled write their profiles to
+worker_profiler = None   # Profiler of a pool worker, enabled only while the worker runs a task
+
+# Checkpoints
+run_journal = None   # {"run", "stages": [run stages done], "completed"}
+service_journal = None   # {"service", "stages": [[stage, artifacts]], "result"} of the service this process runs
+service_journal_position = 0   # Stages of the service journal confirmed intact or done again in this run
+
+# Portal Sessions
+portal_sessions = {}   # (portal, user): {"gis": GIS, "rest_url", "token", "signed_in": time}
+portal_sessions_lock = threading.Lock()
+arcpy_active_portal = None   # [(portal, user), time] arcpy is signed in to
+
+# Portal Inventory
+portal_inventories = {}   # (portal, owner): {"ids": {id: Item}, "titles": {(title, type): {ids}}}
+portal_inventories_lock = threading.RLock()
+
+# Retry Policies
+retry_fatal_errors = (TypeError, ValueError, KeyError, AttributeError, NameError, FileNotFoundError)   # Never retried
+retry_parse_errors = (json.JSONDecodeError,)   # Retried all the same, an HTML gateway error page is not JSON
+retry_stats = {}   # policy: [retries, seconds waited]
+
+# Layer Extraction
+extract_slot = 0   # Number of this extraction worker, names its GDB
+process_query_access = 0x1000   # PROCESS_QUERY_LIMITED_INFORMATION, to check on the process holding a claim on Windows
+process_still_active = 259   # Exit code of a Windows process that is still running
+
 # Database Connections
 spuuser = "*****"
 gisuser = "*****"
@@ -29,13 +204,19 @@ agol_id = "******"
 
 # Primary workflow controller
 def main():
+    global trace_run_id, trace_file
     init_sources()
-    
-    # Allowing edit of global variables 
-    global currentLogFileName, cur_log_file_path
+    start_logging()
     
     # Set timer for total runtime
     total_time = delta_time_system_timer(0)
+    run_start = time.time()
+    run_monotonic = time.monotonic()
+
+    # Every process of this run traces into one file, named by the run id
+    trace_run_id = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    os.environ[trace_run_variable] = trace_run_id
+    trace_file = f"{log_path}\\trace_{trace_run_id}.jsonl"
 
     # Logging to Text file on Network Drive
     write_to_log(log_file, "")
@@ -43,48 +224,35 @@ def main():
     write_to_log(log_file, "")
     write_to_log(log_file, f"Script Source Path: {local_path}")
     write_to_log(log_file, f"Target Path: {list_path}")
+
+    # Checkpoint journal of this run, or of the interrupted run being resumed
+    resuming = start_run_journal()
     
     # Create TO_DELETE folder in network directory if it doesn't exist
     # For Temporary Log Files
+    # A resumed run keeps the service logs of the interrupted run for its emails
     if not os.path.exists(temp_folder):
         write_to_log(log_file, "Creating TO_DELETE directory")
         os.mkdir(temp_folder)
-    else:
+    elif not resuming:
         shutil.rmtree(temp_folder)
         os.mkdir(temp_folder)
     
-    # Move all old files to History (network directory)
-    files_in_data = os.listdir(data_path)
-    if rebuild_data:
-        if not os.path.exists(history_path):
-            os.mkdir(history_path)
-        else:
-            shutil.rmtree(history_path)
-            os.mkdir(history_path)
-        for data in files_in_data:
-            if data != "History":
-                file_path = f"{data_path}\\{data}"
-                if data == "Index":
-                    shutil.rmtree(file_path)
-                else:
-                    new_file_path = f"{history_path}\\{data}"
-                    try:
-                        shutil.copyfile(file_path, new_file_path)
-                        os.remove(file_path)
-                    except Exception:
-                        try:
-                            shutil.copytree(file_path, new_file_path, ignore_dangling_symlinks=True)
-                            shutil.rmtree(file_path)
-                        except Exception:
-                            pass
-                        
-        # Copy Data to local folder from network directory
-        if os.path.exists(local_data_path):
-            shutil.rmtree(local_data_path)
-        try:
-            shutil.copytree(data_path, local_data_path, ignore_dangling_symlinks=True)
-        except Exception:
-            pass
+    # Set the previous local outputs aside, then bring them in line with the network data
+    # A resumed run does neither again, rotating would move the interrupted run's outputs into History
+    if rebuild_data and not run_stage_done("local_copy"):
+        if not run_stage_done("history_rotation"):
+            write_to_log(log_file, "Rotating local History", True)
+            if os.path.exists(local_data_path):
+                with trace_span("history_rotation"):
+                    rotate_history(local_data_path, local_hisotry_path)
+            complete_run_stage("history_rotation")
+
+        # Bring the local History, the outputs set aside, in line with the network data, copying only what changed
+        write_to_log(log_file, "Syncing local History with the network data.", True)
+        with trace_span("local_copy"):
+            sync_folder(data_path, local_hisotry_path, ("history",))
+        complete_run_stage("local_copy")
     
     # Begin iterating through .ini files in target folder
     write_to_log(log_file, "Iterating through Target Path", True)
@@ -94,92 +262,82 @@ def main():
     failed_log_list = {}
     index = 0
     list_of_files = os.listdir(list_path)
-    
+
+    # Read every .ini up front so the scheduler knows the portal of each service
+    jobs = []
     for file_name in list_of_files:
-        start_timestamp = delta_time_system_timer(0)
-        result = 0
-        
         try:
-            init_dict = {}
-            file_path = f"{list_path}\\{file_name}"
-            
-            # Open .ini file and read all arguments out
-            with open(file_path, "r") as init_file:
-                line = init_file.readline()
-                
-                while line:  # While Not Null
-                    split_line = line.split('=')
-                    if len(split_line) > 1:
-                        init_dict[split_line[0].strip()] = split_line[1].strip()
-                    line = init_file.readline()
-            
+            init_dict = read_init_file(f"{list_path}\\{file_name}")
+
             # Check that the .ini file is not empty
             if len(init_dict.keys()) > 0:
-                service_type = init_dict['SERVICETYPE']  # Feature, Vector Tile, Tile, Map Image
-                service_name = init_dict['SERVICENAME']
-                currentLogFileName = f"{service_name}_{month_day_year}.txt"
-                cur_log_file_path = f"{temp_folder}\\{currentLogFileName}"
-                
-                write_to_log(log_file, f"Opening {file_name}", False, cur_log_file_path)
-                write_to_log(log_file, f"Hostname: {socket.getfqdn()}", False, cur_log_file_path)
-                write_to_log(log_file, f"Updating {service_name} as a {service_type}.", False, cur_log_file_path)
-                
-                # Handle as Feature Service
-                if service_type.upper() == "FEATURE":
-                    result = hosted_feature_update(init_dict)
-                
-                # Handle as Vector Tile Service
-                elif service_type.upper() == "VECTOR TILE":
-                    result = vector_tile_update(init_dict)
-                    if result > 1:
-                        write_to_log(log_file, "Retrying due to failed run.", False, cur_log_file_path)
-                        write_to_log(log_file, "")
-                        result = vector_tile_update(init_dict)
-                
-                # Handle as neither Feature or Tile Service
-                else:
-                    write_to_log(log_file, f"{service_name} has an invalid Service Type of: {service_type}", False, cur_log_file_path)
-                
-                # Write runtime for this service to log
-                if start_timestamp is not None:
-                    seconds, minutes, hours = delta_time_system_timer(start_timestamp)
-                    write_to_log(log_file, f"Runtime: {hours} hours, {minutes} minutes, {seconds} seconds.", False, cur_log_file_path)
-                write_to_log(log_file, f"Summary Log File: {log_file}.", False, cur_log_file_path)
-                write_to_log(log_file, "")
-                
-                # Send Email of final result if process failed
-                if result >= 1:
-                    failed_log_list[index] = [cur_log_file_path, service_name]
-                    index += 1
-                
-                # Continue if successful
-                elif result == 0:
-                    log_list.append(cur_log_file_path)
-        
+                if config["profiling"]["run"]:
+                    init_dict['PROFILE'] = "True"
+                if resuming:
+                    init_dict['RESUME'] = "True"
+                jobs.append((file_name, init_dict))
         except Exception:
             throw_exception(log_file)
-    
+
+    # Sources used by several services are extracted once per run into the extract store
+    if rebuild_data and config["extract"]["share"]:
+        write_to_log(log_file, "Finding sources shared between services", True)
+        with trace_span("shared_extracts"):
+            start_extract_store(jobs, resuming)
+
+    # Run services, results come back keyed by .ini so they are collected in list order
+    # Every service hands its layer tasks to one warm worker pool for the run
+    start_worker_pool()
+    try:
+        with trace_span("services", services=len(jobs)):
+            service_results = run_service_scheduler(jobs)
+    finally:
+        stop_worker_pool()
+
+    for file_name, init_dict in jobs:
+        if file_name not in service_results or service_results[file_name] is None:
+            continue
+        result, service_log_file_path, service_name = service_results[file_name]
+
+        # Send Email of final result if process failed
+        if result >= 1:
+            failed_log_list[index] = [service_log_file_path, service_name]
+            index += 1
+
+        # Continue if successful
+        elif result == 0:
+            log_list.append(service_log_file_path)
+
+    # Every service has its copy of the shared extracts
+    if os.path.exists(extract_store_path):
+        write_to_log(log_file, "Removing the extract store.", True)
+        shutil.rmtree(extract_store_path, ignore_errors=True)
+
     # Copy data back to Network Drive
     write_to_log(log_file, "Copying data from local to network drive.", True)
 
     if rebuild_data:
-        # Remove Old Data from network
-        if os.path.exists(data_path):
-            shutil.rmtree(data_path)
+        # Copy only changed local data to network drive, files missing from the local data are removed from it
+        # Skipped services carry their last outputs forward into the local data so they are kept, the outputs of
+        # failed services are left as they are on the network drive
+        failed_outputs = []
+        for service_log_file_path, service_name in failed_log_list.values():
+            failed_outputs += get_service_outputs(data_path, service_name) + \
+                get_service_outputs(local_data_path, service_name)
+        with trace_span("copy_back"):
+            sync_folder(local_data_path, data_path, ("history",) + tuple(failed_outputs))
+
+        # Keep this run as a generation in the History store
+        write_to_log(log_file, "Adding run to History.", True)
         try:
-            shutil.copytree(local_data_path, data_path, ignore_dangling_symlinks=True)
+            with trace_span("history_add"):
+                add_history_generation(local_data_path)
         except Exception:
-            pass
-
-        # Copy new local data to network drive
-        if not os.path.exists(data_path):
-            try:
-                shutil.copytree(local_data_path, data_path, ignore_dangling_symlinks=True)
-            except Exception:
-                pass
+            throw_exception(log_file)
     
     # Send final result email
     write_to_log(log_file, "Sending Result Emails.", True)
+    flush_log()  # Service logs are read back into the emails
     if len(log_list) > 0:
         send_email(True, "", log_list)
     if len(failed_log_list) > 0:
@@ -190,793 +348,3719 @@ def main():
     # Delete all temp logs for emails
     if os.path.exists(temp_folder):
         shutil.rmtree(temp_folder)
+    complete_run_journal()
     
     # Write final runtime to log
     if total_time is not None:
         seconds, minutes, hours = delta_time_system_timer(total_time)
         write_to_log(log_file, f"Total Runtime: {hours} hours, {minutes} minutes, { seconds} seconds.", False)
+
+    # Metrics are read back from the trace file once every span of the run is written
+    write_span("run", run_start, time.monotonic() - run_monotonic, "ok" if not failed_log_list else "error", None,
+               {"services": len(jobs), "failed": len(failed_log_list)})
+    flush_log()
+    write_run_metrics()
     write_to_log(log_file, "End Update Pipeline", True)
     write_to_log(log_file, "", False)
     write_to_log(log_file, "----------------------------------------------------------------------------------", False)
+    stop_logging()
     
 
-# Initiate global variables 
-def init_sources():
-    global log_file, list_path, month_day_year, data_path, log_path, local_data_path, local_path, \
-        target_folder_path, portal_name, folder_name_global, temp_folder, history_path, local_hisotry_path
-    
-    local_path = os.getcwd()
-    month_day_year = f"{datetime.datetime.now().strftime('%m_%d_%Y')}"
-    
-    crash_file = f"{local_path}\\CRASH_{month_day_year}.txt"
-    if os.path.exists(crash_file):
-        os.remove(crash_file)
-    
-    try:
-        if debug is False:
-            target_folder_path = str(sys.argv[1])
-        else:
-            target_folder_path = "***************************"
-        
-        if target_folder_path is None or target_folder_path == "":
-            write_to_log(crash_file, "ERROR: No Target Folder Path.", True)
-            sys.exit()
-            
-        else:
-            list_path = f"{target_folder_path}\\list"
-            data_path = f"{target_folder_path}\\data"
-            log_path = f"{target_folder_path}\\logs"
-            temp_folder = f"{target_folder_path}\\TO_DELETE"
-            history_path = f"{target_folder_path}\\data\\history"
-            
-            if not os.path.exists(log_path):
-                os.mkdir(log_path)
-            log_file = f"{log_path}\\log_portal_update_{month_day_year}.txt"
-            if not os.path.exists(data_path):
-                os.mkdir(data_path)
-            if not os.path.exists(history_path):
-                os.mkdir(history_path)
-    
-            local_data_path = f"{local_path}\\data"
-            local_hisotry_path = f"{local_data_path}\\history"
-            split_path = target_folder_path.split("\\")
-            portal_name = split_path[-2]
-            folder_name_global = split_path[-1]
-            
-    except Exception:
-        throw_exception(crash_file)
+# Read all arguments out of a .ini file
+def read_init_file(file_path: str):
+    init_dict = {}
+    with open(file_path, "r") as init_file:
+        line = init_file.readline()
 
+        while line:  # While Not Null
+            split_line = line.split('=')
+            if len(split_line) > 1:
+                init_dict[split_line[0].strip()] = split_line[1].strip()
+            line = init_file.readline()
+    return init_dict
+
+
+# Apply settings.ini in the script folder, then the --set section.key=value, --profile and --resume arguments, over
+# the defaults in config. Every process of the run that calls init_sources reads them again, so they hold in spawned
+# processes too; the log writer is handed its settings
+# Returns the names of settings config does not have or whose values do not parse
+def read_settings():
+    settings = []
+    settings_path = os.path.join(local_path, settings_file_name)
+    if os.path.exists(settings_path):
+        section = None
+        with open(settings_path, "r") as settings_file:
+            for line in settings_file:
+                line = line.strip()
+                if line.startswith("[") and line.endswith("]"):
+                    section = line[1:-1].strip()
+                elif section and "=" in line and not line.startswith(("#", ";")):
+                    split_line = line.split('=', 1)
+                    settings.append((f"{section}.{split_line[0].strip()}", split_line[1].strip()))
+    for position, argument in enumerate(sys.argv[2:-1], 2):
+        if argument == "--set" and "=" in sys.argv[position + 1]:
+            split_argument = sys.argv[position + 1].split('=', 1)
+            settings.append((split_argument[0].strip(), split_argument[1].strip()))
+    if "--profile" in sys.argv[2:]:
+        settings.append(("profiling.run", "True"))
+    if "--resume" in sys.argv[2:]:
+        settings.append(("checkpoints.resume", "True"))
+
+    invalid_settings = []
+    for setting_name, value in settings:
+        section = config
+        path = setting_name.split('.')
+        for part in path[:-1]:
+            section = section.get(part) if isinstance(section, dict) else None
+        if not isinstance(section, dict) or path[-1] not in section or isinstance(section[path[-1]], dict):
+            invalid_settings.append(setting_name)
+            continue
+        try:
+            section[path[-1]] = parse_setting(value, section[path[-1]])
+        except ValueError:
+            invalid_settings.append(setting_name)
+    return invalid_settings
+
+
+# Value of a setting read as text, of the type of the default it replaces
+def parse_setting(value: str, default):
+    if isinstance(default, bool):
+        return value.upper() == "TRUE"
+    if isinstance(default, int):
+        return int(value)
+    if isinstance(default, float):
+        return float(value)
+    if isinstance(default, tuple):
+        return tuple(part.strip() for part in value.split(',') if part.strip())
+    if default is None and value.upper() in ("NONE", ""):
+        return None
+    return value
+
+
+# Number of services allowed to run at once, bounded by the cores available
+def get_service_slots():
+    if debug:
+        return 1
+    return max(1, min(config["services"]["max_concurrent"], int(mp.cpu_count() / 2)))
+
+
+# Number of layer processes each service may use so all services together stay within the cores
+def get_layer_proc_count(service_slots: int):
+    cores = mp.cpu_count()
+    if service_slots <= 1:
+        return max(1, int(cores / 2))
+    # Each running service holds one process of its own plus its layer pool
+    return max(1, min(int(cores / 2), int(cores / service_slots) - 1))
+
+
+# Run every service job through the stage pipeline: services are extracted and staged (or packaged) by up to
+# services.max_concurrent workers, then wait in a bounded queue to be uploaded and published by up to
+# services.max_concurrent_publishes workers, so one service publishes while the next is still extracting
+def run_service_scheduler(jobs: list):
+    service_slots = get_service_slots()
+    publish_slots = max(1, config["services"]["max_concurrent_publishes"])
+    proc_count = get_layer_proc_count(service_slots)
+    results = {}
+
+    # Serial run in the main process
+    if service_slots == 1:
+        for file_name, init_dict in jobs:
+            results[file_name] = run_service(file_name, init_dict, proc_count)
+        return results
+
+    write_to_log(log_file, f"Running up to {service_slots} services extracting and {publish_slots} publishing at once, "
+                           f"{config['services']['max_per_portal']} per portal, {proc_count} layer processes each",
+                 False)
+
+    result_queue = mp.Queue()
+    pending = list(jobs)
+    staged = []   # [(job, handoff)] built and waiting to publish, in the order they finished
+    finished = {}   # (.ini, stage): stage result not yet collected
+    workers = []   # [process, task queue, running (stage, job) or None, last portal, pool client]
+    stage_counts = {"build": 0, "publish": 0}
+    portal_counts = {}
+
+    while pending or staged or [worker for worker in workers if worker[2] is not None]:
+        # Publish staged services first, so the queue drains and builds can start again
+        for staged_job in list(staged):
+            job, handoff = staged_job
+            portal = job[1].get('PORTALURL', "").lower()
+            if stage_counts["publish"] >= publish_slots:
+                break
+            if portal_counts.get(portal, 0) >= config["services"]["max_per_portal"]:
+                continue
+            worker = get_pipeline_worker(workers, portal, service_slots + publish_slots, result_queue, proc_count)
+            if worker is None:
+                break
+            worker[1].put(("publish", job[0], job[1], handoff))
+            worker[2] = ("publish", job)
+            worker[3] = portal
+            stage_counts["publish"] += 1
+            portal_counts[portal] = portal_counts.get(portal, 0) + 1
+            staged.remove(staged_job)
+
+        # Start builds while build slots are free and the staged queue has room
+        for job in list(pending):
+            if stage_counts["build"] >= service_slots or len(staged) >= config["services"]["queue_depth"]:
+                break
+            portal = job[1].get('PORTALURL', "").lower()
+            worker = get_pipeline_worker(workers, portal, service_slots + publish_slots, result_queue, proc_count)
+            if worker is None:
+                break
+            worker[1].put(("build", job[0], job[1], None))
+            worker[2] = ("build", job)
+            worker[3] = portal
+            stage_counts["build"] += 1
+            pending.remove(job)
+
+        # Wait for the next finished stage
+        try:
+            file_name, stage, result = result_queue.get(timeout=5)
+            finished[(file_name, stage)] = result
+        except queue.Empty:
+            pass
+
+        # Free workers whose stage has finished, drop workers that have died
+        for worker in list(workers):
+            proc, task_queue, task, portal, client = worker
+            if task is None:
+                continue
+            stage, job = task
+            file_name, init_dict = job
+            if (file_name, stage) not in finished:
+                if proc.is_alive():
+                    continue
+                proc.join()
+                while (file_name, stage) not in finished:
+                    try:
+                        done_name, done_stage, result = result_queue.get(timeout=1)
+                        finished[(done_name, done_stage)] = result
+                    except queue.Empty:
+                        break
+            if (file_name, stage) not in finished:
+                # Worker died without reporting, treat the service as failed
+                service_name = init_dict['SERVICENAME']
+                service_log_file_path = f"{temp_folder}\\{service_name}_{month_day_year}.txt"
+                write_to_log(log_file, f"ERROR: {file_name} exited with code {proc.exitcode} in {stage}", True,
+                             service_log_file_path)
+                finished[(file_name, stage)] = (1, service_log_file_path, service_name, None)
+
+            # A built service joins the staged queue, any other result ends the service
+            result = finished.pop((file_name, stage))
+            if result is not None and result[3] is not None:
+                staged.append((job, result[3]))
+            else:
+                results[file_name] = result[:3] if result is not None else None
+            if not proc.is_alive():
+                workers.remove(worker)
+            worker[2] = None
+            stage_counts[stage] -= 1
+            if stage == "publish":
+                portal_counts[portal] -= 1
+
+    # Stop the workers
+    for worker in workers:
+        worker[1].put(None)
+    for worker in workers:
+        worker[0].join()
+
+    return results
+
+
+# Idle service worker for the next stage, preferring one already signed in to the portal
+# Starts a new worker while there are fewer than max_workers, returns None when every worker is busy
+def get_pipeline_worker(workers: list, portal: str, max_workers: int, result_queue, proc_count: int):
+    idle_workers = [worker for worker in workers if worker[2] is None]
+    same_portal = [worker for worker in idle_workers if worker[3] == portal]
+    if same_portal:
+        return same_portal[0]
+    if idle_workers:
+        return idle_workers[0]
+    if len(workers) >= max_workers:
+        return None
+    used_clients = [worker[4] for worker in workers]
+    client = min(client for client in range(1, max_workers + 1) if client not in used_clients)
+    task_queue = mp.Queue()
+    proc = mp.Process(target=service_worker, args=(task_queue, result_queue, proc_count, log_queue,
+                                                   (pool_task_queue, pool_reply_queues, client)))
+    proc.start()
+    worker = [proc, task_queue, None, None, client]
+    workers.append(worker)
+    return worker
+
+
+# Service worker process, runs the service stages handed to it until told to stop
+# Portal sessions stay signed in between the stages it runs
+def service_worker(task_queue, result_queue, proc_count: int, cur_log_queue, pool_handles: tuple):
+    init_sources()
+    init_logging(cur_log_queue)
+    init_pool_client(pool_handles)
+    task = task_queue.get()
+    while task is not None:
+        stage, file_name, init_dict, handoff = task
+        result = None
+        try:
+            result = run_service_stage(stage, file_name, init_dict, proc_count, handoff)
+        finally:
+            result_queue.put((file_name, stage, result))
+        task = task_queue.get()
+
+
+# Update a single service from its .ini arguments, both stages in this process
+# Returns result, service log and service name
+def run_service(file_name: str, init_dict: dict, proc_count: int):
+    service_result = run_service_stage("build", file_name, init_dict, proc_count)
+    if service_result is not None and service_result[3] is not None:
+        service_result = run_service_stage("publish", file_name, init_dict, proc_count, service_result[3])
+    return service_result[:3] if service_result is not None else None
+
+
+# Number of warm pool workers, as many as the layer processes of the services running at once
+def get_pool_size():
+    if config["pool"]["workers"] > 0:
+        return config["pool"]["workers"]
+    service_slots = get_service_slots()
+    return service_slots * get_layer_proc_count(service_slots)
+
+
+# Start the run's warm worker pool, which every service hands its layer tasks to through map_tasks
+# Each service worker gets a reply queue of its own, queue 0 is the main process's
+# No pool is started when it would have a single worker, tasks then run in the process that has them
+def start_worker_pool():
+    global pool_task_queue, pool_reply_queues, pool_client, pool_task_count, pool_processes, pool_running, \
+        pool_watcher, pool_stopping
+    pool_size = get_pool_size()
+    if debug or pool_size <= 1:
+        return
+    pool_task_queue = mp.Queue()
+    pool_reply_queues = [mp.Queue() for client in
+                         range(get_service_slots() + max(1, config["services"]["max_concurrent_publishes"]) + 1)]
+    pool_client = 0
+    pool_task_count = os.getpid() << 32
+    pool_running = mp.RawArray('q', [-1] * (pool_size * 2))
+    pool_processes = [start_pool_worker(slot) for slot in range(pool_size)]
+    pool_stopping = threading.Event()
+    pool_watcher = threading.Thread(target=watch_worker_pool, daemon=True)
+    pool_watcher.start()
+    write_to_log(log_file, f"Started {pool_size} pool workers", False)
+
+
+# Start the pool worker of a slot
+def start_pool_worker(slot: int):
+    proc = mp.Process(target=pool_worker, args=(slot, pool_task_queue, pool_reply_queues, pool_running, log_queue),
+                      daemon=True)
+    proc.start()
+    return proc
+
+
+# Replace pool workers that exit, recycled or crashed; the task a crashed worker was running fails back to its client
+def watch_worker_pool():
+    while not pool_stopping.wait(1):
+        for slot, proc in enumerate(pool_processes):
+            if proc.is_alive():
+                continue
+            client, task_id = pool_running[slot * 2], pool_running[slot * 2 + 1]
+            if task_id >= 0:
+                write_to_log(log_file, f"ERROR: Pool worker {slot} exited with code {proc.exitcode}", True)
+                pool_reply_queues[client].put((task_id, None, f"Pool worker {slot} exited with code {proc.exitcode}"))
+                pool_running[slot * 2 + 1] = -1
+            pool_processes[slot] = start_pool_worker(slot)
+
+
+# Stop the pool's workers once every service has finished
+def stop_worker_pool():
+    global pool_task_queue, pool_reply_queues, pool_processes, pool_watcher
+    if pool_task_queue is None:
+        return
+    pool_stopping.set()
+    pool_watcher.join()
+    for proc in pool_processes:
+        pool_task_queue.put(None)
+    for proc in pool_processes:
+        proc.join(30)
+        if proc.is_alive():
+            proc.terminate()
+    pool_task_queue = None
+    pool_reply_queues = None
+    pool_processes = []
+    pool_watcher = None
+
+
+# Point this process's map_tasks at the run's worker pool as the given client
+def init_pool_client(pool_handles: tuple):
+    global pool_task_queue, pool_reply_queues, pool_client, pool_task_count
+    pool_task_queue, pool_reply_queues, pool_client = pool_handles
+    pool_task_count = os.getpid() << 32
+
+
+# Warm pool worker, runs the tasks of every service until told to stop
+# Its projects and SDE connections stay open between tasks; once it holds more than pool.memory_limit_mb after a
+# task it exits and the pool starts a fresh worker in its slot
+def pool_worker(slot: int, task_queue, reply_queues: list, running, cur_log_queue):
+    global extract_slot, trace_service, profile_folder, worker_profiler, worker_projects, worker_connections
+    init_worker(cur_log_queue)
+    extract_slot = slot
+    worker_projects = {}
+    worker_connections = {}
+    profilers = {}   # Profile folder: profiler, a worker may run tasks of several profiled services
+    task = task_queue.get()
+    while task is not None:
+        client, task_id, task_function, args, trace_service, profile_folder = task
+        running[slot * 2] = client
+        running[slot * 2 + 1] = task_id
+        worker_profiler = None
+        if profile_folder:
+            worker_profiler = profilers.setdefault(profile_folder, cProfile.Profile())
+        try:
+            reply = (task_id, task_function(args), None)
+        except Exception:
+            reply = (task_id, None, traceback.format_exc())
+        reply_queues[client].put(reply)
+        running[slot * 2 + 1] = -1
+
+        memory = get_process_memory()
+        if memory > config["pool"]["memory_limit_mb"] * 1048576:
+            write_to_log(log_file, f"Pool worker {slot} holds {round(memory / 1048576)} MB, recycling", False)
+            break
+        task = task_queue.get()
+
+
+# Run tasks on the run's worker pool as its workers free up, results in the order they finish
+# Without a pool the tasks run one after another in this process
+def map_tasks(task_function, task_args: list):
+    global pool_task_count
+    if pool_task_queue is None:
+        return [task_function(args) for args in task_args]
+    waiting = set()
+    for args in task_args:
+        pool_task_count += 1
+        waiting.add(pool_task_count)
+        pool_task_queue.put((pool_client, pool_task_count, task_function, args, trace_service, profile_folder))
+
+    results = []
+    while waiting:
+        task_id, result, error = pool_reply_queues[pool_client].get()
+        if task_id not in waiting:
+            # Reply to a task given up on after another failed
+            continue
+        waiting.remove(task_id)
+        if error is not None:
+            raise RuntimeError(f"{task_function.__name__} failed in the worker pool: {error}")
+        results.append(result)
+    return results
+
+
+# Project opened once by a pool worker and reopened when the file changes, other processes open it every time
+def get_worker_project(project_path: str):
+    if worker_projects is None:
+        return arcpy.mp.ArcGISProject(project_path)
+    modified = os.path.getmtime(project_path)
+    if project_path not in worker_projects or worker_projects[project_path][0] != modified:
+        worker_projects[project_path] = (modified, arcpy.mp.ArcGISProject(project_path))
+    return worker_projects[project_path][1]
+
+
+# SDE workspace of a source feature class, described once by a pool worker so it keeps the connection open for the
+# layers of every service it extracts afterwards. Other processes connect for each extraction, None is returned
+def get_worker_connection(fc_path: str):
+    if worker_connections is None:
+        return None
+    connection_path = os.path.join(local_path, os.path.relpath(fc_path, local_path).split(os.sep)[0])
+    if connection_path not in worker_connections:
+        worker_connections[connection_path] = arcpy.Describe(connection_path)
+    return worker_connections[connection_path]
+
+
+# Memory counters of a process, as GetProcessMemoryInfo fills them in on Windows
+class ProcessMemoryCounters(ctypes.Structure):
+    _fields_ = [("cb", ctypes.c_ulong), ("PageFaultCount", ctypes.c_ulong)] + \
+               [(name, ctypes.c_size_t) for name in ("PeakWorkingSetSize", "WorkingSetSize", "QuotaPeakPagedPoolUsage",
+                                                     "QuotaPagedPoolUsage", "QuotaPeakNonPagedPoolUsage",
+                                                     "QuotaNonPagedPoolUsage", "PagefileUsage", "PeakPagefileUsage")]
+
+
+# Memory in use by this process in bytes, its working set on Windows and resident set where /proc is mounted
+# Returns 0 where neither can be read, a pool worker is then never recycled for its memory
+def get_process_memory():
+    if os.name == "nt":
+        counters = ProcessMemoryCounters()
+        counters.cb = ctypes.sizeof(counters)
+        # -1 is the handle of the current process
+        if ctypes.windll.psapi.GetProcessMemoryInfo(ctypes.c_void_p(-1), ctypes.byref(counters), counters.cb):
+            return counters.WorkingSetSize
+        return 0
+    if not os.path.exists("/proc/self/statm"):
+        return 0
+    with open("/proc/self/statm", "r") as statm_reader:
+        return int(statm_reader.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+# Run one stage of a service: "build" extracts and stages (or packages) it, "publish" uploads and publishes what
+# the build handed off. Returns result, service log, service name and the handoff for the publish stage, which is
+# None when the service has nothing left to do
+def run_service_stage(stage: str, file_name: str, init_dict: dict, proc_count: int, handoff: dict = None):
+    # Allowing edit of global variables
+    global currentLogFileName, cur_log_file_path, layer_proc_count, trace_service
+
+    start_timestamp = delta_time_system_timer(0)
+    stage_start = time.time()
+    stage_monotonic = time.monotonic()
+    profiler = None
+    result = 0
+    layer_proc_count = proc_count
+    retry_stats.clear()
 
-# Publish/Update Vector Tile Service
-def vector_tile_update(init_dict):
-    global cur_log_file_path
-    
     try:
-        write_to_log(log_file, "Begin", True)
-        
-        # Get config arguments from .ini
+        service_type = init_dict['SERVICETYPE']  # Feature, Vector Tile, Tile, Map Image
         service_name = init_dict['SERVICENAME']
-        service_id = init_dict['SERVICEID']
-        folder_name = init_dict['FOLDERNAME']
-        project_path = init_dict['APRX']
-        tags = init_dict['TAGS']
-        description = init_dict['DESCRIPTION']
-        copy_data = init_dict['COPYDATA']
-        editing = init_dict['EDITING']
-        exporting = init_dict['EXPORTING']
-        sync = init_dict['SYNC']
-        everyone = init_dict['EVERYONE']
-        org = init_dict['ORG']
-        groups = init_dict['GROUPS']
-        portal_url = init_dict['PORTALURL']
-        admin_user = init_dict['ADMINUSER']
-        admin_pass = init_dict['ADMINPASS']
-        max_cache = init_dict['MAXCACHE']
-        
-        # Set sharing options
-        shrOrg = True if org.upper() == 'TRUE' else False
-        shrEveryone = True if everyone.upper() == 'TRUE' else False
-        groups = None if groups.upper() == "NONE" else [group.strip() for group in groups.split(',')]
-        folder_name = None if folder_name.upper() == "NONE" else folder_name
-        copy_data = True if copy_data.upper() == 'TRUE' else False
-        editing = True if editing.upper() == "TRUE" else False
-        exporting = True if exporting.upper() == 'TRUE' else False
-        sync = True if sync.upper() == 'TRUE' else False
+        trace_service = service_name
+        profiler = start_service_profile(f"{service_name}_{stage}", init_dict)
+        currentLogFileName = f"{service_name}_{month_day_year}.txt"
+        cur_log_file_path = f"{temp_folder}\\{currentLogFileName}"
 
-        # Assign VTPK name
-        pckg_name = f"{service_name}_{month_day_year}"
-        pckg_name_vtpk = f"{pckg_name}.vtpk"
-        temp_name = f"temp_{service_name[:12]}"
-        pckg_name_vtpk_path = os.path.join(local_data_path, pckg_name_vtpk)
+        if stage == "build":
+            write_to_log(log_file, f"Opening {file_name}", False, cur_log_file_path)
+            write_to_log(log_file, f"Hostname: {socket.getfqdn()}", False, cur_log_file_path)
+            write_to_log(log_file, f"Updating {service_name} as a {service_type}.", False, cur_log_file_path)
+
+            # A service that finished in the interrupted run is not run again
+            if start_service_journal(service_name, init_dict):
+                write_to_log(log_file, f"{service_name} finished in the interrupted run, skipping.", True,
+                             cur_log_file_path)
+                return 0, cur_log_file_path, service_name, None
+
+            # Handle as Feature Service
+            if service_type.upper() == "FEATURE":
+                result, handoff = hosted_feature_build(init_dict)
+
+            # Handle as Vector Tile Service
+            elif service_type.upper() == "VECTOR TILE":
+                result, handoff = vector_tile_build(init_dict)
+                if result > 1:
+                    write_to_log(log_file, "Retrying due to failed run.", False, cur_log_file_path)
+                    write_to_log(log_file, "")
+                    result, handoff = vector_tile_build(init_dict)
+
+            # Handle as neither Feature or Tile Service
+            else:
+                write_to_log(log_file, f"{service_name} has an invalid Service Type of: {service_type}", False,
+                             cur_log_file_path)
+
+            # The publish stage takes up the service's checkpoints after the ones this stage confirmed or made
+            if handoff is not None:
+                handoff["checkpoints"] = service_journal_position
 
-        # Define Portal connection
-        if "arcgis" in portal_url:
-            target_portal = f"https://{portal_url}"
         else:
-            target_portal = f"https://{portal_url}/portal"
+            write_to_log(log_file, f"Publishing {service_name} from {socket.getfqdn()}.", False, cur_log_file_path)
+            continue_service_journal(service_name, handoff["checkpoints"])
+            if service_type.upper() == "FEATURE":
+                result = hosted_feature_publish(init_dict, handoff)
+            else:
+                result = vector_tile_publish(init_dict, handoff)
+            handoff = None
 
-        if rebuild_data:
-            # Delete vtpk if already exists
-            if os.path.exists(pckg_name_vtpk_path):
-                os.remove(pckg_name_vtpk_path)
-        
-        # Pull Map from project
-        prj = arcpy.mp.ArcGISProject(project_path)
-        mp = prj.listMaps()[0]
-        write_to_log(log_file, f"Source Project: {project_path}", False, cur_log_file_path)
+        if handoff is None:
+            finish_service_journal(result)
 
-        # Create VTPK from Map
-        write_to_log(log_file, f"Creating {pckg_name_vtpk}", True)
-        sp_tiling_scheme = os.path.join(local_path, "tiling_scheme_SP.xml")
-        max_cached_scale = int(max_cache)
-        if rebuild_data:
-            try:
-                arcpy.CreateVectorTilePackage_management(in_map=mp,
-                                                         output_file=pckg_name_vtpk_path,
-                                                         service_type="EXISTING",
-                                                         tiling_scheme=sp_tiling_scheme,
-                                                         max_cached_scale=max_cached_scale,
-                                                         tile_structure='INDEXED',
-                                                         summary=description,
-                                                         tags=tags)
-            except Exception:  # Fail safe
-                time.sleep(60)  # Give time if Portal is lagging
-                arcpy.CreateVectorTilePackage_management(in_map=mp,
-                                                         output_file=pckg_name_vtpk_path,
-                                                         service_type="EXISTING",
-                                                         tiling_scheme=sp_tiling_scheme,
-                                                         max_cached_scale=max_cached_scale,
-                                                         tile_structure='INDEXED',
-                                                         summary=description,
-                                                         tags=tags)
+        # Write runtime for this stage to log
+        if start_timestamp is not None:
+            seconds, minutes, hours = delta_time_system_timer(start_timestamp)
+            write_to_log(log_file, f"{stage.capitalize()} Runtime: {hours} hours, {minutes} minutes, {seconds} "
+                                   f"seconds.", False, cur_log_file_path)
+        log_retry_stats(cur_log_file_path)
+        write_span(f"service_{stage}", stage_start, time.monotonic() - stage_monotonic,
+                   "ok" if result == 0 else "error", None, {"service_type": service_type})
+        if handoff is None:
+            write_to_log(log_file, f"Summary Log File: {log_file}.", False, cur_log_file_path)
+            write_to_log(log_file, "")
 
-        # Close connection to Project
-        del prj
+        return result, cur_log_file_path, service_name, handoff
 
-        # Login to ArcGIS Portal
-        gis = GIS(target_portal, admin_user, admin_pass)
-        write_to_log(log_file, "Active Portal: {gis.url}", True, cur_log_file_path)
+    except Exception:
+        throw_exception(log_file)
+        return None
 
-        # Delete VTPK if exists in Portal
-        write_to_log(log_file, "Clear Service Namespace", True, cur_log_file_path)
+    finally:
+        trace_service = None
+        if profiler is not None:
+            save_service_profile(f"{service_name}_{stage}", profiler)
 
-        # Delete Temp package if exists
-        search_query = f"title:{temp_name} AND owner:{admin_user}"
-        for temp_vtpk in gis.content.search(search_query, item_type="Vector Tile Package"):
-            try:
-                temp_vtpk.delete()
-            except Exception:
-                time.sleep(60)  # Give time if portal is lagging
-                temp_vtpk.delete()  # Try again
-        # Delete Temp Service if exists
-        for temp_serv in gis.content.search(search_query, item_type="Vector Tile Service"):
-            try:
-                temp_serv.delete()
-            except Exception:
-                time.sleep(60)  # Give time if portal is lagging
-                temp_serv.delete()  # Try again
-        search_query = f"title:{pckg_name} AND owner:{admin_user}"
-        for old_vtpk in gis.content.search(search_query, item_type="Vector Tile Package"):
-            if old_vtpk.title == pckg_name and old_vtpk:
+
+# Move everything in the local data folder into its history folder, replacing the previous history
+# Moves are renames on the same drive, so nothing is copied
+def rotate_history(rotate_data_path: str, rotate_history_path: str):
+    if os.path.exists(rotate_history_path):
+        shutil.rmtree(rotate_history_path)
+    os.mkdir(rotate_history_path)
+    for data in os.listdir(rotate_data_path):
+        if data.upper() != "HISTORY":
+            file_path = os.path.join(rotate_data_path, data)
+            if data == "Index":
+                shutil.rmtree(file_path, ignore_errors=True)
+            else:
                 try:
-                    old_vtpk.delete()
+                    shutil.move(file_path, os.path.join(rotate_history_path, data))
                 except Exception:
-                    time.sleep(60)  # Give time if portal is lagging
-                    old_vtpk.delete()  # Try again
-        for old_serv in gis.content.search(search_query, item_type="Vector Tile Service"):
-            if old_serv.title == pckg_name and old_serv:
+                    throw_exception(log_file, file_path)
+
+
+# Hash the contents of a file
+def get_file_hash(file_path: str):
+    file_hash = hashlib.sha1()
+    with open(file_path, "rb") as hash_reader:
+        chunk = hash_reader.read(1048576)
+        while chunk:
+            file_hash.update(chunk)
+            chunk = hash_reader.read(1048576)
+    return file_hash.hexdigest()
+
+
+# Compare two files by size and modified time, falling back to a content hash when only the time differs
+def files_match(src_file: str, dst_file: str):
+    try:
+        dst_stat = os.stat(dst_file)
+    except OSError:
+        return False
+    src_stat = os.stat(src_file)
+    if src_stat.st_size != dst_stat.st_size:
+        return False
+    if abs(src_stat.st_mtime - dst_stat.st_mtime) <= 2:  # SMB reports times at 2 second resolution
+        return True
+    if config["sync"]["verify_hash"] and get_file_hash(src_file) == get_file_hash(dst_file):
+        os.utime(dst_file, (dst_stat.st_atime, src_stat.st_mtime))
+        return True
+    return False
+
+
+# Copy a file if it changed, writing to a temporary name and renaming it into place
+# Returns the number of bytes copied
+def sync_file(src_file: str, dst_file: str):
+    if files_match(src_file, dst_file):
+        return 0
+    partial_file = f"{dst_file}.partial"
+    shutil.copy2(src_file, partial_file)
+    os.replace(partial_file, dst_file)
+    return os.path.getsize(dst_file)
+
+
+# Mirror one folder into another, copying only new or changed files with a pool of copy threads
+# Files missing from the source are removed only once every copy has succeeded
+# Top level folders and files named in exclude are left alone on both sides
+def sync_folder(src_dir: str, dst_dir: str, exclude: tuple = ()):
+    if not os.path.exists(dst_dir):
+        os.makedirs(dst_dir)
+    exclude = [name.upper() for name in exclude]
+
+    src_files = set()
+    copy_jobs = []
+    for root, dirs, files in os.walk(src_dir):
+        rel_root = os.path.relpath(root, src_dir)
+        if rel_root == ".":
+            dirs[:] = [dir_name for dir_name in dirs if dir_name.upper() not in exclude]
+            files = [file_name for file_name in files if file_name.upper() not in exclude]
+        dst_root = os.path.normpath(os.path.join(dst_dir, rel_root))
+        if not os.path.exists(dst_root):
+            os.makedirs(dst_root)
+        for file_name in files:
+            if file_name.endswith(config["sync"]["ignore_suffixes"]):
+                continue
+            rel_path = os.path.normpath(os.path.join(rel_root, file_name))
+            src_files.add(os.path.normcase(rel_path))
+            copy_jobs.append((os.path.join(src_dir, rel_path), os.path.join(dst_dir, rel_path)))
+
+    copied_files = 0
+    copied_bytes = 0
+    failed_files = 0
+    with ThreadPoolExecutor(max_workers=config["sync"]["threads"]) as executor:
+        futures = {executor.submit(sync_file, src_file, dst_file): src_file for src_file, dst_file in copy_jobs}
+        for future in as_completed(futures):
+            try:
+                file_bytes = future.result()
+                if file_bytes > 0:
+                    copied_files += 1
+                    copied_bytes += file_bytes
+            except Exception:
+                failed_files += 1
+                throw_exception(log_file, futures[future])
+
+    removed_files = 0
+    if failed_files == 0:
+        for root, dirs, files in os.walk(dst_dir, topdown=False):
+            rel_root = os.path.relpath(root, dst_dir)
+            if rel_root.split(os.sep)[0].upper() in exclude:
+                continue
+            for file_name in files:
+                rel_path = os.path.normpath(os.path.join(rel_root, file_name))
+                if file_name.endswith(config["sync"]["ignore_suffixes"]) or os.path.normcase(rel_path) in src_files or \
+                        rel_path.upper() in exclude:
+                    continue
                 try:
-                    old_serv.delete()
+                    os.remove(os.path.join(dst_dir, rel_path))
+                    removed_files += 1
                 except Exception:
-                    time.sleep(60)  # Give time if portal is lagging
-                    old_serv.delete()  # Try again
+                    throw_exception(log_file, rel_path)
+            if rel_root != "." and not os.path.exists(os.path.join(src_dir, rel_root)):
+                shutil.rmtree(root, ignore_errors=True)
+    else:
+        write_to_log(log_file, f"ERROR: {failed_files} files failed to copy, keeping extra files in {dst_dir}")
+
+    write_to_log(log_file, f"Synced {src_dir} to {dst_dir}: {copied_files} files copied "
+                           f"({round(copied_bytes / 1048576, 1)} MB), {removed_files} removed, "
+                           f"{len(copy_jobs) - copied_files - failed_files} unchanged.")
+    return failed_files
+
+
+# List the generations in the History store, oldest first
+def list_history_generations():
+    generations_path = os.path.join(history_path, "generations")
+    if not os.path.exists(generations_path):
+        return []
+    return sorted(os.path.splitext(name)[0] for name in os.listdir(generations_path) if name.endswith(".json"))
+
+
+# Read the file list of a History generation, {relative path: [hash, size, mtime]}
+def read_history_generation(generation: str):
+    with open(os.path.join(history_path, "generations", f"{generation}.json"), "r") as generation_reader:
+        return json.load(generation_reader)["files"]
+
+
+# Path of a compressed file in the History store
+def get_history_object_path(file_hash: str):
+    return os.path.join(history_path, "objects", file_hash[:2], f"{file_hash}.gz")
+
+
+# Compress a file into the History store unless its contents are already there
+# Returns the number of compressed bytes written
+def store_history_object(file_path: str, file_hash: str):
+    object_path = get_history_object_path(file_hash)
+    if os.path.exists(object_path):
+        return 0
+    object_dir = os.path.dirname(object_path)
+    if not os.path.exists(object_dir):
+        os.makedirs(object_dir, exist_ok=True)
+    partial_path = f"{object_path}.{threading.get_ident()}.partial"
+    with open(file_path, "rb") as object_reader, \
+            gzip.open(partial_path, "wb", compresslevel=config["history"]["compress_level"]) as object_writer:
+        shutil.copyfileobj(object_reader, object_writer, 1048576)
+    os.replace(partial_path, object_path)
+    return os.path.getsize(object_path)
+
+
+# Add the contents of a data folder to the History store as a new generation
+# Files with the same size and modified time as the last generation reuse its hash and are not read again
+def add_history_generation(src_dir: str):
+    generations = list_history_generations()
+    prior_files = read_history_generation(generations[-1]) if generations else {}
+
+    history_files = {}
+    hash_jobs = []
+    for root, dirs, files in os.walk(src_dir):
+        rel_root = os.path.relpath(root, src_dir)
+        if rel_root == ".":
+            dirs[:] = [dir_name for dir_name in dirs if dir_name.upper() != "HISTORY"]
+        for file_name in files:
+            if file_name.endswith(config["sync"]["ignore_suffixes"]):
+                continue
+            rel_path = os.path.normpath(os.path.join(rel_root, file_name))
+            file_stat = os.stat(os.path.join(src_dir, rel_path))
+            prior_file = prior_files.get(rel_path)
+            if prior_file and prior_file[1] == file_stat.st_size and prior_file[2] == int(file_stat.st_mtime):
+                history_files[rel_path] = prior_file
+            else:
+                hash_jobs.append((rel_path, file_stat))
+
+    # Hash and compress changed files in parallel, zlib and hashlib release the GIL
+    def store_file(rel_path, file_stat):
+        file_path = os.path.join(src_dir, rel_path)
+        file_hash = get_file_hash(file_path)
+        return [file_hash, file_stat.st_size, int(file_stat.st_mtime)], store_history_object(file_path, file_hash)
+
+    stored_bytes = 0
+    with ThreadPoolExecutor(max_workers=config["sync"]["threads"]) as executor:
+        futures = {executor.submit(store_file, rel_path, file_stat): rel_path for rel_path, file_stat in hash_jobs}
+        for future in as_completed(futures):
+            history_files[futures[future]], object_bytes = future.result()
+            stored_bytes += object_bytes
+
+    generation = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
+    generations_path = os.path.join(history_path, "generations")
+    if not os.path.exists(generations_path):
+        os.makedirs(generations_path)
+    generation_file = os.path.join(generations_path, f"{generation}.json")
+    with open(f"{generation_file}.partial", "w") as generation_writer:
+        json.dump({"created": datetime.datetime.now().isoformat(), "files": history_files}, generation_writer)
+    os.replace(f"{generation_file}.partial", generation_file)
+
+    write_to_log(log_file, f"History generation {generation}: {len(history_files)} files, {len(hash_jobs)} changed, "
+                           f"{round(stored_bytes / 1048576, 1)} MB stored.")
+    evict_history()
+    return generation
+
+
+# Drop the oldest History generations past the generation count or byte budget, then unreferenced files
+def evict_history():
+    generations = list_history_generations()
+    generation_objects = {generation: set(file_info[0] for file_info in read_history_generation(generation).values())
+                          for generation in generations}
+    object_sizes = {}
+    for object_set in generation_objects.values():
+        for file_hash in object_set:
+            if file_hash not in object_sizes:
+                object_path = get_history_object_path(file_hash)
+                object_sizes[file_hash] = os.path.getsize(object_path) if os.path.exists(object_path) else 0
+
+    def referenced_bytes():
+        referenced = set()
+        for object_set in generation_objects.values():
+            referenced.update(object_set)
+        return sum(object_sizes[file_hash] for file_hash in referenced)
+
+    # Always keep the newest generation
+    while len(generations) > 1 and (len(generations) > config["history"]["generations"]
+                                    or referenced_bytes() > config["history"]["byte_budget"]):
+        oldest = generations.pop(0)
+        del generation_objects[oldest]
+        os.remove(os.path.join(history_path, "generations", f"{oldest}.json"))
+        write_to_log(log_file, f"History generation {oldest} evicted.")
+
+    referenced = set()
+    for object_set in generation_objects.values():
+        referenced.update(object_set)
+    objects_path = os.path.join(history_path, "objects")
+    if os.path.exists(objects_path):
+        for root, dirs, files in os.walk(objects_path):
+            for file_name in files:
+                if file_name.split(".")[0] not in referenced:
+                    os.remove(os.path.join(root, file_name))
+
+
+# Restore a History generation ("latest" for the newest) into a folder
+def restore_history_generation(generation: str, target_dir: str):
+    if generation.lower() == "latest":
+        generation = list_history_generations()[-1]
+    write_to_log(log_file, f"Restoring History generation {generation} to {target_dir}", True)
+    for rel_path, file_info in read_history_generation(generation).items():
+        file_path = os.path.join(target_dir, rel_path)
+        if not os.path.exists(os.path.dirname(file_path)):
+            os.makedirs(os.path.dirname(file_path))
+        with gzip.open(get_history_object_path(file_info[0]), "rb") as object_reader, \
+                open(f"{file_path}.partial", "wb") as object_writer:
+            shutil.copyfileobj(object_reader, object_writer, 1048576)
+        os.replace(f"{file_path}.partial", file_path)
+        os.utime(file_path, (file_info[2], file_info[2]))
+    write_to_log(log_file, f"Restored {generation}", True)
+
+
+# Build the portal address from the .ini PORTALURL, a full http(s) address is used as is
+def get_target_portal(portal_url: str):
+    if portal_url.lower().startswith(("http://", "https://")):
+        return portal_url.rstrip("/")
+    elif "arcgis" in portal_url:
+        return f"https://{portal_url}"
+    else:
+        return f"https://{portal_url}/portal"
+
+
+# Signed in portal session for a portal and user, reused by every service this process runs
+# The session holds the GIS connection and the REST address and token of the pipeline's own REST requests,
+# both are signed in again before the token of the last ones expires
+def get_portal_session(target_portal: str, admin_user: str, admin_pass: str):
+    session_key = (target_portal.lower(), admin_user.lower())
+    portal_config = config["portal"]
+    with portal_sessions_lock:
+        session = portal_sessions.setdefault(session_key, {})
+        if not session or time.time() - session["signed_in"] > get_token_refresh_seconds():
+            rest_url = f"{target_portal}/sharing/rest"
+            token_fields = {"f": "json", "username": admin_user, "password": admin_pass, "client": "referer",
+                            "referer": portal_config["token_referer"],
+                            "expiration": str(portal_config["token_minutes"])}
+            token = post_portal_form(f"{rest_url}/generateToken", token_fields)["token"]
+            session.update(gis=GIS(target_portal, admin_user, admin_pass, verify_cert=portal_config["verify_cert"]),
+                           rest_url=rest_url, token=token, signed_in=time.time())
+        return session
+
+
+# Seconds after signing in that a portal session or arcpy is signed in again, before its token expires
+def get_token_refresh_seconds():
+    return (config["portal"]["token_minutes"] - config["portal"]["token_refresh_minutes"]) * 60
+
+
+# Sign arcpy in to a portal unless it is already the active portal with a fresh token
+def sign_in_to_portal(target_portal: str, admin_user: str, admin_pass: str):
+    global arcpy_active_portal
+    session_key = (target_portal.lower(), admin_user.lower())
+    with portal_sessions_lock:
+        if arcpy_active_portal is None or arcpy_active_portal[0] != session_key or \
+                time.time() - arcpy_active_portal[1] > get_token_refresh_seconds():
+            arcpy.SignInToPortal(target_portal, admin_user, admin_pass)
+            arcpy_active_portal = [session_key, time.time()]
+
+
+# Every item an owner has in a portal, fetched once a page at a time and then kept up to date
+# by the pipeline's own adds and deletes, indexed by id and by (title, type)
+def get_portal_inventory(gis, owner: str):
+    inventory_key = (gis.url.lower(), owner.lower())
+    with portal_inventories_lock:
+        inventory = portal_inventories.get(inventory_key)
+        if inventory is None:
+            inventory = {"ids": {}, "titles": {}}
+            start = 1
+            while start > 0:
+                response = gis.content.advanced_search(query=f"owner:{owner}",
+                                                       max_items=config["portal"]["inventory_page_size"], start=start,
+                                                       sort_field="created")
+                for item in response.get("results", []):
+                    index_inventory_item(inventory, item)
+                start = response.get("nextStart", -1)
+            portal_inventories[inventory_key] = inventory
+            write_to_log(log_file, f"Portal inventory for {owner}: {len(inventory['ids'])} items", False)
+        return inventory
+
+
+# Add an item to the id and title indexes of an inventory
+def index_inventory_item(inventory: dict, item):
+    inventory["ids"][item.id] = item
+    inventory["titles"].setdefault(((item.title or "").lower(), item.type), set()).add(item.id)
+
+
+# Record an item the pipeline added to the portal
+def add_inventory_item(gis, owner: str, item):
+    inventory = get_portal_inventory(gis, owner)
+    with portal_inventories_lock:
+        remove_indexed_item(inventory, item.id)
+        index_inventory_item(inventory, item)
+
+
+# Record an item the pipeline deleted from the portal
+def remove_inventory_item(gis, owner: str, item):
+    inventory = get_portal_inventory(gis, owner)
+    with portal_inventories_lock:
+        remove_indexed_item(inventory, item.id)
+
+
+# Drop an item from the id and title indexes of an inventory
+def remove_indexed_item(inventory: dict, item_id: str):
+    item = inventory["ids"].pop(item_id, None)
+    if item is not None:
+        inventory["titles"].get(((item.title or "").lower(), item.type), set()).discard(item_id)
+
+
+# Items of an owner with this exact title and type
+# refresh asks the portal again for the title, for items the pipeline may have added without knowing
+def find_items(gis, owner: str, title: str, item_type: str, refresh: bool = False):
+    inventory = get_portal_inventory(gis, owner)
+    if refresh:
+        search_query = f"title:{title} AND owner:{owner}"
+        for item in gis.content.search(search_query, item_type=item_type):
+            with portal_inventories_lock:
+                remove_indexed_item(inventory, item.id)
+                index_inventory_item(inventory, item)
+    with portal_inventories_lock:
+        item_ids = inventory["titles"].get((title.lower(), item_type), set())
+        return [inventory["ids"][item_id] for item_id in item_ids]
+
+
+# Item by id, from the inventory when the owner has it
+def find_item_by_id(gis, owner: str, item_id: str):
+    inventory = get_portal_inventory(gis, owner)
+    with portal_inventories_lock:
+        if item_id in inventory["ids"]:
+            return inventory["ids"][item_id]
+    return gis.content.get(item_id)
+
+
+# Upload a file to a new portal item as a multipart upload and return the item
+def upload_item(session: dict, owner: str, file_path: str, item_properties: dict, folder: str = None):
+    gis = session["gis"]
+    if os.path.getsize(file_path) == 0:
+        raise ValueError(f"{os.path.basename(file_path)} is empty, nothing to upload")
+    folder_id = None
+    if folder:
+        for user_folder in gis.users.get(owner).folders:
+            if user_folder["title"].lower() == folder.lower():
+                folder_id = user_folder["id"]
+        if folder_id is None:
+            folder_id = gis.content.create_folder(folder, owner)["id"]
+    with trace_span("upload", bytes=os.path.getsize(file_path), item_type=item_properties["type"]):
+        item_id = upload_file_parts(session["rest_url"], session["token"], owner, file_path, item_properties,
+                                    folder_id)
+    return Item(gis, item_id)
+
+
+# Upload a file to a new portal item in fixed size parts, several at once, and commit it
+# Parts are read from a memory map of the file; confirmed parts and their checksums are kept in a journal in the
+# state folder, so an upload that fails is resumed from the parts the portal confirmed to it
+def upload_file_parts(rest_url: str, token: str, owner: str, file_path: str, item_properties: dict,
+                      folder_id: str = None):
+    file_name = os.path.basename(file_path)
+    file_size = os.path.getsize(file_path)
+    part_count = max(1, int(math.ceil(file_size / config["upload"]["part_bytes"])))
+    user_url = f"{rest_url.rstrip('/')}/content/users/{owner}"
+    journal_path = os.path.join(state_path, "uploads", f"{file_name}.json")
+
+    # Resume an upload of the same file into its item while the portal still has it, the portal has no listing of
+    # the parts it holds so the parts the journal recorded as confirmed are not sent again
+    journal = read_upload_journal(journal_path, file_path)
+    confirmed_checksums = {}
+    if journal:
+        try:
+            post_portal_form(f"{rest_url.rstrip('/')}/content/items/{journal['item']}", {"f": "json", "token": token})
+            confirmed_checksums = {int(part_number): checksum for part_number, checksum in journal["parts"].items()}
+            write_to_log(log_file, f"Resuming upload of {file_name}, {len(confirmed_checksums)} of {part_count} "
+                                   f"parts already sent", True, cur_log_file_path)
+        except Exception:
+            write_to_log(log_file, f"Item of the earlier upload of {file_name} is gone, starting over", True,
+                         cur_log_file_path)
+            journal = None
+    resumed = journal is not None
+    if not journal:
+        add_url = f"{user_url}/{folder_id}/addItem" if folder_id else f"{user_url}/addItem"
+        new_item = retry_call("upload", post_portal_form, add_url,
+                              {"f": "json", "token": token, "multipart": "true", "filename": file_name,
+                               "type": item_properties["type"],
+                               "title": item_properties.get("title", os.path.splitext(file_name)[0])})
+        journal = {"item": new_item["id"], "size": file_size, "mtime": os.path.getmtime(file_path),
+                   "part_bytes": config["upload"]["part_bytes"], "parts": {}}
+        write_upload_journal(journal_path, journal)
+    item_url = f"{user_url}/items/{journal['item']}"
+
+    # Send the parts, recording each confirmed part in the journal as it lands
+    upload_start = time.time()
+    sent_bytes = 0
+    done_parts = 0
+    logged_percent = 0
+    with open(file_path, "rb") as file_reader:
+        file_map = mmap.mmap(file_reader.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            with ThreadPoolExecutor(max_workers=config["upload"]["threads"]) as executor:
+                futures = [executor.submit(upload_part, file_map, part_number, item_url, token, file_name,
+                                           confirmed_checksums.get(part_number))
+                           for part_number in range(1, part_count + 1)]
+                for future in as_completed(futures):
+                    part_number, checksum, part_bytes = future.result()
+                    journal["parts"][str(part_number)] = checksum
+                    write_upload_journal(journal_path, journal)
+                    sent_bytes += part_bytes
+                    done_parts += 1
+                    percent = done_parts * 100 // part_count
+                    if percent >= logged_percent + config["upload"]["progress_percent"] or done_parts == part_count:
+                        logged_percent = percent
+                        megabytes_per_second = sent_bytes / 1048576 / max(time.time() - upload_start, 0.001)
+                        write_to_log(log_file, f"Uploaded {done_parts}/{part_count} parts of {file_name} ({percent}%, "
+                                               f"{megabytes_per_second:.1f} MB/s)", True, cur_log_file_path)
+        finally:
+            file_map.close()
+
+    # Commit the parts and wait for the portal to assemble the item
+    commit_fields = {"f": "json", "token": token}
+    for key, value in item_properties.items():
+        commit_fields[key] = ",".join(value) if isinstance(value, (list, tuple)) else str(value)
+    try:
+        retry_call("upload", post_portal_form, f"{item_url}/commit", commit_fields)
+    except Exception:
+        # A resumed item may have lost parts the journal recorded, the next attempt starts a new item
+        if resumed:
+            os.remove(journal_path)
+        raise
+    status_deadline = time.time() + config["retry"]["upload"]["deadline"]
+    while True:
+        status = retry_call("portal", post_portal_form, f"{item_url}/status", {"f": "json", "token": token})
+        if status.get("status") == "completed":
+            break
+        if status.get("status") == "failed" or time.time() > status_deadline:
+            raise RuntimeError(f"Upload of {file_name} did not complete: {status}")
+        time.sleep(config["upload"]["status_seconds"])
+    os.remove(journal_path)
+    return journal["item"]
+
+
+# Send one part of a memory mapped file unless the portal already has it, returns (part, checksum, bytes sent)
+def upload_part(file_map, part_number: int, item_url: str, token: str, file_name: str, confirmed_checksum: str):
+    part_bytes = config["upload"]["part_bytes"]
+    part_start = (part_number - 1) * part_bytes
+    with memoryview(file_map) as file_view, file_view[part_start:part_start + part_bytes] as part_view:
+        checksum = hashlib.sha1(part_view).hexdigest()
+        if checksum == confirmed_checksum:
+            return part_number, checksum, 0
+        part_bytes = len(part_view)
+        retry_call("upload", post_portal_form, f"{item_url}/addPart",
+                   {"f": "json", "token": token, "partNum": str(part_number)}, file_name, part_view)
+    return part_number, checksum, part_bytes
+
+
+# Read the journal of an earlier upload of a file, None when there is none or the file has changed since
+def read_upload_journal(journal_path: str, file_path: str):
+    if not os.path.exists(journal_path):
+        return None
+    try:
+        with open(journal_path, "r") as journal_reader:
+            journal = json.load(journal_reader)
+    except Exception:
+        return None
+    if journal.get("size") != os.path.getsize(file_path) or journal.get("mtime") != os.path.getmtime(file_path) or \
+            journal.get("part_bytes") != config["upload"]["part_bytes"]:
+        return None
+    return journal
+
+
+# Write the journal of an upload in progress
+def write_upload_journal(journal_path: str, journal: dict):
+    os.makedirs(os.path.dirname(journal_path), exist_ok=True)
+    temp_journal_path = f"{journal_path}.tmp"
+    with open(temp_journal_path, "w") as journal_writer:
+        json.dump(journal, journal_writer)
+    os.replace(temp_journal_path, journal_path)
+
+
+# POST a form to a portal REST endpoint and return the JSON response, raising on a portal error
+# With a file part the form is sent as multipart/form-data, streaming the part buffer without copying it
+def post_portal_form(url: str, fields: dict, file_name: str = None, file_part=None):
+    url_parts = urllib.parse.urlsplit(url)
+    if url_parts.scheme == "https":
+        ssl_context = None if config["portal"]["verify_cert"] else ssl._create_unverified_context()
+        connection = http.client.HTTPSConnection(url_parts.netloc, timeout=config["upload"]["timeout"],
+                                                 context=ssl_context)
+    else:
+        connection = http.client.HTTPConnection(url_parts.netloc, timeout=config["upload"]["timeout"])
+    if file_part is None:
+        body = [urllib.parse.urlencode(fields).encode("utf-8")]
+        content_type = "application/x-www-form-urlencoded"
+    else:
+        boundary = uuid.uuid4().hex
+        form_fields = "".join(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'
+                              for name, value in fields.items())
+        file_header = f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{file_name}"\r\n' \
+                      f'Content-Type: application/octet-stream\r\n\r\n'
+        body = [(form_fields + file_header).encode("utf-8"), file_part, f"\r\n--{boundary}--\r\n".encode("utf-8")]
+        content_type = f"multipart/form-data; boundary={boundary}"
+    try:
+        connection.request("POST", url_parts.path + (f"?{url_parts.query}" if url_parts.query else ""), body=body,
+                           headers={"Content-Type": content_type, "Referer": config["portal"]["token_referer"],
+                                    "Content-Length": str(sum(len(chunk) for chunk in body))})
+        response = connection.getresponse()
+        response_text = response.read().decode("utf-8")
+    finally:
+        connection.close()
+    if response.status >= 400:
+        raise ConnectionError(f"{url} returned HTTP {response.status}")
+    result = json.loads(response_text)
+    if "error" in result or result.get("success") is False:
+        raise ConnectionError(f"{url} returned {result.get('error', result)}")
+    return result
+
+
+# Call a function, retrying failures under a named retry policy with exponential backoff and jitter
+# Gives up and raises the last error on a non-retryable error, after the last attempt or at the deadline
+def retry_call(policy_name: str, func, *args, **kwargs):
+    policy = config["retry"][policy_name]
+    start = time.monotonic()
+    attempt = 1
+    while True:
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            if (isinstance(e, retry_fatal_errors) and not isinstance(e, retry_parse_errors)) or \
+                    attempt >= policy["attempts"]:
+                raise
+            backoff = min(policy["max_delay"], policy["delay"] * 2 ** (attempt - 1))
+            wait = backoff / 2 + random.uniform(0, backoff / 2)
+            if time.monotonic() - start + wait > policy["deadline"]:
+                raise
+            func_name = getattr(func, "__name__", str(func))
+            write_to_log(log_file, f"RETRY {func_name} ({policy_name}) attempt {attempt} failed: {e}. "
+                                   f"Waiting {round(wait, 1)} seconds.", False, cur_log_file_path)
+            stats = retry_stats.setdefault(policy_name, [0, 0.0])
+            stats[0] += 1
+            stats[1] += wait
+            time.sleep(wait)
+            attempt += 1
+
+
+# Start profiling a service when the run or the service's .ini (PROFILE = True) asks for it
+# Returns the profiler, or None when the service is not profiled
+def start_service_profile(service_name: str, init_dict: dict):
+    global profile_folder
+    if init_dict.get('PROFILE', "False").upper() != 'TRUE':
+        return None
+    profile_folder = os.path.join(log_path, "profiles", f"{service_name}_{trace_run_id or month_day_year}")
+    if os.path.exists(profile_folder):
+        shutil.rmtree(profile_folder)
+    os.makedirs(profile_folder)
+    write_to_log(log_file, f"Profiling {service_name}", False, cur_log_file_path)
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+
+# Merge a service's profile with the profiles its pool workers wrote and save it next to the logs, with a summary
+# of where the time went and the top functions by cumulative and by own time
+def save_service_profile(service_name: str, profiler):
+    global profile_folder
+    profiler.disable()
+    try:
+        summary = io.StringIO()
+        stats = pstats.Stats(profiler, stream=summary)
+        worker_profiles = [os.path.join(profile_folder, file_name) for file_name in os.listdir(profile_folder)
+                           if file_name.endswith(".prof")]
+        for worker_profile in worker_profiles:
+            stats.add(worker_profile)
+
+        profile_name = f"{log_path}\\profile_{service_name}_{trace_run_id or month_day_year}"
+        stats.dump_stats(f"{profile_name}.prof")
+        summary.write(f"Profile of {service_name}, service process and {len(worker_profiles)} pool workers\n\n")
+        for area, seconds in get_profile_areas(stats):
+            summary.write(f"{area}: {round(seconds, 1)} seconds\n")
+        stats.sort_stats("cumulative").print_stats(config["profiling"]["top_functions"])
+        stats.sort_stats("tottime").print_stats(config["profiling"]["top_functions"])
+        with open(f"{profile_name}.txt", 'w') as summary_writer:
+            summary_writer.write(summary.getvalue())
+        write_to_log(log_file, f"Profile: {profile_name}.prof", False, cur_log_file_path)
+    except Exception:
+        throw_exception(log_file, "", cur_log_file_path)
+    finally:
+        shutil.rmtree(profile_folder, ignore_errors=True)
+        profile_folder = None
+
+
+# Own time of every profiled function summed by where it went, largest first
+def get_profile_areas(stats):
+    areas = {"arcpy": 0.0, "portal and network": 0.0, "sleeping": 0.0, "waiting on workers and threads": 0.0,
+             "python": 0.0}
+    for (file_name, line_number, function_name), function_stats in stats.stats.items():
+        location = f"{file_name} {function_name}".lower()
+        if "arcpy" in location or "arcgisscripting" in location:
+            area = "arcpy"
+        elif any(name in location for name in ("arcgis", "socket", "ssl", "http", "select")):
+            area = "portal and network"
+        elif "sleep" in location:
+            area = "sleeping"
+        elif "acquire" in location or "wait" in location:
+            area = "waiting on workers and threads"
+        else:
+            area = "python"
+        areas[area] += function_stats[2]
+    return sorted(areas.items(), key=lambda area: area[1], reverse=True)
+
+
+# Pool task wrapper: while the worker was started for a profiled service, each task runs under the worker's
+# profiler and the worker's profile so far is written to the service's profile folder
+def profiled_task(task):
+    @functools.wraps(task)
+    def run_task(args):
+        if worker_profiler is None:
+            return task(args)
+        worker_profiler.enable()
+        try:
+            return task(args)
+        finally:
+            worker_profiler.disable()
+            worker_profiler.dump_stats(os.path.join(profile_folder, f"worker_{os.getpid()}.prof"))
+    return run_task
+
+
+# Write the retries made since the last call to the log and reset the counts
+def log_retry_stats(temp_log_file: str = None):
+    for policy_name in sorted(retry_stats):
+        retries, waited = retry_stats[policy_name]
+        write_to_log(log_file, f"Retries ({policy_name}): {retries}, {round(waited, 1)} seconds waiting.", False,
+                     temp_log_file)
+    retry_stats.clear()
+
+
+# Initiate global variables 
+def init_sources():
+    global log_file, list_path, month_day_year, data_path, log_path, local_data_path, local_path, \
+        target_folder_path, portal_name, folder_name_global, temp_folder, history_path, local_hisotry_path, \
+        layer_proc_count, cur_log_file_path, state_path, trace_run_id, trace_file, extract_store_path
+    
+    local_path = os.getcwd()
+    layer_proc_count = int(mp.cpu_count() / 2)
+    cur_log_file_path = None
+    month_day_year = f"{datetime.datetime.now().strftime('%m_%d_%Y')}"
+    
+    crash_file = f"{local_path}\\CRASH_{month_day_year}.txt"
+    if os.path.exists(crash_file):
+        os.remove(crash_file)
+    
+    try:
+        if debug is False:
+            target_folder_path = str(sys.argv[1])
+        else:
+            target_folder_path = "***************************"
+        
+        if target_folder_path is None or target_folder_path == "":
+            write_to_log(crash_file, "ERROR: No Target Folder Path.", True)
+            sys.exit()
+            
+        else:
+            # Settings are read before anything uses them
+            invalid_settings = read_settings()
+            if invalid_settings:
+                write_to_log(crash_file, f"ERROR: Invalid settings {', '.join(invalid_settings)}.", True)
+                sys.exit()
+
+            list_path = f"{target_folder_path}\\list"
+            data_path = f"{target_folder_path}\\data"
+            log_path = f"{target_folder_path}\\logs"
+            temp_folder = f"{target_folder_path}\\TO_DELETE"
+            history_path = f"{target_folder_path}\\data\\history"
+            state_path = f"{target_folder_path}\\state"
+            
+            if not os.path.exists(log_path):
+                os.mkdir(log_path)
+            log_file = f"{log_path}\\log_portal_update_{month_day_year}.txt"
+            trace_run_id = os.environ.get(trace_run_variable)
+            trace_file = f"{log_path}\\trace_{trace_run_id}.jsonl" if trace_run_id else None
+            if not os.path.exists(data_path):
+                os.mkdir(data_path)
+            if not os.path.exists(history_path):
+                os.mkdir(history_path)
+            if not os.path.exists(state_path):
+                os.mkdir(state_path)
+    
+            local_data_path = f"{local_path}\\data"
+            local_hisotry_path = f"{local_data_path}\\history"
+            extract_store_path = f"{local_path}\\extract_store"
+            split_path = target_folder_path.split("\\")
+            portal_name = split_path[-2]
+            folder_name_global = split_path[-1]
+            
+    except Exception:
+        throw_exception(crash_file)
+
+
+# Build stage of a Vector Tile Service: fingerprint the sources and build the package
+# Returns the result and the handoff for vector_tile_publish, None when there is nothing to publish
+def vector_tile_build(init_dict):
+    global cur_log_file_path
+    
+    try:
+        write_to_log(log_file, "Begin", True)
+        
+        # Get config arguments from .ini
+        service_name = init_dict['SERVICENAME']
+        service_id = init_dict['SERVICEID']
+        folder_name = init_dict['FOLDERNAME']
+        project_path = init_dict['APRX']
+        tags = init_dict['TAGS']
+        description = init_dict['DESCRIPTION']
+        copy_data = init_dict['COPYDATA']
+        editing = init_dict['EDITING']
+        exporting = init_dict['EXPORTING']
+        sync = init_dict['SYNC']
+        everyone = init_dict['EVERYONE']
+        org = init_dict['ORG']
+        groups = init_dict['GROUPS']
+        portal_url = init_dict['PORTALURL']
+        admin_user = init_dict['ADMINUSER']
+        admin_pass = init_dict['ADMINPASS']
+        max_cache = init_dict['MAXCACHE']
+        
+        # Set sharing options
+        shrOrg = True if org.upper() == 'TRUE' else False
+        shrEveryone = True if everyone.upper() == 'TRUE' else False
+        groups = None if groups.upper() == "NONE" else [group.strip() for group in groups.split(',')]
+        folder_name = None if folder_name.upper() == "NONE" else folder_name
+        copy_data = True if copy_data.upper() == 'TRUE' else False
+        editing = True if editing.upper() == "TRUE" else False
+        exporting = True if exporting.upper() == 'TRUE' else False
+        sync = True if sync.upper() == 'TRUE' else False
+
+        # Assign VTPK name
+        pckg_name = f"{service_name}_{month_day_year}"
+        pckg_name_vtpk = f"{pckg_name}.vtpk"
+        pckg_name_vtpk_path = os.path.join(local_data_path, pckg_name_vtpk)
+
+        # A resumed service keeps the package the interrupted run built, it may be named for the day before
+        packaged = resume_stage("packaged", lambda artifacts: file_intact(artifacts["package"]))
+        if packaged is not None:
+            pckg_name_vtpk_path = packaged["package"]["path"]
+            pckg_name_vtpk = os.path.basename(pckg_name_vtpk_path)
+            pckg_name = os.path.splitext(pckg_name_vtpk)[0]
+
+        # Skip the service when neither the project nor any source has changed since the last successful publish
+        fingerprints = None
+        prior_state = read_service_state(service_name) if rebuild_data else {}
+        project_hash = get_file_hash(project_path) if rebuild_data else None
+        if packaged is not None:
+            fingerprints = packaged["fingerprints"]
+        elif rebuild_data and config["services"]["incremental"]:
+            write_to_log(log_file, "Checking sources for changes", True, cur_log_file_path)
+            with trace_span("fingerprint"):
+                fingerprints, row_counts = fingerprint_project(project_path)
+            if is_unchanged(prior_state, fingerprints, project_hash):
+                # Carry the published package forward so the next incremental build can merge into it
+                carry_forward_package(prior_state.get("package"))
+                write_to_log(log_file, f"{service_name} project and sources unchanged since last publish, skipping.",
+                             True, cur_log_file_path)
+                return 0, None
+
+            # Invalidate the stored state until this rebuild is published
+            write_service_state(service_name, {"published": False, "layers": {}})
+
+        if rebuild_data and packaged is None:
+            # Delete vtpk if already exists
+            if os.path.exists(pckg_name_vtpk_path):
+                os.remove(pckg_name_vtpk_path)
+        
+        # Pull Map from project
+        prj = arcpy.mp.ArcGISProject(project_path)
+        mp = prj.listMaps()[0]
+        write_to_log(log_file, f"Source Project: {project_path}", False, cur_log_file_path)
+
+        # Create VTPK from Map
+        write_to_log(log_file, f"Creating {pckg_name_vtpk}", True)
+        sp_tiling_scheme = os.path.join(local_path, "tiling_scheme_SP.xml")
+        max_cached_scale = int(max_cache)
+        full_build = month_day_year
+        if packaged is not None:
+            project_hash = packaged["project"]
+            full_build = packaged["full_build"]
+        elif rebuild_data:
+            incremental_built = False
+            if config["vector_tiles"]["incremental"]:
+                try:
+                    write_to_log(log_file, "Comparing features with the last package", True, cur_log_file_path)
+                    with trace_span("tile_scan"):
+                        changed_extents = scan_tile_changes(mp, service_name, fingerprints, prior_state)
+                    with trace_span("package", build="incremental") as span:
+                        incremental_built = build_incremental_vtpk(mp, service_name, prior_state, changed_extents,
+                                                                   project_hash, pckg_name_vtpk_path,
+                                                                   sp_tiling_scheme, max_cached_scale, description,
+                                                                   tags)
+                        span["built"] = bool(incremental_built)
+                except Exception:
+                    throw_exception(log_file, "", cur_log_file_path)
+                    incremental_built = False
+            if incremental_built:
+                full_build = prior_state["full_build"]
+            else:
+                write_to_log(log_file, "Building full package", True, cur_log_file_path)
+                if os.path.exists(pckg_name_vtpk_path):
+                    os.remove(pckg_name_vtpk_path)
+                with trace_span("package", build="full"):
+                    build_full_vtpk(mp, project_path, pckg_name_vtpk_path, sp_tiling_scheme, max_cached_scale,
+                                    description, tags)
+            checkpoint("packaged", {"package": get_file_artifact(pckg_name_vtpk_path), "fingerprints": fingerprints,
+                                    "project": project_hash, "full_build": full_build})
+
+        # Close connection to Project
+        del prj
+
+        return 0, {"package": pckg_name_vtpk_path, "fingerprints": fingerprints, "project": project_hash,
+                   "full_build": full_build}
+
+    except Exception:
+        throw_exception(log_file, "", cur_log_file_path)
+        return 1, None
+
+
+# Publish stage of a Vector Tile Service: upload the package built by vector_tile_build, publish it, update its
+# style and sharing and record the published state
+def vector_tile_publish(init_dict, handoff: dict):
+    try:
+        service_name = init_dict['SERVICENAME']
+        folder_name = init_dict['FOLDERNAME']
+        tags = init_dict['TAGS']
+        description = init_dict['DESCRIPTION']
+        everyone = init_dict['EVERYONE']
+        org = init_dict['ORG']
+        groups = init_dict['GROUPS']
+        portal_url = init_dict['PORTALURL']
+        admin_user = init_dict['ADMINUSER']
+        admin_pass = init_dict['ADMINPASS']
+
+        # Set sharing options
+        shrOrg = True if org.upper() == 'TRUE' else False
+        shrEveryone = True if everyone.upper() == 'TRUE' else False
+        groups = None if groups.upper() == "NONE" else [group.strip() for group in groups.split(',')]
+        folder_name = None if folder_name.upper() == "NONE" else folder_name
+
+        # Package handed off by the build stage
+        pckg_name_vtpk_path = handoff["package"]
+        pckg_name_vtpk = os.path.basename(pckg_name_vtpk_path)
+        pckg_name = os.path.splitext(pckg_name_vtpk)[0]
+        temp_name = f"temp_{service_name[:12]}"
+        fingerprints = handoff["fingerprints"]
+        project_hash = handoff["project"]
+        full_build = handoff["full_build"]
+        target_portal = get_target_portal(portal_url)
+
+        # Login to ArcGIS Portal
+        session = get_portal_session(target_portal, admin_user, admin_pass)
+        gis = session["gis"]
+        write_to_log(log_file, f"Active Portal: {gis.url}", True, cur_log_file_path)
+
+        uploaded = resume_stage("uploaded",
+                                lambda artifacts: find_item_by_id(gis, admin_user, artifacts["item"]) is not None)
+        if uploaded is not None:
+            vtpk = find_item_by_id(gis, admin_user, uploaded["item"])
+        else:
+            # Delete VTPK if exists in Portal
+            write_to_log(log_file, "Clear Service Namespace", True, cur_log_file_path)
+
+            # Delete Temp package if exists
+            for temp_vtpk in find_items(gis, admin_user, temp_name, "Vector Tile Package"):
+                retry_call("portal", temp_vtpk.delete)
+                remove_inventory_item(gis, admin_user, temp_vtpk)
+            # Delete Temp Service if exists
+            for temp_serv in find_items(gis, admin_user, temp_name, "Vector Tile Service"):
+                retry_call("portal", temp_serv.delete)
+                remove_inventory_item(gis, admin_user, temp_serv)
+            for old_vtpk in find_items(gis, admin_user, pckg_name, "Vector Tile Package"):
+                retry_call("portal", old_vtpk.delete)
+                remove_inventory_item(gis, admin_user, old_vtpk)
+            for old_serv in find_items(gis, admin_user, pckg_name, "Vector Tile Service"):
+                retry_call("portal", old_serv.delete)
+                remove_inventory_item(gis, admin_user, old_serv)
+
+            # Add VTPK to Portal
+            write_to_log(log_file, "Staging Vector Tile into Portal", True, cur_log_file_path)
+            vtpk = upload_item(session, admin_user, pckg_name_vtpk_path,
+                               {'type': "Vector Tile Package", "description": description, "tags": tags},
+                               folder_name)
+            add_inventory_item(gis, admin_user, vtpk)
+            checkpoint("uploaded", {"item": vtpk.id})
+
+        # Publish New Service
+        published = resume_stage("published",
+                                 lambda artifacts: find_item_by_id(gis, admin_user, artifacts["item"]) is not None)
+        if published is not None:
+            final_service = find_item_by_id(gis, admin_user, published["item"])
+        else:
+            write_to_log(log_file, "Creating New Service", True, cur_log_file_path)
+            with trace_span("publish"):
+                final_service = retry_call("publish", vtpk.publish)
+            add_inventory_item(gis, admin_user, final_service)
+            checkpoint("published", {"item": final_service.id})
+
+        write_to_log(log_file, f"Tile Service: {final_service.homepage}.", False, cur_log_file_path)
+
+        # Update Style File
+        if resume_stage("styled", lambda artifacts: True) is None:
+            with trace_span("style_update"):
+                update_style_file(service_name, admin_user, gis, pckg_name, pckg_name_vtpk_path, portal_url,
+                                  final_service)
+            checkpoint("styled", {})
+
+        # Update Sharing Settings
+        if resume_stage("shared", lambda artifacts: True) is None:
+            with trace_span("share"):
+                retry_call("portal", final_service.share, org=shrOrg, everyone=shrEveryone, groups=groups)
+            checkpoint("shared", {})
+
+        # Record the published sources and package for the next incremental run
+        if rebuild_data:
+            commit_tile_snapshot(service_name)
+            layer_states = {}
+            for layer_key in (fingerprints or {}):
+                layer_states[layer_key] = {"fingerprint": fingerprints[layer_key]}
+            write_service_state(service_name, {"published": fingerprints is not None, "layers": layer_states,
+                                               "package": pckg_name_vtpk, "project": project_hash,
+                                               "full_build": full_build})
+
+        return 0
+    
+    except Exception:
+        throw_exception(log_file, "", cur_log_file_path)
+        return 1
+        
+
+# Update style file service
+def update_style_file(usf_service_name: str, usf_admin_user: str, usf_gis, usf_pckg_name: str,
+                      usf_pckg_name_vtpk_path: str, usf_portal_url: str, usf_final_service):
+    style_service_name = f"{usf_service_name}_Style"
+    style_service = None
+    for service in find_items(usf_gis, usf_admin_user, style_service_name, "Vector Tile Service"):
+        style_service = service
+
+    # Remove the extracted package folder left by earlier runs
+    style_folder = f"{local_data_path}\\{usf_pckg_name}"
+    if os.path.exists(style_folder):
+        shutil.rmtree(style_folder)
+
+    # Read the Style File straight out of the package, nothing else is extracted
+    with zipfile.ZipFile(usf_pckg_name_vtpk_path, 'r') as vtpk_zip:
+        with vtpk_zip.open(vtpk_style_member) as style_file_edits:
+            data = json.loads(style_file_edits.read().decode("utf-8"))
+
+    # Only the edited Style File is written to disk, for the upload
+    style_file_path = f"{local_data_path}\\{usf_pckg_name}_root.json"
+
+    # Edit paths in style file
+    if "arcgis" in usf_portal_url:
+        style_target_portal = f"https://tiles.arcgis.com/tiles/{agol_id}/arcgis/rest/services/"
+    else:
+        style_target_portal = f"https://{usf_portal_url}/server/rest/services/Hosted/"
+    service_path = style_target_portal + usf_pckg_name
+
+    # Write changes to Style File
+    data["sprite"] = f"{service_path}/VectorTileServer/resources/styles/../sprites/sprite"
+    data["glyphs"] = service_path + "/VectorTileServer/resources/styles/../fonts/{fontstack}/{range}.pbf"
+    data["sources"]["esri"]["url"] = f"{service_path}/VectorTileServer"
+    with open(style_file_path, "w") as style_file_edits:
+        json.dump(data, style_file_edits)
+
+    # Update Style File in final_service
+    if not style_service:
+        style_service = usf_final_service.copy(style_service_name)
+        add_inventory_item(usf_gis, usf_admin_user, style_service)
+    try:
+        style_service.resources.add(file=style_file_path, folder_name="styles", file_name="root.json")
+    except:
+        style_service.resources.update(file=style_file_path, folder_name="styles", file_name="root.json")
+    os.remove(style_file_path)
+
+    write_to_log(log_file, f"Style Service: {style_service.homepage}.", True, cur_log_file_path)
+
+
+# Copy the last published package from History back into the local data folder
+def carry_forward_package(package_name: str):
+    if not package_name:
+        return
+    history_package = os.path.join(local_hisotry_path, package_name)
+    if os.path.exists(history_package) and not os.path.exists(os.path.join(local_data_path, package_name)):
+        shutil.copy2(history_package, local_data_path)
+
+
+# Copy a feature service's last outputs from History back into the local data folder: its extract GDBs, project
+# and Service Definitions, so a skipped service keeps them on the network drive, in History and for reuse
+def carry_forward_service(service_name: str):
+    if not os.path.exists(local_hisotry_path):
+        return
+    for name in get_service_outputs(local_hisotry_path, service_name):
+        history_output = os.path.join(local_hisotry_path, name)
+        local_output = os.path.join(local_data_path, name)
+        if os.path.exists(local_output):
+            continue
+        if os.path.isdir(history_output):
+            shutil.copytree(history_output, local_output)
+        else:
+            shutil.copy2(history_output, local_output)
+
+
+# Top level names of a service's outputs in a data folder: its extract GDBs folder, project, Service Definitions
+# and packages
+def get_service_outputs(folder_path: str, service_name: str):
+    if not os.path.exists(folder_path):
+        return []
+    output_pattern = re.compile(rf"^{re.escape(service_name)}(_data|\.aprx|_\d{{2}}_\d{{2}}_\d{{4}}\.(sd|vtpk))$",
+                                re.IGNORECASE)
+    return [name for name in os.listdir(folder_path) if output_pattern.match(name)]
+
+
+# Path of the feature snapshot taken when a service's last package was built
+def get_tile_snapshot_path(service_name: str):
+    return os.path.join(state_path, f"{service_name}_tiles.sqlite")
+
+
+# Compare every feature in the map with the snapshot taken for the last package and write a new snapshot
+# Returns the extents of added, changed and deleted features, or None when there is no snapshot to compare with
+def scan_tile_changes(prj_map, service_name: str, fingerprints: dict, prior_state: dict):
+    snapshot_path = get_tile_snapshot_path(service_name)
+    new_snapshot_path = f"{snapshot_path}.new"
+    if os.path.exists(new_snapshot_path):
+        os.remove(new_snapshot_path)
+    prior_layers = prior_state.get("layers", {})
+    changed_extents = []
+    seen_layers = []
+    scanned = False
+    insert_sql = "INSERT INTO features VALUES (?, ?, ?, ?, ?, ?, ?)"
+    new_db = sqlite3.connect(new_snapshot_path)
+    prior_db = sqlite3.connect(snapshot_path) if os.path.exists(snapshot_path) else None
+    try:
+        new_db.execute("CREATE TABLE features (layer TEXT, oid INTEGER, hash TEXT, xmin REAL, ymin REAL, xmax REAL, "
+                       "ymax REAL, PRIMARY KEY (layer, oid))")
+        for lyr in prj_map.listLayers():
+            if not lyr.isFeatureLayer:
+                continue
+            layer_key = lyr.longName
+            seen_layers.append(layer_key)
+            prior_rows = {}
+            if prior_db:
+                for row in prior_db.execute("SELECT oid, hash, xmin, ymin, xmax, ymax FROM features WHERE layer = ?",
+                                            (layer_key,)):
+                    prior_rows[row[0]] = row[1:]
+
+            # Layers whose sources are unchanged keep their snapshot
+            if prior_rows and fingerprints and layer_key in fingerprints and \
+                    prior_layers.get(layer_key, {}).get("fingerprint") == fingerprints[layer_key]:
+                new_db.executemany(insert_sql, [(layer_key, oid) + values for oid, values in prior_rows.items()])
+                continue
+
+            # Hash each feature's attributes and shape in the map's coordinate system
+            fields = [field.name for field in arcpy.ListFields(lyr)
+                      if field.type not in ("OID", "Geometry", "Blob", "Raster")]
+            new_rows = []
+            with arcpy.da.SearchCursor(lyr, ["OID@", "SHAPE@"] + fields,
+                                       spatial_reference=prj_map.spatialReference) as cursor:
+                for row in cursor:
+                    shape = row[1]
+                    row_hash = hashlib.sha1(repr(row[2:]).encode("utf-8"))
+                    extent = (None, None, None, None)
+                    if shape is not None:
+                        row_hash.update(shape.WKB)
+                        extent = (shape.extent.XMin, shape.extent.YMin, shape.extent.XMax, shape.extent.YMax)
+                    new_rows.append((layer_key, row[0], row_hash.hexdigest()) + extent)
+                    prior_row = prior_rows.pop(row[0], None)
+                    if prior_row is None or prior_row[0] != new_rows[-1][2]:
+                        changed_extents.append(extent)
+                        if prior_row is not None:
+                            changed_extents.append(prior_row[1:])
+                    if len(new_rows) >= 10000:
+                        new_db.executemany(insert_sql, new_rows)
+                        new_rows = []
+            new_db.executemany(insert_sql, new_rows)
+
+            # Features left in the snapshot have been deleted
+            changed_extents.extend(values[1:] for values in prior_rows.values())
+
+        # Features of layers removed from the map
+        if prior_db:
+            removed_sql = "SELECT xmin, ymin, xmax, ymax FROM features WHERE layer NOT IN ({})".format(
+                ", ".join("?" * len(seen_layers)))
+            changed_extents.extend(prior_db.execute(removed_sql, seen_layers).fetchall())
+        new_db.commit()
+        scanned = True
+    finally:
+        new_db.close()
+        if prior_db:
+            prior_db.close()
+        if not scanned and os.path.exists(new_snapshot_path):
+            os.remove(new_snapshot_path)
+
+    if prior_db is None:
+        return None
+    return [extent for extent in changed_extents if extent[0] is not None]
+
+
+# Keep the snapshot of the package that was just published for the next run
+def commit_tile_snapshot(service_name: str):
+    snapshot_path = get_tile_snapshot_path(service_name)
+    if os.path.exists(f"{snapshot_path}.new"):
+        os.replace(f"{snapshot_path}.new", snapshot_path)
+
+
+# Build a package of one level of detail covering only the given tiles
+def build_partial_vtpk(prj_map, tiling_scheme: dict, tiling_scheme_path: str, level: int, tiles: set,
+                       partial_path: str, description: str, tags: str):
+    scale, resolution = [(lod[1], lod[2]) for lod in tiling_scheme["lods"] if lod[0] == level][0]
+    tile_width = resolution * tiling_scheme["cols"]
+    tile_height = resolution * tiling_scheme["rows"]
+    origin_x, origin_y = tiling_scheme["origin"]
+    rows = [tile[0] for tile in tiles]
+    cols = [tile[1] for tile in tiles]
+
+    # Whole tiles are in the extent so their features are not cut at the edge
+    arcpy.env.extent = arcpy.Extent(origin_x + min(cols) * tile_width, origin_y - (max(rows) + 1) * tile_height,
+                                    origin_x + (max(cols) + 1) * tile_width, origin_y - min(rows) * tile_height)
+    try:
+        retry_call("geoprocessing", arcpy.CreateVectorTilePackage_management,
+                   in_map=prj_map,
+                   output_file=partial_path,
+                   service_type="EXISTING",
+                   tiling_scheme=tiling_scheme_path,
+                   min_cached_scale=scale,
+                   max_cached_scale=scale,
+                   tile_structure='INDEXED',
+                   summary=description,
+                   tags=tags)
+    finally:
+        arcpy.ClearEnvironment("extent")
+
+
+# Build today's package from the last one, regenerating only the tiles touched by changed features
+# Returns False when a full build is needed: too many bundles changed, or a changed tile is missing from the last
+# package or now empty, so its tile map would no longer be valid
+def build_incremental_vtpk(prj_map, service_name: str, prior_state: dict, changed_extents: list, project_hash: str,
+                           vtpk_path: str, tiling_scheme_path: str, max_cached_scale: int, description: str,
+                           tags: str):
+    prior_package = prior_state.get("package")
+    prior_vtpk_path = os.path.join(local_hisotry_path, prior_package) if prior_package else None
+    if changed_extents is None or not prior_vtpk_path or not os.path.exists(prior_vtpk_path):
+        write_to_log(log_file, "No earlier package and snapshot to merge into", True, cur_log_file_path)
+        return False
+    if prior_state.get("project") != project_hash:
+        write_to_log(log_file, "Project changed since the last package", True, cur_log_file_path)
+        return False
+    try:
+        full_build_date = datetime.datetime.strptime(prior_state["full_build"], "%m_%d_%Y")
+    except (KeyError, ValueError):
+        return False
+    if (datetime.datetime.now() - full_build_date).days >= config["vector_tiles"]["full_rebuild_days"]:
+        write_to_log(log_file, f"Last full build on {prior_state['full_build']}", True, cur_log_file_path)
+        return False
+
+    tiling_scheme = read_tiling_scheme(tiling_scheme_path)
+    changed_tiles = get_changed_tiles(changed_extents, tiling_scheme, max_cached_scale,
+                                      config["vector_tiles"]["tile_buffer"],
+                                      config["vector_tiles"]["incremental_max_tiles"])
+    if changed_tiles is None:
+        write_to_log(log_file, f"More than {config['vector_tiles']['incremental_max_tiles']} tiles changed", True,
+                     cur_log_file_path)
+        return False
+    write_to_log(log_file, f"{len(changed_extents)} feature changes touch "
+                           f"{sum(len(tiles) for tiles in changed_tiles.values())} tiles in {len(changed_tiles)} "
+                           f"bundles", True, cur_log_file_path)
+    if len(changed_tiles) > config["vector_tiles"]["incremental_max_bundles"]:
+        write_to_log(log_file, f"More than {config['vector_tiles']['incremental_max_bundles']} bundles changed", True,
+                     cur_log_file_path)
+        return False
+
+    partial_folder = f"{vtpk_path}_tiles"
+    merged_path = f"{vtpk_path}.partial"
+    if os.path.exists(partial_folder):
+        shutil.rmtree(partial_folder)
+    os.makedirs(partial_folder)
+    replaced_tiles = 0
+    try:
+        with zipfile.ZipFile(prior_vtpk_path, "r") as prior_zip:
+            prior_bundles = list_package_bundles(prior_zip)
+            replaced_bundles = {}
+            for bundle_key in sorted(changed_tiles):
+                level, bundle_row, bundle_col = bundle_key
+                prior_bundle = prior_zip.read(prior_bundles[bundle_key]) if bundle_key in prior_bundles else None
+                tiles = read_bundle_tiles(prior_bundle) if prior_bundle else {}
+                positions = {(row - bundle_row) * vtpk_bundle_dim + (col - bundle_col): (row, col)
+                             for row, col in changed_tiles[bundle_key]}
+
+                # Regenerate the tiles and swap them into the bundle
+                partial_path = os.path.join(partial_folder, f"L{level:02d}R{bundle_row:04x}C{bundle_col:04x}.vtpk")
+                build_partial_vtpk(prj_map, tiling_scheme, tiling_scheme_path, level, set(positions.values()),
+                                   partial_path, description, tags)
+                with zipfile.ZipFile(partial_path, "r") as partial_zip:
+                    partial_bundles = list_package_bundles(partial_zip)
+                    new_tiles = {}
+                    if bundle_key in partial_bundles:
+                        new_tiles = read_bundle_tiles(partial_zip.read(partial_bundles[bundle_key]))
+                os.remove(partial_path)
+
+                # A tile the last package does not have would also need adding to its tile map, and a tile that
+                # is now empty removing from it
+                added = [position for position in positions if position in new_tiles and position not in tiles]
+                if added:
+                    write_to_log(log_file, f"{len(added)} new tiles at level {level}, not in the last package's tile "
+                                           f"map", True, cur_log_file_path)
+                    return False
+                emptied = [position for position in positions if position in tiles and position not in new_tiles]
+                if emptied:
+                    write_to_log(log_file, f"{len(emptied)} tiles at level {level} are now empty, still in the last "
+                                           f"package's tile map", True, cur_log_file_path)
+                    return False
+                positions = [position for position in positions if position in tiles]
+                if not positions:
+                    continue
+                for position in positions:
+                    tiles[position] = new_tiles[position]
+                    replaced_tiles += 1
+
+                bundle_bytes = write_bundle(prior_bundle, tiles)
+                if read_bundle_tiles(bundle_bytes) != tiles:
+                    raise ValueError(f"Merged bundle {prior_bundles[bundle_key]} does not read back")
+                bundle_path = f"{partial_path}.bundle"
+                with open(bundle_path, "wb") as bundle_file:
+                    bundle_file.write(bundle_bytes)
+                replaced_bundles[prior_bundles[bundle_key]] = bundle_path
+
+            # Copy the last package with the merged bundles swapped in
+            with zipfile.ZipFile(merged_path, "w", allowZip64=True) as merged_zip:
+                for info in prior_zip.infolist():
+                    if info.is_dir():
+                        merged_zip.writestr(info, b"")
+                        continue
+                    bundle_path = replaced_bundles.get(info.filename)
+                    if bundle_path:
+                        info.file_size = os.path.getsize(bundle_path)
+                    with (open(bundle_path, "rb") if bundle_path else prior_zip.open(info)) as member_reader, \
+                            merged_zip.open(info, "w", force_zip64=info.file_size > 0x7FFFFFFF) as member_writer:
+                        shutil.copyfileobj(member_reader, member_writer, 1048576)
+        os.replace(merged_path, vtpk_path)
+    finally:
+        shutil.rmtree(partial_folder, ignore_errors=True)
+        if os.path.exists(merged_path):
+            os.remove(merged_path)
+
+    write_to_log(log_file, f"Merged {replaced_tiles} tiles into {prior_package}", True, cur_log_file_path)
+    return True
+
+
+# Build a full package, in extent strips built at the same time when the map is large enough
+def build_full_vtpk(prj_map, project_path: str, vtpk_path: str, tiling_scheme_path: str, max_cached_scale: int,
+                    description: str, tags: str):
+    if config["vector_tiles"]["shards"] > 1 and layer_proc_count > 1:
+        try:
+            if build_sharded_vtpk(prj_map, project_path, vtpk_path, tiling_scheme_path, max_cached_scale,
+                                  description, tags):
+                if not config["vector_tiles"]["verify_shards"]:
+                    return
+                sharded_path = f"{vtpk_path}.sharded"
+                os.replace(vtpk_path, sharded_path)
+        except Exception:
+            throw_exception(log_file, "", cur_log_file_path)
+            if os.path.exists(vtpk_path):
+                os.remove(vtpk_path)
+
+    write_to_log(log_file, "Building package in one call", True, cur_log_file_path)
+    retry_call("geoprocessing", arcpy.CreateVectorTilePackage_management,
+               in_map=prj_map,
+               output_file=vtpk_path,
+               service_type="EXISTING",
+               tiling_scheme=tiling_scheme_path,
+               max_cached_scale=max_cached_scale,
+               tile_structure='INDEXED',
+               summary=description,
+               tags=tags)
+
+    # The one call package is published, the sharded one is only compared with it
+    sharded_path = f"{vtpk_path}.sharded"
+    if os.path.exists(sharded_path):
+        differences = count_tile_differences(vtpk_path, sharded_path)
+        map_differences = count_tile_map_differences(vtpk_path, sharded_path)
+        write_to_log(log_file, f"Sharded package differs from the one call package in {differences} tiles and "
+                               f"{map_differences} tile map nodes", True, cur_log_file_path)
+        os.remove(sharded_path)
+
+
+# Build a package as extent strips in a process pool and merge them
+# Every shard uses the same tile index so tiles are cut where a one call build would cut them; returns False when
+# the map is too small to split
+def build_sharded_vtpk(prj_map, project_path: str, vtpk_path: str, tiling_scheme_path: str, max_cached_scale: int,
+                       description: str, tags: str):
+    tiling_scheme = read_tiling_scheme(tiling_scheme_path)
+    lods = sorted(lod for lod in tiling_scheme["lods"] if lod[1] >= max_cached_scale / 1.5)
+    shard_folder = f"{vtpk_path}_shards"
+    if os.path.exists(shard_folder):
+        shutil.rmtree(shard_folder)
+    os.makedirs(shard_folder)
+    try:
+        write_to_log(log_file, "Building tile index", True, cur_log_file_path)
+        arcpy.CreateFileGDB_management(shard_folder, "index.gdb")
+        index_polygons = os.path.join(shard_folder, "index.gdb", "tile_index")
+        retry_call("geoprocessing", arcpy.CreateVectorTileIndex_management,
+                   in_map=prj_map,
+                   out_featureclass=index_polygons,
+                   service_type="EXISTING",
+                   tiling_scheme=tiling_scheme_path)
+
+        shards = get_vtpk_shards(arcpy.Describe(index_polygons).extent, tiling_scheme, lods,
+                                 config["vector_tiles"]["shards"])
+        if not shards:
+            write_to_log(log_file, f"Map is too small for {config['vector_tiles']['shards']} shards", True,
+                         cur_log_file_path)
+            return False
+        split_level, strips = shards
+
+        # Each strip holds every level, its coarse tiles are cut at the strip edge so they come from a seam build
+        split_resolution = [lod[2] for lod in lods if lod[0] == split_level][0]
+        tile_width = split_resolution * tiling_scheme["cols"]
+        tile_height = split_resolution * tiling_scheme["rows"]
+        origin_x, origin_y = tiling_scheme["origin"]
+        shard_args = []
+        for shard_number, (first_col, end_col, first_row, end_row) in enumerate(strips):
+            shard_extent = (origin_x + (first_col - config["vector_tiles"]["tile_buffer"]) * tile_width,
+                            origin_y - (end_row + config["vector_tiles"]["tile_buffer"]) * tile_height,
+                            origin_x + (end_col + config["vector_tiles"]["tile_buffer"]) * tile_width,
+                            origin_y - (first_row - config["vector_tiles"]["tile_buffer"]) * tile_height)
+            shard_path = os.path.join(shard_folder, f"shard_{shard_number}.vtpk")
+            shard_args.append((project_path, tiling_scheme_path, shard_path, shard_extent, max_cached_scale,
+                               index_polygons, description, tags))
+        seam_path = None
+        coarse_lods = [lod for lod in lods if lod[0] < split_level]
+        if coarse_lods:
+            seam_path = os.path.join(shard_folder, "seam.vtpk")
+            shard_args.append((project_path, tiling_scheme_path, seam_path, None, coarse_lods[-1][1], index_polygons,
+                               description, tags))
+
+        write_to_log(log_file, f"Building {len(strips)} shards split at level {split_level}", True, cur_log_file_path)
+        for shard_path, shard_seconds in map_tasks(build_vtpk_shard, shard_args):
+            write_to_log(log_file, f"Built {os.path.basename(shard_path)} in {round(shard_seconds, 1)} seconds", False,
+                         cur_log_file_path)
+
+        merge_vtpk_shards(vtpk_path, [args[2] for args in shard_args[:len(strips)]], strips, split_level, seam_path,
+                          lods)
+        return True
+    finally:
+        shutil.rmtree(shard_folder, ignore_errors=True)
+
+
+# Build one shard of a package in a pool worker, returns (shard package, seconds)
+@profiled_task
+def build_vtpk_shard(args):
+    project_path, tiling_scheme_path, shard_path, shard_extent, max_scale, index_polygons, description, tags = args
+    start_time = time.monotonic()
+    prj = get_worker_project(project_path)
+    if shard_extent:
+        arcpy.env.extent = arcpy.Extent(*shard_extent)
+    try:
+        with trace_span("package_shard", shard=os.path.basename(shard_path)):
+            retry_call("geoprocessing", arcpy.CreateVectorTilePackage_management,
+                       in_map=prj.listMaps()[0],
+                       output_file=shard_path,
+                       service_type="EXISTING",
+                       tiling_scheme=tiling_scheme_path,
+                       max_cached_scale=max_scale,
+                       tile_structure='INDEXED',
+                       index_polygons=index_polygons,
+                       summary=description,
+                       tags=tags)
+    finally:
+        arcpy.ClearEnvironment("extent")
+        del prj
+    return shard_path, time.monotonic() - start_time
+
+
+# Build stage of a Hosted Feature Service: extract the layers, repoint the project and stage the Service Definition
+# Returns the result and the handoff for hosted_feature_publish, None when there is nothing to publish
+def hosted_feature_build(init_dict):
+    try:
+        final_result = 0
+        service_name = init_dict['SERVICENAME']
+        service_id = init_dict['SERVICEID']
+        folder_name = init_dict['FOLDERNAME']
+        project_path = init_dict['APRX']
+        tags = init_dict['TAGS']
+        description = init_dict['DESCRIPTION']
+        copy_data = init_dict['COPYDATA']
+        editing = init_dict['EDITING']
+        exporting = init_dict['EXPORTING']
+        sync = init_dict['SYNC']
+        everyone = init_dict['EVERYONE']
+        org = init_dict['ORG']
+        groups = init_dict['GROUPS']
+        portal_url = init_dict['PORTALURL']
+        admin_user = init_dict['ADMINUSER']
+        admin_pass = init_dict['ADMINPASS']
+        
+        # Set sharing options
+        shrOrg = True if org.upper() == 'TRUE' else False
+        shrEveryone = True if everyone.upper() == 'TRUE' else False
+        groups = None if groups.upper() == "NONE" else [group.strip() for group in groups.split(',')]
+        folder_name = None if folder_name.upper() == "NONE" else folder_name
+        copy_data = True if copy_data.upper() == 'TRUE' else False
+        editing = True if editing.upper() == "TRUE" else False
+        exporting = True if exporting.upper() == 'TRUE' else False
+        sync = True if sync.upper() == 'TRUE' else False
+        
+        # Declare paths
+        # Set up Portal connection
+        target_portal = get_target_portal(portal_url)
+        aprx_name = f"{service_name}.aprx"
+        gdb_dir = os.path.join(local_data_path, f"{service_name}_data")
+        aprx_path = os.path.join(local_data_path, aprx_name)
+
+        # A resumed service keeps the extracts of the interrupted run, and the fingerprints they were taken at
+        extracted = resume_stage("extracted", extracts_intact)
+        keep_fields = get_keep_fields(init_dict)
+
+        # Skip the service when neither the project nor any source has changed since the last successful publish
+        fingerprints = None
+        row_counts = {}
+        reuse_sources = {}
+        prior_state = read_service_state(service_name) if rebuild_data else {}
+        project_hash = get_file_hash(project_path) if rebuild_data else None
+        if extracted is not None:
+            fingerprints = extracted["fingerprints"]
+            project_hash = extracted["project"]
+        elif rebuild_data and config["services"]["incremental"]:
+            write_to_log(log_file, "Checking sources for changes", True, cur_log_file_path)
+            with trace_span("fingerprint"):
+                fingerprints, row_counts = fingerprint_project(project_path, keep_fields)
+            if is_unchanged(prior_state, fingerprints, project_hash):
+                # Carry the published outputs forward so the next run can reuse them and History keeps them
+                carry_forward_service(service_name)
+                write_to_log(log_file, f"{service_name} project and sources unchanged since last publish, skipping.",
+                             True, cur_log_file_path)
+                return 0, None
+
+            # Unchanged layers are copied from the previous extract instead of SDE
+            if prior_state.get("published"):
+                prior_gdb_dir = os.path.join(local_hisotry_path, f"{service_name}_data")
+                for layer_key, layer_state in prior_state.get("layers", {}).items():
+                    if fingerprints.get(layer_key) == layer_state["fingerprint"]:
+                        reuse_sources[layer_key] = os.path.join(prior_gdb_dir, layer_state["gdb"],
+                                                                layer_state["dataset"])
+            write_to_log(log_file, f"{len(reuse_sources)} of {len(fingerprints)} layers unchanged", False,
+                         cur_log_file_path)
+
+            # Invalidate the stored state until this rebuild is published
+            write_service_state(service_name, {"published": False, "layers": {}})
+
+        if rebuild_data and extracted is None:
+            # Delete old data
+            if os.path.exists(gdb_dir):
+                shutil.rmtree(gdb_dir)
+            os.makedirs(gdb_dir)
+        
+        write_to_log(log_file, "BEGIN", True, cur_log_file_path)
+
+        # Records of the extracted layers, returned by the extraction workers
+        layer_manifests = []
+        
+        write_to_log(log_file, f"Source Project: {project_path}", False, cur_log_file_path)
+
+        repointed = None
+        if rebuild_data and extracted is not None:
+            layer_manifests = [LayerManifest(**layer) for layer in extracted["layers"]]
+            repointed = resume_stage("repointed", lambda artifacts: file_intact(artifacts["project"]))
+
+        if rebuild_data and repointed is None:
+            # Delete/Copy Local Project for refresh
+            if os.path.exists(aprx_path):
+                os.remove(aprx_path)
+            shutil.copy(project_path, aprx_path)
+
+        if rebuild_data and extracted is None:
+            # Estimate each layer's extraction cost from its last extraction time, or else its row count
+            layer_costs = {}
+            for layer_key, row_count in row_counts.items():
+                layer_costs[layer_key] = row_count / config["extract"]["rows_per_second"]
+            for layer_key, layer_state in prior_state.get("layers", {}).items():
+                if layer_state.get("seconds") is not None:
+                    layer_costs[layer_key] = layer_state["seconds"]
+
+            # Most expensive layers first, idle workers take the next layer from the pool's task queue
+            extract_tasks, extract_aliases = get_extract_tasks(aprx_path, layer_costs, reuse_sources, log_file,
+                                                               keep_fields)
+            write_extract_keys(service_name, project_hash, keep_fields, extract_tasks)
+            extract_args = [(task, service_name, log_file, local_data_path, cur_log_file_path)
+                            for task in extract_tasks]
+            extract_start = time.monotonic()
+
+            if pool_task_queue is not None:
+                write_to_log(log_file, "Preprocessing layers on the worker pool", False)
+
+            # Get Create copies of all feature classes into local GDBs
+            layer_manifests = map_tasks(save_to_gdb_aprx, extract_args)
+            log_worker_utilization(layer_manifests, time.monotonic() - extract_start, layer_proc_count)
+            layer_manifests += get_alias_manifests(layer_manifests, extract_aliases)
+
+            for manifest in layer_manifests:
+                if manifest.result == 1:
+                    final_result = 1
+
+            # The pool compacts and indexes each worker's GDB
+            if config["extract"]["optimize"] and final_result == 0:
+                write_to_log(log_file, "Optimizing extract GDBs", True, cur_log_file_path)
+                optimize_args = get_optimize_tasks(layer_manifests, extract_tasks, get_delta_keys(init_dict),
+                                                   log_file, cur_log_file_path)
+                with trace_span("optimize", gdbs=len(optimize_args)) as span:
+                    optimize_results = map_tasks(optimize_gdb, optimize_args)
+                    span["bytes_before"] = sum(gdb_result[1] for gdb_result in optimize_results)
+                    span["bytes_after"] = sum(gdb_result[2] for gdb_result in optimize_results)
+                write_to_log(log_file, f"Extract GDBs optimized from {round(span['bytes_before'] / 1048576, 1)} MB "
+                                       f"to {round(span['bytes_after'] / 1048576, 1)} MB", True, cur_log_file_path)
+
+            # Only a complete extraction is kept for a resume
+            if final_result == 0:
+                checkpoint("extracted", {"fingerprints": fingerprints, "project": project_hash,
+                                         "layers": [get_manifest_record(manifest) for manifest in layer_manifests]})
+
+        if rebuild_data and repointed is None:
+            write_to_log(log_file, f"Making Changes to: {aprx_path}", True)
+
+            # Update all layers in Project to point to local GDBs
+            with trace_span("repoint", layers=len(layer_manifests)):
+                if update_project(layer_manifests, aprx_path, log_file, cur_log_file_path) == 1:
+                    final_result = 1
+            if final_result == 0:
+                checkpoint("repointed", {"project": get_file_artifact(aprx_path)})
+
+        write_to_log(log_file, "Publishing Project to Portal", True, cur_log_file_path)
+        write_to_log(log_file, f"Connecting to {portal_url} as {admin_user}.", False, cur_log_file_path)
+
+        sign_in_to_portal(target_portal, admin_user, admin_pass)
+
+        # Open Project for editing
+        prj = arcpy.mp.ArcGISProject(aprx_path)
+        mapprj = prj.listMaps()[0]
+
+        write_to_log(log_file, "Creating Service Definition", True, cur_log_file_path)
+
+        sd_name = f"{service_name}_{month_day_year}"
+        sd_name_sddraft = f"{sd_name}.sddraft"
+        sd_name_sd = f"{sd_name}.sd"
+        sd_name_sddraft_path = os.path.join(local_data_path, sd_name_sddraft)
+        sd_name_sd_path = os.path.join(local_data_path, sd_name_sd)
+
+        # The interrupted run's Service Definition is used while it is unchanged, it may be from the day before
+        staged = resume_stage("staged", lambda artifacts: file_intact(artifacts["sd"]))
+        if staged is not None:
+            sd_name_sd_path = staged["sd"]["path"]
+            sd_name = os.path.splitext(os.path.basename(sd_name_sd_path))[0]
+
+        # Services with a DELTAKEY send only their changed rows when the hosted layers still have the same fields
+        delta_edits = None
+        delta_keys = get_delta_keys(init_dict)
+        if rebuild_data and staged is None and delta_keys is not None and final_result == 0:
+            try:
+                with trace_span("delta_plan") as span:
+                    delta_edits = plan_delta_edits(service_name, delta_keys, layer_manifests, set(reuse_sources),
+                                                   mapprj)
+                    span["edits"] = delta_edits
+            except Exception:
+                throw_exception(log_file, "", cur_log_file_path)
+                delta_edits = None
+
+        if rebuild_data and staged is None and delta_edits is None:
+            stage_service_definition(mapprj, service_name, sd_name_sddraft_path, sd_name_sd_path, tags, description,
+                                     exporting, folder_name)
+            checkpoint("staged", {"sd": get_file_artifact(sd_name_sd_path)})
+
+        # Clean up Data Connections
+        del prj
+
+        return 0, {"sd": sd_name_sd_path, "fingerprints": fingerprints, "project": project_hash, "result": final_result,
+                   "delta": delta_edits, "layers": [get_manifest_record(manifest) for manifest in layer_manifests]}
+
+    except Exception:
+        throw_exception(log_file, "", cur_log_file_path)
+        return 1, None
+
+
+# Publish stage of a Hosted Feature Service: send the row edits planned by hosted_feature_build to the hosted layers,
+# or upload its Service Definition and overwrite the service with it; then update its sharing and record the
+# published sources
+def hosted_feature_publish(init_dict, handoff: dict):
+    try:
+        service_name = init_dict['SERVICENAME']
+        service_id = init_dict['SERVICEID']
+        folder_name = init_dict['FOLDERNAME']
+        tags = init_dict['TAGS']
+        description = init_dict['DESCRIPTION']
+        exporting = init_dict['EXPORTING']
+        everyone = init_dict['EVERYONE']
+        org = init_dict['ORG']
+        groups = init_dict['GROUPS']
+        portal_url = init_dict['PORTALURL']
+        admin_user = init_dict['ADMINUSER']
+        admin_pass = init_dict['ADMINPASS']
+
+        # Set sharing options
+        shrOrg = True if org.upper() == 'TRUE' else False
+        shrEveryone = True if everyone.upper() == 'TRUE' else False
+        groups = None if groups.upper() == "NONE" else [group.strip() for group in groups.split(',')]
+        folder_name = None if folder_name.upper() == "NONE" else folder_name
+        exporting = True if exporting.upper() == 'TRUE' else False
+
+        # Service Definition and extracts handed off by the build stage
+        sd_name_sd_path = handoff["sd"]
+        sd_name = os.path.splitext(os.path.basename(sd_name_sd_path))[0]
+        fingerprints = handoff["fingerprints"]
+        project_hash = handoff["project"]
+        final_result = handoff["result"]
+        layer_manifests = [LayerManifest(**layer) for layer in handoff["layers"]]
+        target_portal = get_target_portal(portal_url)
+
+        # Sign into portal
+        session = get_portal_session(target_portal, admin_user, admin_pass)
+        gis = session["gis"]
+        write_to_log(log_file, f"Active Portal: {gis.url}", True, cur_log_file_path)
+
+        # Send only the changed rows to the hosted layers, the service stays online throughout
+        feature_service = None
+        if handoff.get("delta") is not None:
+            published = resume_stage("published",
+                                     lambda artifacts: find_item_by_id(gis, admin_user, artifacts["item"]) is not None)
+            if published is not None:
+                feature_service = find_item_by_id(gis, admin_user, published["item"])
+            else:
+                feature_service = find_feature_service(gis, admin_user, service_id, service_name)
+                applied = False
+                if feature_service is None:
+                    write_to_log(log_file, f"No hosted service to edit for {service_name}", False, cur_log_file_path)
+                else:
+                    write_to_log(log_file, f"Sending {handoff['delta']} row edits to {feature_service.homepage}", True,
+                                 cur_log_file_path)
+                    try:
+                        with trace_span("delta_apply", edits=handoff["delta"]):
+                            applied = apply_delta_edits(service_name, feature_service, session)
+                    except Exception:
+                        throw_exception(log_file, "", cur_log_file_path)
+                if applied:
+                    checkpoint("published", {"item": feature_service.id})
+                else:
+                    # Overwriting the service brings it back in line with the extracts whatever edits were sent
+                    write_to_log(log_file, "Row edits not applied, overwriting the service", True, cur_log_file_path)
+                    feature_service = None
+                    sign_in_to_portal(target_portal, admin_user, admin_pass)
+                    prj = arcpy.mp.ArcGISProject(os.path.join(local_data_path, f"{service_name}.aprx"))
+                    sd_name = f"{service_name}_{month_day_year}"
+                    sd_name_sd_path = os.path.join(local_data_path, f"{sd_name}.sd")
+                    stage_service_definition(prj.listMaps()[0], service_name,
+                                             os.path.join(local_data_path, f"{sd_name}.sddraft"), sd_name_sd_path,
+                                             tags, description, exporting, folder_name)
+                    del prj
+                    checkpoint("staged", {"sd": get_file_artifact(sd_name_sd_path)})
+
+        if feature_service is None:
+            uploaded = resume_stage("uploaded",
+                                    lambda artifacts: find_item_by_id(gis, admin_user, artifacts["item"]) is not None)
+            if uploaded is not None:
+                sdItem = find_item_by_id(gis, admin_user, uploaded["item"])
+            else:
+                # Delete Service Definition if Exists
+                for item in find_items(gis, admin_user, sd_name, "Service Definition"):
+                    retry_call("portal", item.delete)
+                    remove_inventory_item(gis, admin_user, item)
+
+                # Add Service Definition to Portal
+                write_to_log(log_file, "Adding Service Definition to Portal", True, cur_log_file_path)
+
+                sdItem = upload_item(session, admin_user, sd_name_sd_path, {'type': "Service Definition"}, folder_name)
+                add_inventory_item(gis, admin_user, sdItem)
+                checkpoint("uploaded", {"item": sdItem.id})
+
+            # Publish Feature Service
+            published = resume_stage("published",
+                                     lambda artifacts: find_item_by_id(gis, admin_user, artifacts["item"]) is not None)
+            if published is not None:
+                feature_service = find_item_by_id(gis, admin_user, published["item"])
+            else:
+                with trace_span("publish"):
+                    feature_service = publish_as_overwrite_feature_service(service_id, service_name, gis, log_file,
+                                                                           cur_log_file_path, sdItem, admin_user)
+                if feature_service:
+                    checkpoint("published", {"item": feature_service.id})
+
+        if not feature_service:
+            write_to_log(log_file, "ERROR: Failed to publish service", False, cur_log_file_path)
+            return 1
+
+        # Update Share Settings and Feature Service Title
+        if resume_stage("shared", lambda artifacts: True) is None:
+            with trace_span("share"):
+                retry_call("portal", feature_service.share, org=shrOrg, everyone=shrEveryone, groups=groups)
+            retry_call("portal", feature_service.update, item_properties={"title": service_name})
+            checkpoint("shared", {})
+
+        write_to_log(log_file, f"Feature Service URL: {feature_service.homepage}.", False, cur_log_file_path)
+        write_to_log(log_file, "Feature Service Published.", True, cur_log_file_path)
+
+        # Record the published sources for the next incremental run
+        if fingerprints is not None and final_result == 0:
+            layer_states = {}
+            for manifest in layer_manifests:
+                if manifest.layer_key in fingerprints and manifest.gdb_path and \
+                        arcpy.Exists(os.path.join(manifest.gdb_path, manifest.fc_name)):
+                    layer_states[manifest.layer_key] = {"fingerprint": fingerprints[manifest.layer_key],
+                                                        "gdb": os.path.basename(manifest.gdb_path),
+                                                        "dataset": manifest.fc_name,
+                                                        "seconds": manifest.seconds}
+            write_service_state(service_name, {"published": True, "layers": layer_states, "project": project_hash})
+        if final_result == 0:
+            commit_row_snapshot(service_name)
+
+        return final_result
+
+    except Exception as e:
+        throw_exception(log_file, "", cur_log_file_path)
+        return 1
+
+
+# Overwrite the underlying data in the target Feature service
+def publish_as_overwrite_feature_service(pofs_service_id: str, pofs_service_name: str, pofs_gis, pofs_log_file: str,
+                                         pofs_cur_log_file_path: str, pofs_sd_item, pofs_owner: str):
+    feature_service = None
+
+    # Make sure that there's a Feature Service to replace
+    publish_params = {"title": pofs_service_name}
+    replace_sdItem = find_feature_service(pofs_gis, pofs_owner, pofs_service_id, pofs_service_name,
+                                          pofs_sd_item.title)
+    if replace_sdItem:
+        write_to_log(pofs_log_file, "To Be Replaced Service: {0}".format(replace_sdItem.homepage), False,
+                     pofs_cur_log_file_path)
+        write_to_log(pofs_log_file, "Overwriting Feature Service", True, pofs_cur_log_file_path)
+        try:
+            feature_service = retry_call("publish", pofs_sd_item.publish, overwrite=True,
+                                         file_type='serviceDefinition')
+        except Exception as e:
+            throw_exception(pofs_log_file, "", pofs_cur_log_file_path)
+    else:
+        feature_service = publish_as_new_feature_service(pofs_sd_item, pofs_log_file, pofs_cur_log_file_path)
+
+    if feature_service:
+        add_inventory_item(pofs_gis, pofs_owner, feature_service)
+    return feature_service
+
+
+# Find the hosted Feature Service of a service, by its .ini SERVICEID or else by title
+# Returns None when there is none
+def find_feature_service(ffs_gis, ffs_owner: str, ffs_service_id: str, ffs_service_name: str, ffs_sd_title: str = None):
+    feature_service = None
+    titles = [ffs_service_name] + ([ffs_sd_title] if ffs_sd_title else [])
+
+    # Toggle Search by ID or Search by Title
+    search_by_id = False
+    if ffs_service_id.upper() != 'NONE':
+        search_by_id = True
+    search_query = "title:{0} OR name:{0}".format(ffs_service_name)
+
+    if search_by_id:
+        feature_service = find_item_by_id(ffs_gis, ffs_owner, ffs_service_id)
+    if not feature_service:
+        write_to_log(log_file, f"Searching for matching titles... current search: {ffs_service_name}", False,
+                     cur_log_file_path)
+        for title in titles:
+            for item in find_items(ffs_gis, ffs_owner, title, "Feature Service"):
+                if not feature_service:
+                    feature_service = item
+    if not feature_service:
+        # Services owned by another user are not in the inventory
+        for item in ffs_gis.content.search(search_query, item_type="Feature Service"):
+            if item.title in titles and item and not feature_service:
+                feature_service = item
+    return feature_service
+
+
+# Create a Service Definition of a project map for overwriting its hosted Feature Service
+def stage_service_definition(ssd_map, ssd_service_name: str, ssd_sddraft_path: str, ssd_sd_path: str, ssd_tags: str,
+                             ssd_description: str, ssd_exporting: bool, ssd_folder_name: str):
+    # Create SDDraft, delete if exists
+    if os.path.exists(ssd_sddraft_path):
+        os.remove(ssd_sddraft_path)
+    if os.path.exists(ssd_sd_path):
+        os.remove(ssd_sd_path)
+
+    sharing_draft = ssd_map.getWebLayerSharingDraft("HOSTING_SERVER", "FEATURE", ssd_service_name)
+    sharing_draft.tags = ssd_tags
+    sharing_draft.description = ssd_description
+    sharing_draft.allowExporting = ssd_exporting
+    sharing_draft.overwriteExistingService = True
+    sharing_draft.portalFolder = ssd_folder_name
+
+    # Create Service Definition Draft file
+    with trace_span("sddraft_export"):
+        sharing_draft.exportToSDDraft(ssd_sddraft_path)
+
+    # Stage Service SDDraft -> SD file
+    write_to_log(log_file, "Finalizing Service (.sddraft to .sd)", True)
+    with trace_span("stage_service"):
+        retry_call("geoprocessing", arcpy.StageService_server, ssd_sddraft_path, ssd_sd_path)
+
+    # Delete SDDraft
+    if os.path.exists(ssd_sddraft_path):
+        os.remove(ssd_sddraft_path)
+
+
+# Publish a new feature service
+def publish_as_new_feature_service(pnfs_sdItem, pnfs_log: str, pnfs_curlog: str):
+    write_to_log(pnfs_log, "Publishing Feature Service", True, pnfs_curlog)
+    pnfs_feature_service = None
+    pnfs_feature_service = retry_call("publish", pnfs_sdItem.publish, file_type='serviceDefinition')
+    return pnfs_feature_service
+
+
+# Key field of each layer for delta publishing, from the .ini DELTAKEY: a field name for every layer, and
+# "layer name: field" entries for layers keyed by another field. None when the service has no DELTAKEY
+def get_delta_keys(init_dict: dict):
+    delta_key = init_dict.get('DELTAKEY', "None")
+    if not config["delta"]["publish"] or delta_key.upper() in ("NONE", ""):
+        return None
+    delta_keys = {None: None}
+    for entry in delta_key.split(','):
+        if ':' in entry:
+            layer_name, key_field = entry.split(':', 1)
+            delta_keys[layer_name.strip()] = key_field.strip()
+        elif entry.strip():
+            delta_keys[None] = entry.strip()
+    return delta_keys
+
+
+# Fields the .ini's KEEPFIELDS always extracts, as {None: [fields of every layer], layer name: [fields]}, with the
+# delta key fields. Returns None when the service extracts every field: KEEPFIELDS = ALL, or extract.prune_fields off
+# KEEPFIELDS = FIELD, Layer name: FIELD
+def get_keep_fields(init_dict: dict):
+    keep_field = init_dict.get('KEEPFIELDS', "None")
+    if not config["extract"]["prune_fields"] or keep_field.upper() == "ALL":
+        return None
+    keep_fields = {None: []}
+    if keep_field.upper() not in ("NONE", ""):
+        for entry in keep_field.split(','):
+            if ':' in entry:
+                layer_name, field_name = entry.split(':', 1)
+                keep_fields.setdefault(layer_name.strip(), []).append(field_name.strip())
+            elif entry.strip():
+                keep_fields[None].append(entry.strip())
+
+    # Changed rows are matched to hosted rows by their key field
+    for layer_name, key_field in (get_delta_keys(init_dict) or {}).items():
+        if key_field:
+            keep_fields.setdefault(layer_name, []).append(key_field)
+    return keep_fields
+
+
+# Path of the row snapshot taken when a service's hosted layers were last published
+def get_row_snapshot_path(service_name: str):
+    return os.path.join(state_path, f"{service_name}_rows.sqlite")
+
+
+# Hash every row of a service's extracts by its key field and write a new row snapshot; when the snapshot of the
+# last publish has the same layers and fields, the adds, updates and deletes that bring the hosted layers up to date
+# are kept in it too. Returns the number of edits, or None when the service has to be overwritten
+def plan_delta_edits(service_name: str, delta_keys: dict, layer_manifests: list, unchanged_layers: set, prj_map):
+    snapshot_path = get_row_snapshot_path(service_name)
+    new_snapshot_path = f"{snapshot_path}.new"
+    if os.path.exists(new_snapshot_path):
+        os.remove(new_snapshot_path)
+    reason = None if os.path.exists(snapshot_path) else "no snapshot of the last publish"
+    edit_count = 0
+    row_count = 0
+    planned = False
+    new_db = sqlite3.connect(new_snapshot_path)
+    prior_db = sqlite3.connect(snapshot_path) if reason is None else None
+    try:
+        new_db.execute("CREATE TABLE layers (layer TEXT PRIMARY KEY, name TEXT, key_field TEXT, key_type TEXT, "
+                       "fields TEXT)")
+        new_db.execute("CREATE TABLE rows (layer TEXT, key TEXT, hash TEXT, PRIMARY KEY (layer, key))")
+        new_db.execute("CREATE TABLE edits (layer TEXT, operation TEXT, key TEXT, feature TEXT)")
+        prior_fields = dict(prior_db.execute("SELECT layer, fields FROM layers")) if prior_db else {}
+
+        for manifest in layer_manifests:
+            layer_key = manifest.layer_key
+            fc_path = os.path.join(manifest.gdb_path, manifest.fc_name)
+            key_field = delta_keys.get(manifest.layer_name, delta_keys[None])
+            all_fields = arcpy.ListFields(fc_path)
+            layer_fields = [field for field in all_fields
+                            if field.type not in ("OID", "Geometry", "GlobalID", "Blob", "Raster") and
+                            field.name.upper() not in ("SHAPE_LENGTH", "SHAPE_AREA")]
+            field_names = [field.name for field in layer_fields]
+            key_index = [name.upper() for name in field_names].index(key_field.upper()) \
+                if key_field and key_field.upper() in [name.upper() for name in field_names] else None
+            if key_index is None:
+                write_to_log(log_file, f"{manifest.layer_name} has no key field {key_field}, rows are not compared",
+                             False, cur_log_file_path)
+                return None
+            fields = json.dumps([[field.name, field.type, field.length] for field in layer_fields])
+            new_db.execute("INSERT INTO layers VALUES (?, ?, ?, ?, ?)",
+                           (layer_key, manifest.layer_name, field_names[key_index], layer_fields[key_index].type,
+                            fields))
+            if reason is None and prior_fields.get(layer_key) != fields:
+                reason = f"fields of {manifest.layer_name} changed"
+            prior_rows = {}
+            if prior_db:
+                prior_rows = dict(prior_db.execute("SELECT key, hash FROM rows WHERE layer = ?", (layer_key,)))
+
+            # Layers whose sources are unchanged keep their snapshot
+            if prior_rows and layer_key in unchanged_layers and prior_fields.get(layer_key) == fields:
+                new_db.executemany("INSERT INTO rows VALUES (?, ?, ?)",
+                                   [(layer_key, key, row_hash) for key, row_hash in prior_rows.items()])
+                row_count += len(prior_rows)
+                continue
+
+            # Hash each row's attributes and shape in the map's coordinate system
+            has_shape = any(field.type == "Geometry" for field in all_fields)
+            new_rows = []
+            edits = []
+            with arcpy.da.SearchCursor(fc_path, field_names + (["SHAPE@JSON"] if has_shape else []),
+                                       spatial_reference=prj_map.spatialReference) as cursor:
+                for row in cursor:
+                    if row[key_index] is None:
+                        write_to_log(log_file, f"{manifest.layer_name} has rows without a {key_field}", False,
+                                     cur_log_file_path)
+                        return None
+                    key = get_delta_key_value(row[key_index], layer_fields[key_index].type)
+                    row_hash = hashlib.sha1(repr(row).encode("utf-8")).hexdigest()
+                    new_rows.append((layer_key, key, row_hash))
+                    prior_hash = prior_rows.pop(key, None)
+                    if prior_hash != row_hash:
+                        edits.append((layer_key, "update" if prior_hash else "add", key,
+                                      json.dumps(get_delta_feature(field_names, row, has_shape))))
+                    if len(new_rows) >= 10000:
+                        new_db.executemany("INSERT INTO rows VALUES (?, ?, ?)", new_rows)
+                        new_rows = []
+                    if len(edits) >= 10000:
+                        new_db.executemany("INSERT INTO edits VALUES (?, ?, ?, ?)", edits)
+                        edit_count += len(edits)
+                        edits = []
+            new_db.executemany("INSERT INTO rows VALUES (?, ?, ?)", new_rows)
+
+            # Rows left in the snapshot have been deleted
+            edits.extend((layer_key, "delete", key, None) for key in prior_rows)
+            new_db.executemany("INSERT INTO edits VALUES (?, ?, ?, ?)", edits)
+            edit_count += len(edits)
+            row_count += new_db.execute("SELECT COUNT(*) FROM rows WHERE layer = ?", (layer_key,)).fetchone()[0]
+
+        if reason is None and set(prior_fields) != set(manifest.layer_key for manifest in layer_manifests):
+            reason = "layers of the map changed"
+        if reason is None and edit_count > config["delta"]["max_share"] * max(row_count, 1):
+            reason = f"{edit_count} of {row_count} rows changed"
+        if reason is not None:
+            new_db.execute("DELETE FROM edits")
+        new_db.commit()
+        planned = True
+    except sqlite3.IntegrityError:
+        write_to_log(log_file, f"Key values repeat in {manifest.layer_name}, rows are not compared", False,
+                     cur_log_file_path)
+        return None
+    finally:
+        new_db.close()
+        if prior_db:
+            prior_db.close()
+        if not planned and os.path.exists(new_snapshot_path):
+            os.remove(new_snapshot_path)
+
+    if reason is not None:
+        write_to_log(log_file, f"Overwriting {service_name}: {reason}", True, cur_log_file_path)
+        return None
+    write_to_log(log_file, f"{edit_count} of {row_count} rows changed since the last publish", True, cur_log_file_path)
+    return edit_count
+
+
+# Feature of an applyEdits call from a row of a delta scan, dates as epoch milliseconds
+def get_delta_feature(field_names: list, row: tuple, has_shape: bool):
+    attributes = {}
+    for field_name, value in zip(field_names, row):
+        if isinstance(value, datetime.datetime):
+            value = get_epoch_milliseconds(value)
+        attributes[field_name] = value
+    feature = {"attributes": attributes}
+    if has_shape and row[-1] is not None:
+        feature["geometry"] = json.loads(row[-1])
+    return feature
+
+
+# Epoch milliseconds of a date, as hosted layers return dates
+def get_epoch_milliseconds(value: datetime.datetime):
+    return int(value.replace(tzinfo=datetime.timezone.utc).timestamp() * 1000)
+
+
+# Key value of a row as kept in the row snapshot, written the same way for a source row and a hosted row
+# Dates are kept as epoch milliseconds and numbers in one form, so 1 and 1.0 of a Double key match
+def get_delta_key_value(value, key_type: str):
+    if key_type == "Date":
+        return str(value if isinstance(value, int) else get_epoch_milliseconds(value))
+    if key_type in ("Double", "Single"):
+        return repr(float(value))
+    if key_type in ("Integer", "SmallInteger", "BigInteger"):
+        return str(int(value))
+    return str(value)
+
+
+# Where clause literal of a key value from the row snapshot, by the type of its key field
+def get_key_literal(key: str, key_type: str):
+    if key_type == "Date":
+        key_date = datetime.datetime.fromtimestamp(int(key) / 1000, datetime.timezone.utc)
+        return f"DATE '{key_date.strftime('%Y-%m-%d %H:%M:%S')}'" if key_date.microsecond == 0 else \
+            f"TIMESTAMP '{key_date.strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]}'"
+    if key_type in ("Double", "Single", "Integer", "SmallInteger", "BigInteger"):
+        return key
+    return "'{}'".format(key.replace("'", "''"))
+
+
+# Send the edits planned for a service to its hosted layers in applyEdits batches
+# Keys are looked up on the hosted layers first, so adds already sent by an interrupted run become updates and
+# deletes of rows already gone are dropped. Returns True when every edit was applied
+def apply_delta_edits(service_name: str, feature_service, session: dict):
+    token = session["token"]
+    service_url = feature_service.url
+    service_info = retry_call("portal", post_portal_form, service_url, {"f": "json", "token": token})
+    hosted_layers = {}
+    for hosted_layer in service_info.get("layers", []) + service_info.get("tables", []):
+        hosted_layers[hosted_layer["name"]] = hosted_layer["id"]
+
+    snapshot_db = sqlite3.connect(f"{get_row_snapshot_path(service_name)}.new")
+    try:
+        for layer_key, layer_name, key_field, key_type in \
+                snapshot_db.execute("SELECT layer, name, key_field, key_type FROM layers").fetchall():
+            edits = snapshot_db.execute("SELECT operation, key, feature FROM edits WHERE layer = ?",
+                                        (layer_key,)).fetchall()
+            if not edits:
+                continue
+            if layer_name not in hosted_layers:
+                write_to_log(log_file, f"{layer_name} is not a layer of {feature_service.homepage}", False,
+                             cur_log_file_path)
+                return False
+            layer_url = f"{service_url}/{hosted_layers[layer_name]}"
+            layer_info = retry_call("portal", post_portal_form, layer_url, {"f": "json", "token": token})
+            oid_field = layer_info["objectIdField"]
+            object_ids = get_hosted_object_ids(layer_url, token, key_field, key_type, oid_field,
+                                               [edit[1] for edit in edits])
+
+            adds = []
+            updates = []
+            deletes = []
+            for operation, key, feature in edits:
+                if operation == "delete":
+                    if key in object_ids:
+                        deletes.append(object_ids[key])
+                    continue
+                feature = json.loads(feature)
+                if key in object_ids:
+                    feature["attributes"][oid_field] = object_ids[key]
+                    updates.append(feature)
+                else:
+                    adds.append(feature)
+
+            # Edits are not retried, a batch that may have been applied is repaired by overwriting the service
+            for batch_start in range(0, max(len(adds), len(updates), len(deletes)), config["delta"]["batch_rows"]):
+                batch = slice(batch_start, batch_start + config["delta"]["batch_rows"])
+                edit_fields = {"f": "json", "token": token, "rollbackOnFailure": "true"}
+                if adds[batch]:
+                    edit_fields["adds"] = json.dumps(adds[batch])
+                if updates[batch]:
+                    edit_fields["updates"] = json.dumps(updates[batch])
+                if deletes[batch]:
+                    edit_fields["deletes"] = ",".join(str(object_id) for object_id in deletes[batch])
+                edit_results = post_portal_form(f"{layer_url}/applyEdits", edit_fields)
+                failed = [edit_result for results_name in ("addResults", "updateResults", "deleteResults")
+                          for edit_result in edit_results.get(results_name, []) if not edit_result.get("success")]
+                if failed:
+                    write_to_log(log_file, f"{layer_name}: {len(failed)} edits failed, {failed[0].get('error')}",
+                                 False, cur_log_file_path)
+                    return False
+            write_to_log(log_file, f"{layer_name}: {len(adds)} added, {len(updates)} updated, {len(deletes)} deleted",
+                         False, cur_log_file_path)
+        return True
+    finally:
+        snapshot_db.close()
+
+
+# Object ids of the rows of a hosted layer with the given key values, {key: object id}
+def get_hosted_object_ids(layer_url: str, token: str, key_field: str, key_type: str, oid_field: str, keys: list):
+    object_ids = {}
+    for batch_start in range(0, len(keys), config["delta"]["lookup_keys"]):
+        batch = keys[batch_start:batch_start + config["delta"]["lookup_keys"]]
+        values = ", ".join(get_key_literal(key, key_type) for key in batch)
+        query_result = retry_call("portal", post_portal_form, f"{layer_url}/query",
+                                  {"f": "json", "token": token, "where": f"{key_field} IN ({values})",
+                                   "outFields": f"{oid_field},{key_field}", "returnGeometry": "false"})
+        for feature in query_result.get("features", []):
+            object_ids[get_delta_key_value(feature["attributes"][key_field], key_type)] = \
+                feature["attributes"][oid_field]
+    return object_ids
+
+
+# Keep the row snapshot of the data that was just published for the next run
+def commit_row_snapshot(service_name: str):
+    snapshot_path = get_row_snapshot_path(service_name)
+    if os.path.exists(f"{snapshot_path}.new"):
+        os.replace(f"{snapshot_path}.new", snapshot_path)
+
+
+# Record of one extracted layer, returned by an extraction worker to the parent
+class LayerManifest:
+    __slots__ = ("layer_name", "layer_key", "fc_name", "gdb_path", "source_connection", "result", "worker",
+                 "seconds")
+
+    def __init__(self, layer_name: str, layer_key: str, fc_name: str, gdb_path: str, source_connection: dict,
+                 result: int, worker: int, seconds: float):
+        self.layer_name = layer_name
+        self.layer_key = layer_key
+        self.fc_name = fc_name
+        self.gdb_path = gdb_path
+        self.source_connection = source_connection
+        self.result = result
+        self.worker = worker
+        self.seconds = seconds
+
+
+# Layer manifest as a plain dict, for checkpoints and the publish handoff
+def get_manifest_record(manifest: LayerManifest):
+    return {name: getattr(manifest, name) for name in LayerManifest.__slots__}
+
+
+# Build the extraction tasks for the layers of a project, most expensive first
+# Each task: [cost, layer name, layer long name, fc_path, fc_name, definition query, connection, reuse source,
+# extract key, services sharing the extract, fields to extract or None for every field]
+# Layers with the same extract key as an earlier layer get no task of their own, they are returned as
+# {layer long name of the task: [(layer name, layer long name)]} and point to that layer's feature class
+# Feature class names are made unique here, before any worker starts
+def get_extract_tasks(aprx_path: str, layer_costs: dict, reuse_sources: dict, cur_logFile: str,
+                      keep_fields: dict = None):
+    extract_tasks = []
+    extract_aliases = {}
+    extract_layers = {}
+    fc_names = set()
+    shared_extracts = read_shared_extracts() if config["extract"]["share"] else {}
+    prj = arcpy.mp.ArcGISProject(aprx_path)
+    for cur_layer in prj.listMaps()[0].listLayers():
+        try:
+            layer_source = get_layer_source(cur_layer, cur_logFile)
+            if layer_source:
+                fc_path, fc_name, definition_query, connectionProperties = layer_source
+                layer_key = cur_layer.longName
+                field_names = get_layer_fields(cur_layer, fc_path, definition_query, keep_fields, cur_logFile)
+                extract_key = get_extract_key(fc_path, definition_query, connectionProperties, field_names)
+                if config["extract"]["share"] and extract_key in extract_layers:
+                    extract_aliases.setdefault(extract_layers[extract_key], []).append((str(cur_layer), layer_key))
+                    write_to_log(cur_logFile, f"{cur_layer} shares the extract of {extract_layers[extract_key]}.")
+                    continue
+                extract_layers[extract_key] = layer_key
+                while fc_name.upper() in fc_names:
+                    fc_name = f"{fc_name}_1"
+                fc_names.add(fc_name.upper())
+                extract_tasks.append([layer_costs.get(layer_key, 0), str(cur_layer), layer_key, fc_path, fc_name,
+                                      definition_query, connectionProperties, reuse_sources.get(layer_key),
+                                      extract_key, shared_extracts.get(extract_key, 1), field_names])
+        except Exception:
+            throw_exception(cur_logFile, str(cur_layer))
+    del prj
+    extract_tasks.sort(key=lambda task: task[0], reverse=True)
+    return extract_tasks, extract_aliases
+
+
+# Manifests for the layers sharing another layer's extract, pointing to its feature class
+def get_alias_manifests(layer_manifests: list, extract_aliases: dict):
+    alias_manifests = []
+    for manifest in layer_manifests:
+        for layer_name, layer_key in extract_aliases.get(manifest.layer_key, []):
+            alias_manifests.append(LayerManifest(layer_name, layer_key, manifest.fc_name, manifest.gdb_path,
+                                                 manifest.source_connection, manifest.result, manifest.worker, 0.0))
+    return alias_manifests
+
+
+# Save a layer of the service to this worker's local file geodatabase
+@profiled_task
+def save_to_gdb_aprx(args):
+    task = args[0]
+    cur_service_name = args[1]
+    cur_logFile = args[2]
+    cur_data_path = args[3]
+    currentLogFilePath = args[4]
+    cost, cur_layer, layer_key, fc_path, fc_name, definition_query, connectionProperties, reuse_source, \
+        extract_key, shared_services, field_names = task
+    task_start = time.monotonic()
+    gdb_path = None
+
+    try:
+        # Each worker writes to its own GDB
+        cur_gdb_dir = os.path.join(cur_data_path, f"{cur_service_name}_data")
+        gdb_name = f"{cur_service_name}_{extract_slot}.gdb"
+        gdb_path = os.path.join(cur_gdb_dir, gdb_name)
+        if not arcpy.Exists(gdb_path):
+            arcpy.CreateFileGDB_management(cur_gdb_dir, gdb_name)
+
+        # Save FC to local GDB
+        try:
+            with trace_span("extract", cur_layer, worker=extract_slot) as span:
+                if reuse_source and arcpy.Exists(reuse_source):
+                    # Source unchanged since the last publish, copy the previous extract
+                    span["reused"] = True
+                    arcpy.Copy_management(reuse_source, os.path.join(gdb_path, fc_name))
+                    write_to_log(cur_logFile, f"{cur_layer} unchanged, reused {fc_name} in {gdb_name}.")
+                elif fc_name != "GATES" and shared_services > 1:  # TODO FIX GATES
+                    # Other services extract the same source, copy it from the extract store
+                    span["shared"] = True
+                    get_worker_connection(fc_path)
+                    store_fc = get_shared_extract(extract_key, shared_services, fc_path, fc_name, definition_query,
+                                                  field_names, cur_logFile)
+                    arcpy.Copy_management(store_fc, os.path.join(gdb_path, fc_name))
+                    release_shared_extract(extract_key, cur_service_name)
+                    write_to_log(cur_logFile, f"{cur_layer} source changed to {fc_name} in {gdb_name}, "
+                                              f"copied from the extract store.")
+                elif fc_name != "GATES":  # TODO FIX GATES
+                    get_worker_connection(fc_path)
+                    arcpy.FeatureClassToFeatureClass_conversion(fc_path, gdb_path, fc_name,
+                                                                where_clause=definition_query,
+                                                                field_mapping=get_field_mappings(fc_path, field_names))
+                    write_to_log(cur_logFile, f"{cur_layer} source changed to {fc_name} in {gdb_name}.")
+        except Exception:
+            throw_exception(cur_logFile, cur_layer, currentLogFilePath)
+
+        return LayerManifest(cur_layer, layer_key, fc_name, gdb_path, connectionProperties, 0, extract_slot,
+                             time.monotonic() - task_start)
+
+    except Exception:
+        throw_exception(cur_logFile, cur_layer, currentLogFilePath)
+        return LayerManifest(cur_layer, layer_key, fc_name, None, connectionProperties, 1, extract_slot,
+                             time.monotonic() - task_start)
+
+
+# Key of a layer's extract: its connection, dataset, where clause and fields
+# Layers and services with the same key get the same extract
+def get_extract_key(fc_path: str, definition_query: str, connectionProperties: dict, field_names: list = None):
+    extract_key = hashlib.sha1()
+    extract_key.update(json.dumps(connectionProperties, sort_keys=True, default=str).encode("utf-8"))
+    extract_key.update(fc_path.upper().encode("utf-8"))
+    extract_key.update(definition_query.encode("utf-8"))
+    extract_key.update(json.dumps(sorted(name.upper() for name in field_names) if field_names else "*").encode())
+    return extract_key.hexdigest()
+
+
+# Count the feature services extracting each source, sources of more than one service are extracted once into the
+# extract store and copied from there
+# The extract keys of a service are the ones its last extraction worked out, a service whose project or fields to
+# keep have changed since, or that has not been extracted yet, has its project read here
+# Writes {extract key: services} of the shared sources to the store, for the services' extraction tasks
+def count_shared_extracts(jobs: list):
+    extract_services = {}
+    for file_name, init_dict in jobs:
+        if init_dict.get('SERVICETYPE', "").upper() != "FEATURE":
+            continue
+        keep_fields = get_keep_fields(init_dict)
+        try:
+            extract_keys = read_extract_keys(init_dict['SERVICENAME'], get_file_hash(init_dict['APRX']), keep_fields)
+        except Exception:
+            throw_exception(log_file, file_name)
+            continue
+        if extract_keys is None:
+            extract_keys = set()
+            try:
+                prj = arcpy.mp.ArcGISProject(init_dict['APRX'])
+                for lyr in prj.listMaps()[0].listLayers():
+                    try:
+                        layer_source = get_layer_source(lyr)
+                        if layer_source:
+                            fc_path, fc_name, definition_query, connectionProperties = layer_source
+                            field_names = get_layer_fields(lyr, fc_path, definition_query, keep_fields)
+                            extract_keys.add(get_extract_key(fc_path, definition_query, connectionProperties,
+                                                             field_names))
+                    except Exception:
+                        continue
+                del prj
+            except Exception:
+                throw_exception(log_file, file_name)
+        for extract_key in extract_keys:
+            extract_services[extract_key] = extract_services.get(extract_key, 0) + 1
+
+    shared_extracts = {key: services for key, services in extract_services.items() if services > 1}
+    with open(os.path.join(extract_store_path, "shared.json"), "w") as shared_writer:
+        json.dump(shared_extracts, shared_writer)
+    write_to_log(log_file, f"{len(shared_extracts)} sources shared between services", False)
+    return shared_extracts
+
+
+# Path of the extract keys of a service's layers, kept in the state store
+def get_extract_keys_path(service_name: str):
+    return os.path.join(state_path, f"{service_name}_extracts.json")
+
+
+# Extract keys of a service's layers as its last extraction worked them out, None when its project or fields to
+# keep have changed since
+def read_extract_keys(service_name: str, project_hash: str, keep_fields: dict):
+    try:
+        with open(get_extract_keys_path(service_name), "r") as keys_reader:
+            extract_keys = json.load(keys_reader)
+    except Exception:
+        return None
+    if extract_keys.get("project") != project_hash or extract_keys.get("keep_fields") != json.dumps(keep_fields):
+        return None
+    return set(extract_keys["keys"])
+
+
+# Keep the extract keys of a service's layers for the next run's count of shared sources
+def write_extract_keys(service_name: str, project_hash: str, keep_fields: dict, extract_tasks: list):
+    keys_path = get_extract_keys_path(service_name)
+    temp_keys_path = f"{keys_path}.{os.getpid()}.tmp"
+    with open(temp_keys_path, "w") as keys_writer:
+        json.dump({"project": project_hash, "keep_fields": json.dumps(keep_fields),
+                   "keys": sorted(set(task[8] for task in extract_tasks))}, keys_writer)
+    os.replace(temp_keys_path, keys_path)
+
+
+# Read the shared sources counted for this run, none when the store was not set up
+def read_shared_extracts():
+    try:
+        with open(os.path.join(extract_store_path, "shared.json"), "r") as shared_reader:
+            return json.load(shared_reader)
+    except Exception:
+        return {}
+
+
+# Path of a shared extract in the extract store, extracting it first unless another process already has
+# The first process to claim the extract makes it, writing its process id into the claim, the others wait until it
+# is done. A claim whose process is gone is broken and the extract made again; waiting longer than
+# extract.store_wait_seconds raises TimeoutError
+def get_shared_extract(extract_key: str, shared_services: int, fc_path: str, fc_name: str, definition_query: str,
+                       field_names: list, cur_logFile: str):
+    entry_path = os.path.join(extract_store_path, extract_key)
+    entry_file = f"{entry_path}.json"
+    lock_file = f"{entry_path}.lock"
+    store_gdb = f"{extract_key}.gdb"
+    wait_deadline = time.monotonic() + config["extract"]["store_wait_seconds"]
+    while not os.path.exists(entry_file):
+        try:
+            claim = os.open(lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            if break_stale_claim(lock_file):
+                write_to_log(cur_logFile, f"Broke the claim of an exited process on the extract of {fc_path}.")
+                continue
+            if time.monotonic() > wait_deadline:
+                raise TimeoutError(f"{fc_path} was not extracted to the extract store within "
+                                   f"{config['extract']['store_wait_seconds']} seconds")
+            time.sleep(config["extract"]["store_poll_seconds"])
+            continue
+        try:
+            os.write(claim, str(os.getpid()).encode("utf-8"))
+            # A GDB without an entry file is left from a failed extraction
+            shutil.rmtree(os.path.join(extract_store_path, store_gdb), ignore_errors=True)
+            arcpy.CreateFileGDB_management(extract_store_path, store_gdb)
+            arcpy.FeatureClassToFeatureClass_conversion(fc_path, os.path.join(extract_store_path, store_gdb),
+                                                        fc_name, where_clause=definition_query,
+                                                        field_mapping=get_field_mappings(fc_path, field_names))
+            temp_entry_file = f"{entry_file}.{os.getpid()}.tmp"
+            with open(temp_entry_file, "w") as entry_writer:
+                json.dump({"fc_name": fc_name, "services": shared_services}, entry_writer)
+            os.replace(temp_entry_file, entry_file)
+            write_to_log(cur_logFile, f"{fc_path} extracted to the extract store for {shared_services} services.")
+        finally:
+            os.close(claim)
+            os.remove(lock_file)
+
+    with open(entry_file, "r") as entry_reader:
+        return os.path.join(extract_store_path, store_gdb, json.load(entry_reader)["fc_name"])
+
+
+# Remove a claim on a shared extract whose process has exited, True when the claim is gone
+# The claim is moved aside before it is removed, so only one of the processes waiting on it breaks it
+def break_stale_claim(lock_file: str):
+    try:
+        with open(lock_file, "r") as lock_reader:
+            claim_pid = lock_reader.read()
+    except FileNotFoundError:
+        return True
+    # An empty claim is still being written
+    if not claim_pid.isdigit() or is_process_running(int(claim_pid)):
+        return False
+    stale_file = f"{lock_file}.{os.getpid()}.stale"
+    try:
+        os.rename(lock_file, stale_file)
+    except FileNotFoundError:
+        return True
+    except PermissionError:
+        # Windows does not move a claim that is held open, a new claim taken since it was read
+        return False
+    with open(stale_file, "r") as lock_reader:
+        if lock_reader.read() != claim_pid:
+            # Another process broke the claim and took a new one in the meantime, give it back
+            os.rename(stale_file, lock_file)
+            return False
+    os.remove(stale_file)
+    return True
+
+
+# True while a process of this machine is running
+def is_process_running(pid: int):
+    if os.name == "nt":
+        handle = ctypes.windll.kernel32.OpenProcess(process_query_access, False, pid)
+        if not handle:
+            return False
+        try:
+            exit_code = ctypes.c_ulong()
+            ctypes.windll.kernel32.GetExitCodeProcess(handle, ctypes.byref(exit_code))
+            return exit_code.value == process_still_active
+        finally:
+            ctypes.windll.kernel32.CloseHandle(handle)
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+# Drop a service's reference to a shared extract, the extract is removed once every service counted on it has
+# its copy
+def release_shared_extract(extract_key: str, service_name: str):
+    entry_path = os.path.join(extract_store_path, extract_key)
+    try:
+        with open(f"{entry_path}.json", "r") as entry_reader:
+            shared_services = json.load(entry_reader)["services"]
+        with open(f"{entry_path}.{service_name}.ref", "w"):
+            pass
+        references = [name for name in os.listdir(extract_store_path)
+                      if name.startswith(f"{extract_key}.") and name.endswith(".ref")]
+        if len(references) >= shared_services:
+            os.remove(f"{entry_path}.json")
+            shutil.rmtree(f"{entry_path}.gdb", ignore_errors=True)
+    except FileNotFoundError:
+        # The last other service removed it at the same time
+        pass
+
+
+# Set up the extract store for the run, a resumed run keeps the interrupted run's extracts
+# Claims held by the processes of the interrupted run are dropped
+def start_extract_store(jobs: list, resuming: bool):
+    if not resuming:
+        shutil.rmtree(extract_store_path, ignore_errors=True)
+    os.makedirs(extract_store_path, exist_ok=True)
+    for name in os.listdir(extract_store_path):
+        if name.endswith((".lock", ".stale")):
+            os.remove(os.path.join(extract_store_path, name))
+    count_shared_extracts(jobs)
+
+
+# Optimization tasks, one per extract GDB: (GDB path, {feature class: names to index}, log file, service log)
+# Names to index are the words of the layers' definition queries and their delta key fields
+def get_optimize_tasks(layer_manifests: list, extract_tasks: list, delta_keys: dict, cur_logFile: str,
+                       currentLogFilePath: str):
+    definition_queries = {task[2]: task[5] for task in extract_tasks}
+    gdb_indexes = {}
+    for manifest in layer_manifests:
+        if manifest.gdb_path is None or manifest.result == 1:
+            continue
+        index_names = gdb_indexes.setdefault(manifest.gdb_path, {}).setdefault(manifest.fc_name, set())
+        index_names.update(re.findall(r"[A-Za-z_][A-Za-z0-9_]*", definition_queries.get(manifest.layer_key, "")))
+        if delta_keys:
+            index_names.add(delta_keys.get(manifest.layer_name, delta_keys[None]) or "")
+    return [(gdb_path, {fc_name: sorted(names) for fc_name, names in fc_indexes.items()}, cur_logFile,
+             currentLogFilePath) for gdb_path, fc_indexes in sorted(gdb_indexes.items())]
+
+
+# Rebuild the spatial indexes of an extract GDB, add attribute indexes on the fields to index, then compact it
+# Returns (GDB path, bytes before, bytes after, result), a GDB that could not be optimized is published as it is
+@profiled_task
+def optimize_gdb(args):
+    gdb_path, fc_indexes, cur_logFile, currentLogFilePath = args
+    gdb_name = os.path.basename(gdb_path)
+    bytes_before = get_folder_bytes(gdb_path)
+
+    try:
+        added = 0
+        with trace_span("optimize_gdb", gdb_name, worker=extract_slot):
+            for fc_name, index_names in fc_indexes.items():
+                fc_path = os.path.join(gdb_path, fc_name)
+                if not arcpy.Exists(fc_path):
+                    continue
+
+                # A failed index is logged and the GDB still compacted, tables have no spatial index
+                try:
+                    desc = arcpy.Describe(fc_path)
+                    if desc.dataType == "FeatureClass" and getattr(desc, "shapeType", None):
+                        arcpy.AddSpatialIndex_management(fc_path)
+
+                    # Fields already indexed, a reused extract keeps the indexes of its last run
+                    indexed = {index.fields[0].name.upper() for index in arcpy.ListIndexes(fc_path) if index.fields}
+                    fields = {field.name.upper(): field for field in desc.fields
+                              if field.type not in ("OID", "Geometry")}
+                    for index_name in index_names:
+                        field = fields.get(index_name.upper())
+                        if field is not None and field.name.upper() not in indexed:
+                            arcpy.AddIndex_management(fc_path, field.name, f"IX_{field.name}")
+                            indexed.add(field.name.upper())
+                            added += 1
+                except Exception:
+                    throw_exception(cur_logFile, fc_name, currentLogFilePath)
+            arcpy.Compact_management(gdb_path)
+
+        bytes_after = get_folder_bytes(gdb_path)
+        write_to_log(cur_logFile, f"{gdb_name}: {added} attribute indexes added, compacted from "
+                                  f"{round(bytes_before / 1048576, 1)} MB to {round(bytes_after / 1048576, 1)} MB.")
+        return gdb_path, bytes_before, bytes_after, 0
+
+    except Exception:
+        throw_exception(cur_logFile, gdb_name, currentLogFilePath)
+        return gdb_path, bytes_before, get_folder_bytes(gdb_path), 1
+
+
+# Bytes of every file under a folder
+def get_folder_bytes(folder_path: str):
+    total = 0
+    for root, dirs, files in os.walk(folder_path):
+        for file_name in files:
+            total += os.path.getsize(os.path.join(root, file_name))
+    return total
+
+
+# Log how busy each extraction worker was over the extraction phase
+def log_worker_utilization(layer_manifests: list, phase_seconds: float, proc_count: int):
+    worker_seconds = {}
+    worker_layers = {}
+    for manifest in layer_manifests:
+        worker_seconds[manifest.worker] = worker_seconds.get(manifest.worker, 0) + manifest.seconds
+        worker_layers[manifest.worker] = worker_layers.get(manifest.worker, 0) + 1
+    for slot in sorted(worker_seconds):
+        utilization = worker_seconds[slot] / phase_seconds * 100 if phase_seconds > 0 else 0
+        write_to_log(log_file, f"[Process {slot}]: {worker_layers[slot]} layers, {round(worker_seconds[slot], 1)} "
+                               f"seconds, {round(utilization)}% busy", False)
+    if phase_seconds > 0:
+        overall = sum(worker_seconds.values()) / (phase_seconds * proc_count) * 100
+        write_to_log(log_file, f"Extraction: {round(phase_seconds, 1)} seconds, {round(overall)}% worker utilization",
+                     True, cur_log_file_path)
+
+
+# Find the SDE feature class behind a project layer
+# Returns (fc_path, fc_name, definition_query, connectionProperties), or None for layers that are not copied
+def get_layer_source(cur_layer, cur_logFile: str = None):
+    global spuuser, gisuser, gisuserimgp
+
+    if cur_layer.isGroupLayer is not False:
+        if cur_logFile:
+            write_to_log(cur_logFile, f"{cur_layer} is a Group Layer.")
+        return None
+    try:
+        if cur_layer.isFeatureLayer:
+            pass
+    except Exception:
+        return None
+    if cur_layer.isBasemapLayer is not False or cur_layer.isWebLayer is not False:
+        if cur_logFile:
+            write_to_log(cur_logFile, f"{cur_layer} is a Basemap/Web Layer.")
+        return None
+
+    # Make local copy of gdb with filtered results
+    definition_query = ""
+    if cur_layer.supports("DEFINITIONQUERY") and \
+            len(cur_layer.definitionQuery) > 0 and \
+            cur_layer.definitionQuery != "":
+        definition_query = cur_layer.definitionQuery
+    connectionProperties = cur_layer.connectionProperties
+    if not connectionProperties or not connectionProperties['connection_info']:
+        if cur_logFile:
+            write_to_log(cur_logFile, f"POTENTIAL ERROR: {cur_layer} has no valid connection info.")
+        return None
+    if 'user' not in connectionProperties['connection_info']:
+        if cur_logFile:
+            write_to_log(cur_logFile, f"POTENTIAL ERROR: {cur_layer} has no valid 'user' connection info.")
+        return None
+
+    user = connectionProperties['connection_info']['user']
+    dataset = connectionProperties['dataset']
+    datasource = cur_layer.dataSource
+    if len(datasource) > 150:
+        time.sleep(2)
+        datasource = cur_layer.dataSource
+    datasource_dict = {}
+    ds_config = datasource.split(',')
+    for conn_string in ds_config:
+        ds_key_value = conn_string.split('=')
+        try:
+            datasource_dict[ds_key_value[0].upper()] = ds_key_value[1]
+        except:
+            pass
+    try:
+        edit_dataset = datasource_dict["DATASET"]
+    except:
+        edit_dataset = datasource[datasource.rfind("\\") + 1:]
+    server = connectionProperties['connection_info']['server']
+    instance = connectionProperties['connection_info']['instance']
+    if user == 'gisuser' and (server == 'spugisp.world'
+                              or instance == 'sde:oracle$sde:oracle11g:spugisp'
+                              or instance == 'sde:oracle$sde:oracle11g:spugisp.world'):
+        sde_conn = gisuser
+    elif user == 'spuuser' and (server == 'spugisp.world'
+                                or instance == 'sde:oracle$sde:oracle11g:spugisp'
+                                or instance == 'sde:oracle$sde:oracle11g:spugisp.world'):
+        sde_conn = spuuser
+    elif user == 'crw' and (server == 'spugisp.world'
+                            or instance == 'sde:oracle$sde:oracle11g:spugisp'
+                            or instance == 'sde:oracle$sde:oracle11g:spugisp.world'):
+        sde_conn = crw_spugis
+    elif user == 'gisuser' and server == 'spuimgp.world':
+        sde_conn = gisuserimgp
+    elif user == 'crw' and 'shedsded' in instance:
+        sde_conn = crw_dev
+    elif user == 'crw' and 'shedsdet' in instance:
+        sde_conn = crw_test
+    elif user == 'crw':
+        sde_conn = crw_prod
+    else:
+        sde_conn = None
+
+    if not sde_conn:
+        if cur_logFile:
+            write_to_log(cur_logFile, f"{dataset} path unfound for {cur_layer}.")
+        return None
+
+    sde_conn_path = os.path.join(local_path, sde_conn)
+    if "FEATURE DATASET" in datasource_dict:
+        sde_conn_path = os.path.join(sde_conn_path, datasource_dict["FEATURE DATASET"])
+    fc_path = os.path.join(sde_conn_path, edit_dataset)
+
+    split_dataset = edit_dataset.split('.')
 
-        # Add VTPK to Portal
-        write_to_log(log_file, "Staging Vector Tile into Portal", True, cur_log_file_path)
-        try:
-            vtpk = gis.content.add(item_properties={'type': "Vector Tile Package", "description": description,
-                                                    "tags": tags}, data=pckg_name_vtpk_path, folder=folder_name)
-        except Exception:
-            time.sleep(60)  # Give time if portal is lagging
-            vtpk = gis.content.add(item_properties={'type': "Vector Tile Package", "description": description,
-                                                    "tags": tags}, data=pckg_name_vtpk_path, folder=folder_name)
+    if "\\" in edit_dataset:
+        schema = split_dataset[1][(split_dataset[1].find("\\") + 1):]
+        fc_name = split_dataset[2]
+    else:
+        schema = split_dataset[0]
+        fc_name = split_dataset[1]
 
-        # Publish New Service
-        write_to_log(log_file, "Creating New Service", True, cur_log_file_path)
-        try:
-            final_service = vtpk.publish()
-        except Exception:
-            time.sleep(60)  # Give time if portal is lagging
-            final_service = vtpk.publish()  # Try Again
+    return fc_path, fc_name, definition_query, connectionProperties
 
-        write_to_log(log_file, f"Tile Service: {final_service.homepage}.", False, cur_log_file_path)
 
-        # Update Style File
-        update_style_file(service_name, admin_user, gis, pckg_name, pckg_name_vtpk_path, portal_url, final_service)
+# Fields of a layer's source the layer uses: its visible fields, renderer fields, label expressions, definition query
+# and pop-up, with the required fields and the fields to keep. Returns sorted field names, or None to extract every
+# field when keep_fields is None or the layer cannot be read
+# Pop-ups are read from the layer's CIM where arcpy has it, with the fields they list, otherwise they show the
+# visible fields
+def get_layer_fields(cur_layer, fc_path: str, definition_query: str, keep_fields: dict, cur_logFile: str = None):
+    if keep_fields is None:
+        return None
+    try:
+        source_fields = {field.name.upper(): field for field in arcpy.ListFields(fc_path)}
+        layer_fields = {name.upper() for name in keep_fields[None] + keep_fields.get(str(cur_layer), [])}
+        layer_fields.update(name for name, field in source_fields.items() if getattr(field, "required", False))
+        expressions = [definition_query]
 
-        # Update Sharing Settings
-        try:
-            final_service.share(org=shrOrg, everyone=shrEveryone, groups=groups)
-        except Exception:
-            time.sleep(60)  # Give time if portal is lagging
-            final_service.share(org=shrOrg, everyone=shrEveryone, groups=groups)  # Try Again
+        field_info = arcpy.Describe(cur_layer).fieldInfo
+        for index in range(field_info.count):
+            if field_info.getVisible(index) == "VISIBLE":
+                layer_fields.add(field_info.getFieldName(index).upper())
 
-        return 0
-    
+        if cur_layer.supports("SYMBOLOGY"):
+            renderer = getattr(cur_layer.symbology, "renderer", None)
+            for renderer_field in ("fields", "classificationField", "normalizationField"):
+                value = getattr(renderer, renderer_field, None) or []
+                layer_fields.update(name.upper() for name in ([value] if isinstance(value, str) else value))
+
+        if cur_layer.supports("SHOWLABELS"):
+            for label_class in cur_layer.listLabelClasses():
+                expressions += [label_class.expression or "", label_class.SQLQuery or ""]
+
+        popup_info = getattr(cur_layer.getDefinition("V2"), "popupInfo", None) \
+            if hasattr(cur_layer, "getDefinition") else None
+        if popup_info is not None:
+            expressions.append(getattr(popup_info, "title", None) or "")
+            for media_info in getattr(popup_info, "mediaInfos", None) or []:
+                layer_fields.update(name.upper() for name in getattr(media_info, "fields", None) or [])
+                expressions.append(getattr(media_info, "text", None) or "")
+            for expression_info in getattr(popup_info, "expressionInfos", None) or []:
+                expressions.append(getattr(expression_info, "expression", None) or "")
+
+            # Fields the pop-up lists, shown there even when they are hidden in the table
+            for popup_field in (getattr(popup_info, "fieldInfos", None) or []) + \
+                    (getattr(popup_info, "fieldDescriptions", None) or []):
+                if getattr(popup_field, "visible", True) is not False and getattr(popup_field, "fieldName", None):
+                    layer_fields.add(popup_field.fieldName.upper())
+
+        # Fields named in an expression, [FIELD], $feature.FIELD, {FIELD} or a bare name in a query
+        layer_fields.update(word.upper() for word in re.findall(r"[A-Za-z_][A-Za-z0-9_]*", " ".join(expressions)))
     except Exception:
-        throw_exception(log_file, "", cur_log_file_path)
-        return 1
-        
+        # The layer is extracted whole when its fields cannot be worked out
+        if cur_logFile:
+            throw_exception(cur_logFile, str(cur_layer))
+        return None
 
-# Update style file service
-def update_style_file(usf_service_name: str, usf_admin_user: str, usf_gis, usf_pckg_name: str,
-                      usf_pckg_name_vtpk_path: str, usf_portal_url: str, usf_final_service):
-    style_service_name = f"{usf_service_name}_Style"
-    style_service = None
-    search_query = f"title:{style_service_name} AND owner:{usf_admin_user}"
-    for service in usf_gis.content.search(search_query, item_type="Vector Tile Service"):
-        if service.title == style_service_name and service:
-            style_service = service
+    field_names = sorted(source_fields[name].name for name in layer_fields if name in source_fields)
+    if cur_logFile:
+        write_to_log(cur_logFile, f"{cur_layer} uses {len(field_names)} of {len(source_fields)} fields.")
+    return field_names
 
-    # Update Style File
-    style_folder = f"{local_data_path}\\{usf_pckg_name}"
-    if os.path.exists(style_folder):
-        shutil.rmtree(style_folder)
-    os.mkdir(style_folder)
 
-    # Extract vtpk to zip
-    new_vtpk_path = f"{local_data_path}\\{usf_pckg_name}.zip"
-    os.rename(usf_pckg_name_vtpk_path, new_vtpk_path)
+# Field mappings of a source holding only the given fields, None keeps every field
+def get_field_mappings(fc_path: str, field_names: list):
+    if field_names is None:
+        return None
+    keep = {name.upper() for name in field_names}
+    field_mappings = arcpy.FieldMappings()
+    field_mappings.addTable(fc_path)
+    for index in reversed(range(field_mappings.fieldCount)):
+        if field_mappings.getFieldMap(index).getInputFieldName(0).upper() not in keep:
+            field_mappings.removeFieldMap(index)
+    return field_mappings
 
-    # Unzip
-    zip_ref = zipfile.ZipFile(new_vtpk_path, 'r')
-    zip_ref.extractall(style_folder)
-    zip_ref.close()
 
-    os.rename(new_vtpk_path, usf_pckg_name_vtpk_path)
+# Fingerprint the source of a layer: dataset, definition query, schema, row count, the latest edit date and the
+# number of rows without one, or a hash of every row when editor tracking is off
+def get_source_fingerprint(fc_path: str, definition_query: str):
+    fingerprint = hashlib.sha1()
+    fingerprint.update(fc_path.upper().encode("utf-8"))
+    fingerprint.update(definition_query.encode("utf-8"))
+    where_clause = definition_query if definition_query != "" else None
 
-    # Repoint Style Path to unzipped folder
-    style_file_path = f"{style_folder}\\p12\\resources\\styles\\root.json"
+    desc = arcpy.Describe(fc_path)
+    for field in desc.fields:
+        fingerprint.update(f"{field.name}|{field.type}|{field.length}".encode("utf-8"))
 
-    # Edit paths in style file
-    if "arcgis" in usf_portal_url:
-        style_target_portal = f"https://tiles.arcgis.com/tiles/{agol_id}/arcgis/rest/services/"
+    # Rows are counted in the cursor that reads them, the count is only asked for when no rows are read
+    row_count = 0
+    edit_field = None
+    if getattr(desc, "editorTrackingEnabled", False):
+        edit_field = desc.editedAtFieldName
+    if edit_field:
+        # Rows without an edit date are counted on their own and left out of the latest edit date, Oracle sorts
+        # nulls first in a descending order
+        row_filter = f"({where_clause}) AND " if where_clause else ""
+        with arcpy.da.SearchCursor(fc_path, [edit_field], f"{row_filter}{edit_field} IS NULL") as cursor:
+            unedited_count = sum(1 for row in cursor)
+        fingerprint.update(f"{unedited_count} unedited".encode("utf-8"))
+        row_count = int(arcpy.GetCount_management(fc_path).getOutput(0)) if where_clause is None else unedited_count
+        latest_edit = None
+        with arcpy.da.SearchCursor(fc_path, [edit_field], f"{row_filter}{edit_field} IS NOT NULL",
+                                   sql_clause=(None, f"ORDER BY {edit_field} DESC")) as cursor:
+            for row in cursor:
+                if latest_edit is None:
+                    latest_edit = row[0]
+                    fingerprint.update(str(latest_edit).encode("utf-8"))
+                if where_clause is None:
+                    break
+                row_count += 1
     else:
-        style_target_portal = f"https://{usf_portal_url}/server/rest/services/Hosted/"
-    service_path = style_target_portal + usf_pckg_name
+        # Without editor tracking every row is hashed, shapes included
+        fields = ["OID@", "*"]
+        if hasattr(desc, "shapeType"):
+            fields.append("SHAPE@WKB")
+        with arcpy.da.SearchCursor(fc_path, fields, where_clause,
+                                   sql_clause=(None, f"ORDER BY {desc.OIDFieldName}")) as cursor:
+            for row in cursor:
+                fingerprint.update(repr(row).encode("utf-8"))
+                row_count += 1
+    fingerprint.update(str(row_count).encode("utf-8"))
 
-    # Write changes to Style File
-    with open(style_file_path, "r") as style_file_edits:
-        data = json.load(style_file_edits)
-    data["sprite"] = f"{service_path}/VectorTileServer/resources/styles/../sprites/sprite"
-    data["glyphs"] = service_path + "/VectorTileServer/resources/styles/../fonts/{fontstack}/{range}.pbf"
-    data["sources"]["esri"]["url"] = f"{service_path}/VectorTileServer"
-    with open(style_file_path, "w") as style_file_edits:
-        json.dump(data, style_file_edits)
+    return fingerprint.hexdigest(), row_count
 
-    # Update Style File in final_service
-    if not style_service:
-        style_service = usf_final_service.copy(style_service_name)
-    try:
-        style_service.resources.add(file=style_file_path, folder_name="styles", file_name="root.json")
-    except:
-        style_service.resources.update(file=style_file_path, folder_name="styles", file_name="root.json")
 
-    write_to_log(log_file, f"Style Service: {style_service.homepage}.", True, cur_log_file_path)
+# Fingerprint every copied layer of a project, with the fields extracted from it when fields are pruned
+# Returns {layer long name: fingerprint}, {layer long name: row count}
+# Layers that could not be fingerprinted are left out so they are always rebuilt
+def fingerprint_project(project_path: str, keep_fields: dict = None):
+    fingerprints = {}
+    row_counts = {}
+    prj = arcpy.mp.ArcGISProject(project_path)
+    for lyr in prj.listMaps()[0].listLayers():
+        try:
+            layer_source = get_layer_source(lyr)
+            if layer_source:
+                fc_path, fc_name, definition_query, connectionProperties = layer_source
+                fingerprints[lyr.longName], row_counts[lyr.longName] = get_source_fingerprint(fc_path,
+                                                                                             definition_query)
+                field_names = get_layer_fields(lyr, fc_path, definition_query, keep_fields)
+                if field_names is not None:
+                    fingerprints[lyr.longName] = hashlib.sha1(f"{fingerprints[lyr.longName]}|"
+                                                              f"{'|'.join(field_names)}".encode("utf-8")).hexdigest()
+        except Exception:
+            continue
+    del prj
+    return fingerprints, row_counts
 
 
-# Publish/Update Hosted Feature Service
-def hosted_feature_update(init_dict):
+# Read the last publish state of a service from the state store
+def read_service_state(service_name: str):
+    state_file = os.path.join(state_path, f"{service_name}.json")
+    if not os.path.exists(state_file):
+        return {}
     try:
-        final_result = 0
-        service_name = init_dict['SERVICENAME']
-        service_id = init_dict['SERVICEID']
-        folder_name = init_dict['FOLDERNAME']
-        project_path = init_dict['APRX']
-        tags = init_dict['TAGS']
-        description = init_dict['DESCRIPTION']
-        copy_data = init_dict['COPYDATA']
-        editing = init_dict['EDITING']
-        exporting = init_dict['EXPORTING']
-        sync = init_dict['SYNC']
-        everyone = init_dict['EVERYONE']
-        org = init_dict['ORG']
-        groups = init_dict['GROUPS']
-        portal_url = init_dict['PORTALURL']
-        admin_user = init_dict['ADMINUSER']
-        admin_pass = init_dict['ADMINPASS']
-        
-        # Set sharing options
-        shrOrg = True if org.upper() == 'TRUE' else False
-        shrEveryone = True if everyone.upper() == 'TRUE' else False
-        groups = None if groups.upper() == "NONE" else [group.strip() for group in groups.split(',')]
-        folder_name = None if folder_name.upper() == "NONE" else folder_name
-        copy_data = True if copy_data.upper() == 'TRUE' else False
-        editing = True if editing.upper() == "TRUE" else False
-        exporting = True if exporting.upper() == 'TRUE' else False
-        sync = True if sync.upper() == 'TRUE' else False
-        
-        # Declare paths
-        # Set up Portal connection
-        if "arcgis" in portal_url:
-            target_portal = f"https://{portal_url}"
-        else:
-            target_portal = f"https://{portal_url}/portal"
-        aprx_name = f"{service_name}.aprx"
-        gdb_dir = os.path.join(local_data_path, f"{service_name}_data")
-        aprx_path = os.path.join(local_data_path, aprx_name)
+        with open(state_file, "r") as state_reader:
+            return json.load(state_reader)
+    except Exception:
+        return {}
 
-        if rebuild_data:
-            # Delete old data
-            if os.path.exists(gdb_dir):
-                shutil.rmtree(gdb_dir)
-            os.makedirs(gdb_dir)
-        
-        write_to_log(log_file, "BEGIN", True, cur_log_file_path)
 
-        # Stage Multiprocessing Manager
-        m = mp.Manager()
-        fc_relationships = m.dict()
-        
-        write_to_log(log_file, f"Source Project: {project_path}", False, cur_log_file_path)
+# Write the publish state of a service to the state store
+def write_service_state(service_name: str, state: dict):
+    state_file = os.path.join(state_path, f"{service_name}.json")
+    temp_state_file = f"{state_file}.{os.getpid()}.tmp"
+    with open(temp_state_file, "w") as state_writer:
+        json.dump(state, state_writer)
+    os.replace(temp_state_file, state_file)
 
-        if rebuild_data:
-            # Delete/Copy Local Project for refresh
-            if os.path.exists(aprx_path):
-                os.remove(aprx_path)
-            shutil.copy(project_path, aprx_path)
 
-            proc_count = int(mp.cpu_count() / 2)
-            if debug or proc_count == 1:
-                save_to_gdb_aprx([0, service_name, 1, fc_relationships, log_file, local_data_path, aprx_path,
-                                  cur_log_file_path])
-            else:
-                write_to_log(log_file, "Preprocessing layers with Multiprocessing", False)
-                write_to_log(log_file, f"{proc_count} usable cores", False)
-
-                # Get Create copies of all feature classes into local GDBs
-                with mp.Pool(processes=proc_count, initializer=init_sources) as pool:
-                    for i in pool.imap_unordered(save_to_gdb_aprx,
-                                                 [(proc_num, service_name, proc_count, fc_relationships,
-                                                   log_file, local_data_path, aprx_path, cur_log_file_path)
-                                                  for proc_num in range(0, proc_count)]):
-                        if i == 1:
-                            final_result = 1
+# True when the project and every layer fingerprint match the last successful publish
+def is_unchanged(prior_state: dict, fingerprints: dict, project_hash: str):
+    if not prior_state.get("published") or not fingerprints or prior_state.get("project") != project_hash:
+        return False
+    prior_layers = prior_state.get("layers", {})
+    if set(prior_layers.keys()) != set(fingerprints.keys()):
+        return False
+    for layer_key in fingerprints:
+        if prior_layers[layer_key].get("fingerprint") != fingerprints[layer_key]:
+            return False
+    return True
 
-            write_to_log(log_file, f"Making Changes to: {aprx_path}", True)
 
-            layers = []
-            proj = arcpy.mp.ArcGISProject(aprx_path)
-            mapprj = proj.listMaps()[0]
-            aprx_layer_list = mapprj.listLayers()
-            for lyr in aprx_layer_list:
-                try:
-                    layers.append(str(lyr))
-                except Exception:
-                    continue
-            del proj
+# Path of a checkpoint journal, the run's own or a service's
+def get_journal_path(journal_name: str):
+    return os.path.join(state_path, "journal", f"{journal_name}.json")
 
-            # Update all layers in Project to point to local GDBs
-            if debug or proc_count == 1:
-                update_project([0, fc_relationships, aprx_path, layers, log_file, proc_count, cur_log_file_path])
-            else:
-                lock = mp.Lock()
-                with mp.Pool(processes=proc_count, initializer=init_lock, initargs=(lock,)) as pool:
-                    for i in pool.imap_unordered(update_project,
-                                                 [(proc_num, fc_relationships, aprx_path, layers, log_file,
-                                                   proc_count, cur_log_file_path)
-                                                  for proc_num in range(0, proc_count)]):
-                        if i == 1:
-                            final_result = 1
 
-        write_to_log(log_file, "Publishing Project to Portal", True, cur_log_file_path)
-        write_to_log(log_file, f"Connecting to {portal_url} as {admin_user}.", False, cur_log_file_path)
+# Read a checkpoint journal, None when there is none or it cannot be read
+def read_journal(journal_name: str):
+    journal_file = get_journal_path(journal_name)
+    if not os.path.exists(journal_file):
+        return None
+    try:
+        with open(journal_file, "r") as journal_reader:
+            return json.load(journal_reader)
+    except Exception:
+        return None
 
-        arcpy.SignInToPortal(target_portal, admin_user, admin_pass)
 
-        # Open Project for editing
-        prj = arcpy.mp.ArcGISProject(aprx_path)
-        mapprj = prj.listMaps()[0]
+# Write a checkpoint journal to disk before replacing the last one, so a crash leaves one or the other whole
+def write_journal(journal_name: str, journal: dict):
+    journal_file = get_journal_path(journal_name)
+    os.makedirs(os.path.dirname(journal_file), exist_ok=True)
+    temp_journal_file = f"{journal_file}.{os.getpid()}.tmp"
+    with open(temp_journal_file, "w") as journal_writer:
+        json.dump(journal, journal_writer)
+        journal_writer.flush()
+        os.fsync(journal_writer.fileno())
+    os.replace(temp_journal_file, journal_file)
 
-        write_to_log(log_file, "Creating Service Definition", True, cur_log_file_path)
 
-        sd_name = f"{service_name}_{month_day_year}"
-        sd_name_sddraft = f"{sd_name}.sddraft"
-        sd_name_sd = f"{sd_name}.sd"
-        sd_name_sddraft_path = os.path.join(local_data_path, sd_name_sddraft)
-        sd_name_sd_path = os.path.join(local_data_path, sd_name_sd)
+# Start this run's journal, or take up the journal of an interrupted run when resuming
+# Returns True when an interrupted run is being resumed
+def start_run_journal():
+    global run_journal
+    journal = read_journal("run")
+    if journal is not None and not journal.get("completed"):
+        if config["checkpoints"]["resume"]:
+            run_journal = journal
+            write_to_log(log_file, f"Resuming run {journal['run']}", True)
+            return True
+        write_to_log(log_file, f"Run {journal['run']} did not finish, starting over (--resume continues it)", True)
+    elif config["checkpoints"]["resume"]:
+        write_to_log(log_file, "No interrupted run to resume, starting a new run", True)
+    shutil.rmtree(os.path.dirname(get_journal_path("run")), ignore_errors=True)
+    run_journal = {"run": trace_run_id, "stages": [], "completed": False}
+    write_journal("run", run_journal)
+    return False
 
-        if rebuild_data:
-            # Create SDDraft, delete if exists
-            if os.path.exists(sd_name_sddraft_path):
-                os.remove(sd_name_sddraft_path)
-            if os.path.exists(sd_name_sd_path):
-                os.remove(sd_name_sd_path)
-
-            sharing_draft = mapprj.getWebLayerSharingDraft("HOSTING_SERVER", "FEATURE", service_name)
-            sharing_draft.tags = tags
-            sharing_draft.description = description
-            sharing_draft.allowExporting = exporting
-            sharing_draft.overwriteExistingService = True
-            sharing_draft.portalFolder = folder_name
-
-            # Create Service Definition Draft file
-            sharing_draft.exportToSDDraft(sd_name_sddraft_path)
-
-            # Stage Service SDDraft -> SD file
-            write_to_log(log_file, "Finalizing Service (.sddraft to .sd)", True)
-            try:
-                arcpy.StageService_server(sd_name_sddraft_path, sd_name_sd_path)
-            except Exception:
-                arcpy.StageService_server(sd_name_sddraft_path, sd_name_sd_path)
 
-            # Delete SDDraft
-            if os.path.exists(sd_name_sddraft_path):
-                os.remove(sd_name_sddraft_path)
+# True when this run, or the interrupted run it resumes, finished a run stage
+def run_stage_done(stage: str):
+    return stage in run_journal["stages"]
 
-        # Sign into portal
-        gis = GIS(target_portal, admin_user, admin_pass)
-        write_to_log(log_file, f"Active Portal: {gis.url}", True, cur_log_file_path)
-        
-        # Delete Service Definition if Exists
-        search_query = f"title:{sd_name} AND owner:{admin_user}"
-        for item in gis.content.search(search_query, item_type="Service Definition"):
-            if item.title == sd_name and item:
-                try:
-                    item.delete()
-                except Exception:
-                    item.delete()
 
-        # Add Service Definition to Portal
-        sdItem = None
-        write_to_log(log_file, "Adding Service Definition to Portal", True, cur_log_file_path)
-        while not gis.content.search(search_query, item_type="Service Definition"):
-            try:
-                sdItem = gis.content.add(item_properties={'type': "Service Definition"}, data=sd_name_sd_path,
-                                         folder=folder_name)
-            except Exception as e:
-                pass
+# Record a finished run stage
+def complete_run_stage(stage: str):
+    run_journal["stages"].append(stage)
+    write_journal("run", run_journal)
 
-        if not sdItem:
-            sdItem = gis.content.search(search_query, item_type="Service Definition")[0]
 
-        # Clean up Data Connections
-        del prj
+# Record that the run finished, there is nothing left to resume
+def complete_run_journal():
+    run_journal["completed"] = True
+    write_journal("run", run_journal)
 
-        # Publish Feature Service
-        feature_service = publish_as_overwrite_feature_service(service_id, service_name, gis, log_file,
-                                                               cur_log_file_path, sdItem)
-        # Update Share Settings
-        if feature_service:
-            try:
-                feature_service.share(org=shrOrg, everyone=shrEveryone, groups=groups)
-            except Exception as e:
-                time.sleep(60)  # Give time if portal is lagging
-                feature_service.share(org=shrOrg, everyone=shrEveryone, groups=groups)
-        else:
-            write_to_log(log_file, "ERROR: Failed to publish service", False, cur_log_file_path)
-            return 1
 
-        # Update Feature Service Title
-        try:
-            feature_service.update(item_properties={"title": service_name})
-        except Exception as e:
-            time.sleep(60)  # Give time if portal is lagging
-            feature_service.update(item_properties={"title": service_name})
+# Start the journal of a service; when resuming, the checkpoints of the interrupted run are kept to be confirmed
+# Returns True when the service finished in the interrupted run
+def start_service_journal(service_name: str, init_dict: dict):
+    global service_journal, service_journal_position
+    service_journal_position = 0
+    journal = read_journal(service_name) if init_dict.get('RESUME', "False").upper() == 'TRUE' else None
+    if journal is not None and journal.get("result") == 0:
+        service_journal = journal
+        return True
+    service_journal = {"service": service_name, "stages": journal["stages"] if journal else [], "result": None}
+    write_journal(service_name, service_journal)
+    return False
 
-        write_to_log(log_file, f"Feature Service URL: {feature_service.homepage}.", False, cur_log_file_path)
-        write_to_log(log_file, "Feature Service Published.", True, cur_log_file_path)
-        return final_result
 
-    except Exception as e:
-        throw_exception(log_file, "", cur_log_file_path)
-        return 1
+# Take up the journal of a service whose earlier stage ran in another process, after the checkpoints that stage
+# confirmed or made
+def continue_service_journal(service_name: str, position: int):
+    global service_journal, service_journal_position
+    service_journal = read_journal(service_name) or {"service": service_name, "stages": [], "result": None}
+    service_journal_position = min(position, len(service_journal["stages"]))
 
 
-# Overwrite the underlying data in the target Feature service
-def publish_as_overwrite_feature_service(pofs_service_id: str, pofs_service_name: str, pofs_gis, pofs_log_file: str,
-                                         pofs_cur_log_file_path: str, pofs_sd_item):
-    feature_service = None
+# Record how the service ended
+def finish_service_journal(result: int):
+    service_journal["result"] = result
+    write_journal(service_journal["service"], service_journal)
 
-    # Toggle Search by ID or Search by Title
-    search_by_id = False
-    if pofs_service_id.upper() != 'NONE':
-        search_by_id = True
-        search_query = "id:{0}".format(pofs_service_id)
-    else:
-        search_query = "title:{0} OR name:{0}".format(pofs_service_name)
 
-    # Make sure that there's a Feature Service to replace
-    replace_sdItem = None
-    publish_params = {"title": pofs_service_name}
-    if search_by_id:
-        replace_sdItem = pofs_gis.content.search(search_query, item_type="Feature Service")[0]
-    if not replace_sdItem:
-        print(f"Searching for matching titles... current search: {pofs_service_name}")
-        for item in pofs_gis.content.search(search_query, item_type="Feature Service"):
-            if (item.title == pofs_service_name or item.title == pofs_sd_item.title) and item and not replace_sdItem:
-                replace_sdItem = item
-    if replace_sdItem:
-        write_to_log(pofs_log_file, "To Be Replaced Service: {0}".format(replace_sdItem.homepage), False,
-                     pofs_cur_log_file_path)
-        write_to_log(pofs_log_file, "Overwriting Feature Service", True, pofs_cur_log_file_path)
-        try:
-            feature_service = pofs_sd_item.publish(overwrite=True, file_type='serviceDefinition')
-            tries = 30
-        except Exception as e:
-            throw_exception(pofs_log_file, "", pofs_cur_log_file_path)
-    else:
-        feature_service = publish_as_new_feature_service(pofs_sd_item, pofs_log_file, pofs_cur_log_file_path)
+# Artifacts of a stage the interrupted run finished, when it is the next stage checkpointed and verify confirms
+# its artifacts are intact; otherwise None and the stage is done again, along with every stage after it
+def resume_stage(stage: str, verify):
+    global service_journal_position
+    stages = service_journal["stages"]
+    if service_journal_position >= len(stages) or stages[service_journal_position][0] != stage:
+        return None
+    artifacts = stages[service_journal_position][1]
+    try:
+        intact = verify(artifacts)
+    except Exception:
+        intact = False
+    if not intact:
+        write_to_log(log_file, f"Checkpoint {stage} of the interrupted run is not intact, doing it again", True,
+                     cur_log_file_path)
+        del stages[service_journal_position:]
+        write_journal(service_journal["service"], service_journal)
+        return None
+    write_to_log(log_file, f"Resumed from checkpoint: {stage}", True, cur_log_file_path)
+    service_journal_position += 1
+    return artifacts
 
-    return feature_service
 
+# Record a finished stage of the service and the artifacts it left, replacing any later checkpoints
+def checkpoint(stage: str, artifacts: dict):
+    global service_journal_position
+    del service_journal["stages"][service_journal_position:]
+    service_journal["stages"].append([stage, artifacts])
+    service_journal_position += 1
+    write_journal(service_journal["service"], service_journal)
 
-# Publish a new feature service
-def publish_as_new_feature_service(pnfs_sdItem, pnfs_log: str, pnfs_curlog: str):
-    write_to_log(pnfs_log, "Publishing Feature Service", True, pnfs_curlog)
-    pnfs_feature_service = None
-    try:
-        pnfs_feature_service = pnfs_sdItem.publish(file_type='serviceDefinition')
-    except Exception as e:
-        time.sleep(60)  # Give time if portal is lagging
-        pnfs_feature_service = pnfs_sdItem.publish(file_type='serviceDefinition')
-    return pnfs_feature_service
 
+# Checkpoint artifact of a file: its path, size and modified time
+def get_file_artifact(file_path: str):
+    return {"path": file_path, "size": os.path.getsize(file_path), "mtime": os.path.getmtime(file_path)}
 
-# Save layers in service to local file geodatabase
-def save_to_gdb_aprx(args):
-    global spuuser, gisuser, gisuserimgp
-    
-    increment = args[0]
-    cur_service_name = args[1]
-    cur_proc_count = args[2]
-    cur_fc_relationships = args[3]
-    cur_logFile = args[4]
-    cur_data_path = args[5]
-    cur_aprx_path = args[6]
-    currentLogFilePath = args[7]
-    cur_layer = ""
-    
-    try:
-        cur_gdb_dir = os.path.join(cur_data_path, f"{cur_service_name}_data")
-        gdb_name = f"{cur_service_name}_{increment}.gdb"
-        gdb_path = os.path.join(cur_gdb_dir, gdb_name)
-        arcpy.CreateFileGDB_management(cur_gdb_dir, gdb_name)
-        
-        # Get working projects
-        replacement_prj = arcpy.mp.ArcGISProject(cur_aprx_path)
-        
-        # Pull Map
-        replacement_mp = replacement_prj.listMaps()[0]
-        
-        # Pull Layers
-        layer_list = replacement_mp.listLayers()
-        layer_list_length = len(layer_list)
-        # To account for the number of processes, to make sure the range gets all the layers
-        range_length = layer_list_length + (layer_list_length % cur_proc_count)
-        
-        for i in range(0, range_length, cur_proc_count):
-            index = i + increment
-            if index < layer_list_length:
-                cur_layer = layer_list[index]
-                if cur_layer.isGroupLayer is False:
-                    cont = True
-                    try:
-                        if cur_layer.isFeatureLayer:
-                            cont = True
-                    except Exception:
-                        cont = False
-                    if cont is True:
-                        if cur_layer.isBasemapLayer is False and cur_layer.isWebLayer is False:
-                            # Make local copy of gdb with filtered results
-                            definition_query = ""
-                            if cur_layer.supports("DEFINITIONQUERY") and \
-                                    len(cur_layer.definitionQuery) > 0 and \
-                                    cur_layer.definitionQuery != "":
-                                definition_query = cur_layer.definitionQuery
-                            if cur_layer.connectionProperties:
-                                connectionProperties = cur_layer.connectionProperties
-                                if connectionProperties['connection_info']:
-                                    if 'user' in connectionProperties['connection_info']:
-                                        user = connectionProperties['connection_info']['user']
-                                        dataset = connectionProperties['dataset']
-                                        datasource = cur_layer.dataSource
-                                        if len(datasource) > 150:
-                                            time.sleep(2)
-                                            datasource = cur_layer.dataSource
-                                        datasource_dict = {}
-                                        ds_config = datasource.split(',')
-                                        for conn_string in ds_config:
-                                            ds_key_value = conn_string.split('=')
-                                            try:
-                                                datasource_dict[ds_key_value[0].upper()] = ds_key_value[1]
-                                            except:
-                                                pass
-                                        try:
-                                            edit_dataset = datasource_dict["DATASET"]
-                                        except:
-                                            edit_dataset = datasource[datasource.rfind("\\") + 1:]
-                                        server = connectionProperties['connection_info']['server']
-                                        instance = connectionProperties['connection_info']['instance']
-                                        if user == 'gisuser' and (server == 'spugisp.world'
-                                                                  or instance == 'sde:oracle$sde:oracle11g:spugisp'
-                                                                  or instance == 'sde:oracle$sde:oracle11g:spugisp.world'):
-                                            sde_conn = gisuser
-                                        elif user == 'spuuser' and (server == 'spugisp.world'
-                                                                    or instance == 'sde:oracle$sde:oracle11g:spugisp'
-                                                                    or instance == 'sde:oracle$sde:oracle11g:spugisp.world'):
-                                            sde_conn = spuuser
-                                        elif user == 'crw' and (server == 'spugisp.world'
-                                                                or instance == 'sde:oracle$sde:oracle11g:spugisp'
-                                                                or instance == 'sde:oracle$sde:oracle11g:spugisp.world'):
-                                            sde_conn = crw_spugis
-                                        elif user == 'gisuser' and server == 'spuimgp.world':
-                                            sde_conn = gisuserimgp
-                                        elif user == 'crw' and 'shedsded' in instance:
-                                            sde_conn = crw_dev
-                                        elif user == 'crw' and 'shedsdet' in instance:
-                                            sde_conn = crw_test
-                                        elif user == 'crw':
-                                            sde_conn = crw_prod
-                                        else:
-                                            sde_conn = None
-
-                                        if sde_conn:
-                                            sde_conn_path = os.path.join(local_path, sde_conn)
-                                            if "FEATURE DATASET" in datasource_dict:
-                                                sde_conn_path = os.path.join(sde_conn_path,
-                                                                             datasource_dict["FEATURE DATASET"])
-                                            fc_path = os.path.join(sde_conn_path, edit_dataset)
-
-                                            split_dataset = edit_dataset.split('.')
-                                            
-                                            if "\\" in edit_dataset:
-                                                schema = split_dataset[1][(split_dataset[1].find("\\") + 1):]
-                                                fc_name = split_dataset[2]
-                                            else:
-                                                schema = split_dataset[0]
-                                                fc_name = split_dataset[1]
-                                            
-                                            # Get FC Name
-                                            try:
-                                                while fc_name in cur_fc_relationships:
-                                                    fc_name = f"{fc_name}_1"
-                                                cur_fc_relationships[fc_name] = []
-                                                temp_dict = cur_fc_relationships[fc_name]
-                                                newConnectionProperties = {
-                                                    'dataset': fc_name,
-                                                    'workspace_factory': "File Geodatabase",
-                                                    'connection_info': {'database': f'{gdb_path}'}}
-                                                temp_dict.append(json.dumps(newConnectionProperties))
-                                                temp_dict.append(str(cur_layer))
-                                                temp_dict.append(json.dumps(connectionProperties))
-                                                cur_fc_relationships[fc_name] = temp_dict
-                                            
-                                            except Exception:
-                                                throw_exception(cur_logFile, str(cur_layer), currentLogFilePath)
-                                            
-                                            # Save FC to local GDB
-                                            try:
-                                                if fc_name != "GATES":  # TODO FIX GATES
-                                                    arcpy.FeatureClassToFeatureClass_conversion(fc_path, gdb_path, fc_name,
-                                                                                                where_clause=definition_query)
-                                                    write_to_log(cur_logFile, f"{cur_layer} source changed to {fc_name} in {gdb_name}.")
-                                            except Exception:
-                                                throw_exception(cur_logFile, str(cur_layer), currentLogFilePath)
-                                    
-                                        else:
-                                            write_to_log(cur_logFile,
-                                                       f"{dataset} path unfound for {cur_layer}.")
-                                    else:
-                                        write_to_log(cur_logFile,
-                                                   f"POTENTIAL ERROR: {cur_layer} has no valid 'user' connection info.")
-                                else:
-                                    write_to_log(cur_logFile,
-                                               f"POTENTIAL ERROR: {cur_layer} has no valid connection info.")
-                        else:
-                            write_to_log(cur_logFile,
-                                       f"{cur_layer} is a Basemap/Web Layer.")
-                else:
-                    write_to_log(cur_logFile, f"{cur_layer} is a Group Layer.")
-        
-        write_to_log(cur_logFile, f"[Process {increment}]: Complete", True)
-        del replacement_prj
-        cur_layer = ""
-        return 0
-    
-    except Exception:
-        throw_exception(cur_logFile, cur_layer, currentLogFilePath)
-        return 1
+
+# True when a file checkpoint artifact is still the same file
+def file_intact(artifact: dict):
+    return os.path.exists(artifact["path"]) and os.path.getsize(artifact["path"]) == artifact["size"] and \
+        os.path.getmtime(artifact["path"]) == artifact["mtime"]
+
+
+# True when every layer extract of an extracted checkpoint is still in its GDB
+def extracts_intact(artifacts: dict):
+    return all(arcpy.Exists(os.path.join(layer["gdb_path"], layer["fc_name"])) for layer in artifacts["layers"]
+               if layer["gdb_path"])
 
 
 # Update .aprx project layers to point to new datasets in local file geodatabase
-def update_project(args):
+# Opens the project once, repoints every layer found through an index by layer name, then saves once
+def update_project(layer_manifests: list, aprx_path: str, logFile: str, currentLogFilePath: str):
     final_result = 0
-    
-    proc_num = args[0]
-    fc_relationships = args[1]
-    aprx_path = args[2]
-    layers = args[3]
-    logFile = args[4]
-    proc_count = args[5]
-    currentLogFilePath = args[6]
-    index = 0
-    threshold = len(layers) / proc_count
-    lower_bounds = threshold * proc_num
-    upper_bounds = lower_bounds + threshold
-    
+
     try:
-        # Update layer datasource in project
-        for fc in fc_relationships.keys():
-            if lower_bounds <= index < upper_bounds:
-                cur_layer = fc_relationships[fc][1]
-                old_connectionprop = json.loads(fc_relationships[fc][2])
-                new_connectionprop = json.loads(fc_relationships[fc][0])
-                
-                lyr_index = -1
-                for ind in range(0, len(layers)):
-                    layer = layers[ind]
-                    if layer == str(cur_layer):
-                        lyr_index = ind
-                
-                if lyr_index > -1:
-                    try:
-                        if proc_count > 1:
-                            lock.acquire()  # Only let one process open the ArcPro Project at a time
-                        proj = arcpy.mp.ArcGISProject(aprx_path)
-                        mapprj = proj.listMaps()[0]
-                        aprx_layer_list = mapprj.listLayers()
-                        replace_layer = aprx_layer_list[lyr_index]
-                        connectionProperties = replace_layer.connectionProperties
-                        if connectionProperties['connection_info']:
-                            if 'user' in connectionProperties['connection_info']:
-                                replace_layer.updateConnectionProperties(old_connectionprop, new_connectionprop)
-                                replace_layer.definitionQuery = ""
-                                if replace_layer.connectionProperties['dataset'] == new_connectionprop['dataset']:
-                                    write_to_log(logFile,
-                                               f"{replace_layer} successfully repointed to {new_connectionprop['dataset']}.")
-                                else:
-                                    write_to_log(logFile,
-                                               f"POTENTIAL ERROR: {replace_layer} failed to repoint.", False)
-                                    old_conn_props = replace_layer.connectionProperties['dataset']
-                                    write_to_log(logFile,
-                                               f"POTENTIAL ERROR: Old Connection Properties: {old_conn_props}.", False)
-                                    write_to_log(logFile, f"POTENTIAL ERROR: New Connection Properties: {new_connectionprop['dataset']}.", False)
-                            else:
-                                write_to_log(logFile, f"POTENTIAL ERROR: {replace_layer} Skipped Repoint.", False)
-                        else:
-                            write_to_log(logFile, f"POTENTIAL ERROR: {replace_layer} Skipped Repoint.", False)
-                            
-                        proj.save()
-                        del proj
-                    
-                    except Exception:
-                        throw_exception(logFile, "", currentLogFilePath)
-                        final_result = 1
-                    
-                    finally:
-                        if proc_count > 1:
-                            lock.release()
-                
+        proj = arcpy.mp.ArcGISProject(aprx_path)
+        mapprj = proj.listMaps()[0]
+        layer_index = {}
+        for lyr in mapprj.listLayers():
+            try:
+                layer_index[lyr.longName] = lyr
+            except Exception:
+                continue
+
+        repointed = 0
+        for manifest in layer_manifests:
+            cur_layer = manifest.layer_name
+            replace_layer = layer_index.get(manifest.layer_key)
+            if replace_layer is None or manifest.gdb_path is None:
+                write_to_log(logFile, f"{cur_layer} is INVALID.", False, currentLogFilePath)
+                continue
+
+            new_connectionprop = {
+                'dataset': manifest.fc_name,
+                'workspace_factory': "File Geodatabase",
+                'connection_info': {'database': manifest.gdb_path}}
+            old_connectionprop = manifest.source_connection
+            try:
+                connectionProperties = replace_layer.connectionProperties
+                if connectionProperties['connection_info'] and 'user' in connectionProperties['connection_info']:
+                    replace_layer.updateConnectionProperties(old_connectionprop, new_connectionprop)
+                    replace_layer.definitionQuery = ""
+
+                    # Validate the repoint
+                    if replace_layer.connectionProperties['dataset'] == new_connectionprop['dataset']:
+                        repointed += 1
+                        write_to_log(logFile,
+                                     f"{replace_layer} successfully repointed to {new_connectionprop['dataset']}.")
+                    else:
+                        write_to_log(logFile, f"POTENTIAL ERROR: {replace_layer} failed to repoint.", False)
+                        old_conn_props = replace_layer.connectionProperties['dataset']
+                        write_to_log(logFile, f"POTENTIAL ERROR: Old Connection Properties: {old_conn_props}.", False)
+                        write_to_log(logFile, f"POTENTIAL ERROR: New Connection Properties: "
+                                              f"{new_connectionprop['dataset']}.", False)
                 else:
-                    write_to_log(logFile, f"{cur_layer} is INVALID.", False, currentLogFilePath)
-            
-            index += 1
-        
-        write_to_log(logFile, f"[Process {proc_num}]: Complete", True)
+                    write_to_log(logFile, f"POTENTIAL ERROR: {replace_layer} Skipped Repoint.", False)
+
+            except Exception:
+                throw_exception(logFile, str(cur_layer), currentLogFilePath)
+                final_result = 1
+
+        proj.save()
+        del proj
+        write_to_log(logFile, f"{repointed} of {len(layer_manifests)} layers repointed", True, currentLogFilePath)
         return final_result
-    
+
     except Exception:
         throw_exception(logFile, "", currentLogFilePath)
         return 1
 
 
-# Initialize lock for multiprocessing
-def init_lock(l):
-    global lock
-    lock = l
+# Initialize a pool worker with the global variables, the log writer queue, the service it traces for and,
+# when that service is profiled, the folder for the worker's profile
+def init_worker(cur_log_queue=None, cur_trace_service=None, cur_profile_folder=None):
+    global trace_service, profile_folder, worker_profiler
+    init_sources()
+    init_logging(cur_log_queue)
+    trace_service = cur_trace_service
+    profile_folder = cur_profile_folder
+    worker_profiler = cProfile.Profile() if cur_profile_folder else None
     
 
+# Time a stage and record it as a span when the block ends, the block may add attributes to the yielded dict
+@contextlib.contextmanager
+def trace_span(stage: str, layer: str = None, **attributes):
+    start = time.time()
+    start_monotonic = time.monotonic()
+    status = "ok"
+    try:
+        yield attributes
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        write_span(stage, start, time.monotonic() - start_monotonic, status, layer, attributes)
+
+
+# Write a span to this run's trace file, through the log writer once it is running
+def write_span(stage: str, start: float, seconds: float, status: str, layer: str = None, attributes: dict = None):
+    if not config["tracing"]["spans"] or trace_file is None:
+        return
+    span = {"run": trace_run_id, "stage": stage, "service": trace_service, "layer": layer,
+            "process": mp.current_process().name, "pid": os.getpid(), "start": round(start, 3),
+            "seconds": round(seconds, 4), "status": status}
+    span.update(attributes or {})
+    line = json.dumps(span, default=str) + "\n"
+    if log_queue is not None:
+        log_queue.put((trace_file, line, None, False))
+    else:
+        with open(trace_file, 'a') as trace_writer:
+            trace_writer.write(line)
+
+
+# Write this run's spans, summed by stage and service, as a Prometheus textfile
+# The file is replaced in one step so a collector never reads half of it
+def write_run_metrics():
+    if not config["tracing"]["spans"] or trace_file is None or not os.path.exists(trace_file):
+        return
+    try:
+        stage_totals = {}  # (stage, service): [seconds, spans, errors]
+        run_span = None
+        with open(trace_file, 'r') as trace_reader:
+            for line in trace_reader:
+                try:
+                    span = json.loads(line)
+                except ValueError:
+                    continue  # Cut short by a worker that crashed
+                if span.get("run") != trace_run_id:
+                    continue
+                if span["stage"] == "run":
+                    run_span = span
+                    continue
+                totals = stage_totals.setdefault((span["stage"], span.get("service") or ""), [0.0, 0, 0])
+                totals[0] += span["seconds"]
+                totals[1] += 1
+                totals[2] += 1 if span["status"] != "ok" else 0
+
+        lines = ["# HELP portal_update_stage_seconds Seconds spent in a stage in the last run, summed over its spans",
+                 "# TYPE portal_update_stage_seconds gauge"]
+        for (stage, service), totals in sorted(stage_totals.items()):
+            lines.append(f'portal_update_stage_seconds{{{get_metric_labels(stage, service)}}} {round(totals[0], 3)}')
+        lines += ["# HELP portal_update_stage_spans Times a stage ran in the last run",
+                  "# TYPE portal_update_stage_spans gauge"]
+        for (stage, service), totals in sorted(stage_totals.items()):
+            lines.append(f'portal_update_stage_spans{{{get_metric_labels(stage, service)}}} {totals[1]}')
+        lines += ["# HELP portal_update_stage_errors Times a stage failed in the last run",
+                  "# TYPE portal_update_stage_errors gauge"]
+        for (stage, service), totals in sorted(stage_totals.items()):
+            lines.append(f'portal_update_stage_errors{{{get_metric_labels(stage, service)}}} {totals[2]}')
+        if run_span is not None:
+            lines += ["# HELP portal_update_run_seconds Wall time of the last run",
+                      "# TYPE portal_update_run_seconds gauge",
+                      f"portal_update_run_seconds {round(run_span['seconds'], 3)}",
+                      "# HELP portal_update_run_services Services in the last run",
+                      "# TYPE portal_update_run_services gauge",
+                      f"portal_update_run_services {run_span.get('services', 0)}",
+                      "# HELP portal_update_run_failed_services Services that failed in the last run",
+                      "# TYPE portal_update_run_failed_services gauge",
+                      f"portal_update_run_failed_services {run_span.get('failed', 0)}",
+                      "# HELP portal_update_last_run_timestamp_seconds Start of the last run",
+                      "# TYPE portal_update_last_run_timestamp_seconds gauge",
+                      f"portal_update_last_run_timestamp_seconds {run_span['start']}"]
+
+        metrics_file = os.path.join(config["tracing"]["metrics_path"] or log_path,
+                                    config["tracing"]["metrics_file_name"])
+        with open(f"{metrics_file}.tmp", 'w') as metrics_writer:
+            metrics_writer.write("\n".join(lines) + "\n")
+        os.replace(f"{metrics_file}.tmp", metrics_file)
+    except Exception:
+        throw_exception(log_file)
+
+
+# Prometheus label set for a stage and service
+def get_metric_labels(stage: str, service: str):
+    escaped = [value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for value in (stage, service)]
+    return f'stage="{escaped[0]}",service="{escaped[1]}"'
+
+
 def throw_exception(log_file: str, layer_name: str = "", temp_log_file=None):
     error = sys.exc_info()[0]
     if layer_name != "":
@@ -987,22 +4071,118 @@ def throw_exception(log_file: str, layer_name: str = "", temp_log_file=None):
     write_to_log(log_file, traceback.format_exc(), False, temp_log_file)
     
 # Logging module for writing to text file
+# Lines go to the log writer process once it is running, otherwise straight to the files
 def write_to_log(logFile: str, message: str, timestamp: bool = False, temp_log_file: str = None):
     if timestamp is True:
         formatted_timestamp = f"{datetime.datetime.now().strftime('%m/%d/%y %I:%M:%S%p')}"
-        with open(logFile, 'a') as log:
-            log.write(f"{message} - {formatted_timestamp}.\n")
-            print(f"{message} - {formatted_timestamp}.")
-        if temp_log_file is not None:
-            with open(temp_log_file, 'a') as tempLog:
-                tempLog.write("{message} - {formatted_timestamp}.\n")
+        line = f"{message} - {formatted_timestamp}.\n"
+    else:
+        line = f"{message}\n"
+
+    if log_queue is not None:
+        # SimpleQueue writes to the pipe before returning, so a crashing worker cannot drop the line
+        log_queue.put((logFile, line, temp_log_file, True))
     else:
         with open(logFile, 'a') as log:
-            log.write(f"{message}\n")
-            print(f"{message}")
+            log.write(line)
+            print(line, end="")
         if temp_log_file is not None:
             with open(temp_log_file, 'a') as tempLog:
-                tempLog.write(f"{message}\n")
+                tempLog.write(line)
+
+
+# Start the log writer process, every process after this logs through its queue
+# The writer is handed the logging settings in force, it does not read settings.ini or the arguments itself
+def start_logging():
+    global log_queue, log_ack_queue, log_process
+    log_queue = mp.SimpleQueue()
+    log_ack_queue = mp.SimpleQueue()
+    log_process = mp.Process(target=log_writer, args=(log_queue, log_ack_queue, dict(config["logging"])),
+                             daemon=True)
+    log_process.start()
+
+
+# Point this process's logging at the log writer queue
+def init_logging(cur_log_queue):
+    global log_queue
+    log_queue = cur_log_queue
+
+
+# Wait until the log writer has written everything sent so far
+def flush_log():
+    if log_queue is not None and log_process is not None:
+        log_queue.put("FLUSH")
+        log_ack_queue.get()
+
+
+# Write everything outstanding and stop the log writer process
+def stop_logging():
+    global log_queue, log_process
+    if log_queue is not None and log_process is not None:
+        log_queue.put(None)
+        log_process.join()
+        log_queue = None
+        log_process = None
+
+
+# Log writer process, batches lines per file and appends each file once per flush
+# Waits on the queue, a timer thread sends "TICK" so buffered lines are written after flush_seconds
+def log_writer(cur_log_queue, cur_log_ack_queue, logging_settings: dict):
+    buffers = {}  # log file path: [lines]
+    echo_lines = []
+    buffered = 0
+    last_flush = time.time()
+
+    def flush():
+        for buffer_path, lines in buffers.items():
+            try:
+                with open(buffer_path, 'a') as log:
+                    log.write("".join(lines))
+            except Exception:
+                print(f"ERROR writing to {buffer_path}")
+                print(traceback.format_exc())
+        buffers.clear()
+        if logging_settings["echo"] and echo_lines:
+            sys.stdout.write("".join(echo_lines))
+            sys.stdout.flush()
+        del echo_lines[:]
+
+    stopped = threading.Event()
+
+    def tick():
+        while not stopped.wait(logging_settings["flush_seconds"]):
+            cur_log_queue.put("TICK")
+
+    threading.Thread(target=tick, daemon=True).start()
+    while True:
+        record = cur_log_queue.get()
+        if record == "TICK":
+            if buffered > 0 and time.time() - last_flush >= logging_settings["flush_seconds"]:
+                flush()
+                buffered = 0
+                last_flush = time.time()
+            continue
+        if record is None or record == "FLUSH":
+            flush()
+            buffered = 0
+            last_flush = time.time()
+            if record is None:
+                stopped.set()
+                break
+            cur_log_ack_queue.put(True)
+            continue
+
+        record_log_file, line, record_temp_log_file, echo = record
+        buffers.setdefault(record_log_file, []).append(line)
+        if echo:
+            echo_lines.append(line)
+        if record_temp_log_file is not None:
+            buffers.setdefault(record_temp_log_file, []).append(line)
+        buffered += 1
+        if buffered >= logging_settings["batch_lines"]:
+            flush()
+            buffered = 0
+            last_flush = time.time()
 
 
 # Send Alert email on success/failure
@@ -1081,4 +4261,10 @@ def delta_time_system_timer(time_as_int):
 
 
 if __name__ == "__main__":
-    main()
+    # Python.py <target folder> --restore <generation|latest> [restore folder]
+    # Python.py <target folder> [--profile] [--resume] [--set section.key=value ...]
+    if len(sys.argv) > 3 and sys.argv[2] == "--restore":
+        init_sources()
+        restore_history_generation(sys.argv[3], sys.argv[4] if len(sys.argv) > 4 else data_path)
+    else:
+        main()
@@ -0,0 +1,1349 @@
+## Version: Python 3.6
+## Description:
+### Benchmark for the Python.py update pipeline without ArcGIS Pro or a live portal
+### Stand-in arcpy and arcgis.gis modules simulate geoprocessing and portal calls with set latencies and file sizes,
+### main() runs against a synthetic list folder of N services with M layers each, and the wall time per stage,
+### process utilization and I/O volume of every run are written as JSON
+### Exits 1 when a run leaves hosted rows unlike their sources or a service's outputs missing from the data folder
+### Usage: Python_benchmark.py [--services N] [--layers M] [--output results.json] [--compare baseline.json]
+
+import os
+import sys
+import json
+import time
+import types
+import re
+import struct
+import zipfile
+import shutil
+import threading
+import platform
+import subprocess
+import argparse
+import uuid
+import urllib.parse
+import urllib.request
+import multiprocessing as mp
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+# Synthetic Services
+bench_services = 4   # Services in the list folder
+bench_vector_tile_services = 1   # How many of those are vector tile services, the rest are feature services
+bench_layers = 10   # Layers in each service's map
+bench_rows = 20000   # Rows in each layer
+bench_row_bytes = 200   # Bytes written per extracted row
+bench_runs = 2   # Runs of main(), runs after the first see only bench_changed_layers changed
+bench_changed_layers = 0.2   # Share of layers changed between runs
+bench_unchanged_runs = 1   # Runs of main() after those, with nothing changed
+bench_changed_rows = 20   # One row in this many changes in a changed layer, and one row is added and one deleted
+bench_delta_key = "ASSET_ID"   # DELTAKEY of the feature services, None publishes them by overwriting
+bench_shared_layers = 0.2   # Share of each service's layers drawing on datasets every service uses
+bench_settings = {"vector_tiles": {"verify_shards": True}}   # Python.py config of the benchmark, shards are checked
+
+# Stand-in Latencies
+read_rows_per_second = 500000   # Rows read by cursors
+extract_rows_per_second = 50000   # Rows copied by FeatureClassToFeatureClass
+copy_mb_per_second = 200   # Copy_management and local copies
+fragment_share = 0.15   # Share of a fresh extract's bytes freed by compacting its GDB
+index_rows_per_second = 200000   # Rows indexed by AddSpatialIndex and AddIndex
+compact_mb_per_second = 100
+stage_seconds = 2   # StageService fixed cost
+stage_mb_per_second = 50
+sd_ratio = 0.5   # Service definition size against the data it packages
+tile_seconds = 3   # CreateVectorTilePackage fixed cost
+tile_rows_per_second = 20000   # Rows drawn into tiles at every level of a full build
+tile_bytes_per_row = 40   # Package bytes per row
+sign_in_seconds = 0.5
+portal_seconds = 0.05   # Every other portal request
+upload_mb_per_second = 40
+publish_seconds = 3
+publish_mb_per_second = 100
+apply_rows_per_second = 5000   # Rows added, updated or deleted by applyEdits
+
+# Synthetic Tiling Scheme
+scheme_levels = 12   # Levels of detail in the tiling scheme
+scheme_cached_levels = 11   # Levels cached, sets MAXCACHE; the finest spans 8 bundles so packages can be sharded
+data_size = 100000.0   # Width and height of the data extent in map units
+scheme_origin = (0.0, 1000000.0)
+
+# Reporting
+regression_tolerance = 0.10   # Share a metric may grow over the baseline before it is a regression
+regression_floor_seconds = 0.5   # Smaller changes are noise
+config_variable = "PYTHON_BENCHMARK_CONFIG"   # Environment variable that hands the run config to every process
+config_cache = [None, None]   # [environment value, parsed config]
+
+
+# Config of the current run, read from the environment so spawned pipeline processes see it too
+def load_config():
+    value = os.environ.get(config_variable)
+    if value != config_cache[0]:
+        config_cache[0] = value
+        config_cache[1] = json.loads(value) if value else None
+    return config_cache[1]
+
+
+# Set the benchmark's Python.py config sections in this process
+def apply_settings():
+    config = load_config()
+    if config and config.get("settings"):
+        import Python
+        for section, values in config["settings"].items():
+            Python.config[section].update(values)
+
+
+# Record one stand-in call for the current run
+def record(stage: str, operation: str, start: float, end: float, byte_count: int = 0, rows: int = 0):
+    config = load_config()
+    if not config:
+        return
+    line = json.dumps({"run": config["run"], "pid": os.getpid(), "stage": stage, "op": operation, "start": start,
+                       "end": end, "bytes": byte_count, "rows": rows})
+    with open(os.path.join(config["stats_dir"], f"{os.getpid()}.jsonl"), "a") as stats_writer:
+        stats_writer.write(line + "\n")
+
+
+# Times a stand-in call and records it on exit
+class StandInCall:
+    def __init__(self, stage: str, operation: str):
+        self.stage = stage
+        self.operation = operation
+        self.byte_count = 0
+        self.rows = 0
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        record(self.stage, self.operation, self.start, time.time(), self.byte_count, self.rows)
+        return False
+
+
+# Write a file of a given size, starting with a JSON header line when one is given, returns the bytes written
+def write_size(file_path: str, size: int, header: dict = None):
+    chunk = bytes(min(size, 1048576))
+    remaining = size
+    with open(file_path, "wb") as size_writer:
+        if header is not None:
+            header_line = (json.dumps(header) + "\n").encode("utf-8")
+            size_writer.write(header_line)
+            remaining -= len(header_line)
+        while remaining > 0:
+            size_writer.write(chunk[:remaining])
+            remaining -= len(chunk)
+    return size
+
+
+# JSON header line of a file written by write_size, None when it has none
+def read_header(path):
+    if not os.path.isfile(str(path)):
+        return None
+    with open(str(path), "rb") as header_reader:
+        header_line = header_reader.readline(65536)
+    try:
+        return json.loads(header_line.decode("utf-8")) if header_line.startswith(b"{") else None
+    except ValueError:
+        return None
+
+
+# Synthetic dataset behind an SDE or local path, by its last path part
+# A local extract names its dataset and the generation it was taken at in its header
+def get_dataset(path):
+    name = re.split(r"[\\/]", str(path))[-1]
+    datasets = load_config()["datasets"]
+    if name in datasets:
+        return name, datasets[name]
+    header = read_header(path)
+    if header and header.get("dataset") in datasets:
+        return header["dataset"], dict(datasets[header["dataset"]], generation=header["generation"])
+    return None, None
+
+
+# Value of a field of a synthetic row at a generation
+# Every generation changes one row in bench_changed_rows, deletes the first row and adds one after the last
+def get_field_value(name: str, dataset: dict, generation: int, oid: int, field_name: str):
+    changed = generation if oid % bench_changed_rows == 0 else max(0, oid - dataset["rows"])
+    offset = sum(ord(character) for character in name) * 7919
+    if field_name == "OID@":
+        return oid
+    if field_name in ("SHAPE@", "SHAPE@JSON"):
+        x = scheme_origin[0] + (offset + oid * 7919) % data_size
+        y = scheme_origin[1] - (offset + oid * 104729) % data_size
+        if field_name == "SHAPE@JSON":
+            return json.dumps({"x": x, "y": y, "spatialReference": {"wkid": 2926}})
+        return StandInGeometry(x, y)
+    if field_name == "ASSET_ID":
+        return f"{name}-{oid}"
+    if field_name == "LAST_EDITED_DATE":
+        return f"2019-01-01 00:00:{changed:02d}"
+    return f"{field_name}_{oid}_{changed}"
+
+
+# Stand-in arcpy ######################################################################################################
+
+class StandInExtent:
+    def __init__(self, XMin=None, YMin=None, XMax=None, YMax=None):
+        self.XMin = XMin
+        self.YMin = YMin
+        self.XMax = XMax
+        self.YMax = YMax
+
+
+class StandInGeometry:
+    def __init__(self, x: float, y: float):
+        self.WKB = struct.pack("<dd", x, y)
+        self.extent = StandInExtent(x, y, x + 10, y + 10)
+
+
+class StandInField:
+    def __init__(self, name: str, field_type: str, length: int = 0, required: bool = False):
+        self.name = name
+        self.type = field_type
+        self.length = length
+        self.required = required
+
+
+stand_in_fields = [StandInField("OBJECTID", "OID", required=True), StandInField("SHAPE", "Geometry", required=True),
+                   StandInField("NAME", "String", 50), StandInField("VALUE", "Double"),
+                   StandInField("LAST_EDITED_DATE", "Date"), StandInField("ASSET_ID", "String", 40),
+                   StandInField("COMMENTS", "String", 255)]
+stand_in_hidden_fields = ["NAME", "COMMENTS"]   # Fields hidden in every layer, NAME is still used by the labels
+stand_in_label_expression = "$feature.NAME"
+stand_in_popup_fields = ["COMMENTS"]   # Fields the last layer's pop-up lists, COMMENTS is hidden in the table
+stand_in_attributes = ["NAME", "VALUE", "LAST_EDITED_DATE", "ASSET_ID"]   # Fields a hosted layer row is compared on
+stand_in_key_field = "ASSET_ID"   # Unique key of the synthetic rows
+
+
+# Fields of a dataset, or of an extract taken with only some of them
+def get_source_fields(path):
+    header = read_header(path)
+    if not header or header.get("fields") is None:
+        return stand_in_fields
+    return [field for field in stand_in_fields if field.required or field.name in header["fields"]]
+
+
+# Bytes of a row holding only the given attribute fields, fields take bytes by their length
+def get_row_bytes(dataset: dict, field_names: list):
+    weights = {field.name: max(8, field.length) for field in stand_in_fields if not field.required}
+    return int(dataset["row_bytes"] * sum(weights.get(name, 0) for name in field_names) / sum(weights.values()))
+
+
+class StandInFieldInfo:
+    def __init__(self, hidden_fields: list):
+        self.field_names = [field.name for field in stand_in_fields]
+        self.hidden_fields = hidden_fields
+        self.count = len(self.field_names)
+
+    def getFieldName(self, index):
+        return self.field_names[index]
+
+    def getVisible(self, index):
+        return "HIDDEN" if self.field_names[index] in self.hidden_fields else "VISIBLE"
+
+
+class StandInDescribe:
+    def __init__(self, path):
+        if isinstance(path, StandInLayer):
+            self.fieldInfo = StandInFieldInfo(path.layer_dict.get("hiddenFields", []))
+            path = path.dataSource
+        self.fields = get_source_fields(path)
+        self.dataType = "FeatureClass"
+        self.shapeType = "Point"
+        self.OIDFieldName = "OBJECTID"
+        self.editorTrackingEnabled = True
+        self.editedAtFieldName = "LAST_EDITED_DATE"
+        self.extent = StandInExtent(scheme_origin[0], scheme_origin[1] - data_size, scheme_origin[0] + data_size,
+                                    scheme_origin[1])
+        if os.path.exists(str(path)) and not os.path.isdir(str(path)):
+            try:
+                with open(str(path), "r") as describe_reader:
+                    self.extent = StandInExtent(*json.load(describe_reader)["extent"])
+            except Exception:
+                pass
+
+
+class StandInResult:
+    def __init__(self, value):
+        self.value = value
+
+    def getOutput(self, index):
+        return str(self.value)
+
+
+# Rows of a synthetic dataset for the requested fields
+# Edits between runs change one row in bench_changed_rows and move the latest edit date
+class StandInSearchCursor:
+    def __init__(self, source, field_names, where_clause=None, spatial_reference=None, explode_to_points=False,
+                 sql_clause=(None, None)):
+        if isinstance(source, StandInLayer):
+            source = source.connectionProperties["dataset"]
+        self.name, self.dataset = get_dataset(source)
+        self.field_names = list(field_names)
+        self.latest_first = bool(sql_clause and sql_clause[1] and "DESC" in sql_clause[1])
+        # Every field of a synthetic row has a value
+        self.null_rows = bool(where_clause) and where_clause.upper().endswith(" IS NULL")
+        self.call = StandInCall("read", "SearchCursor")
+
+    def __enter__(self):
+        self.call.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.call.__exit__(exc_type, exc_value, exc_traceback)
+        return False
+
+    def __iter__(self):
+        if self.dataset is None or self.null_rows:
+            return
+        generation = self.dataset["generation"]
+        first_oid = generation + 1
+        for oid in range(first_oid, first_oid + self.dataset["rows"]):
+            row = []
+            for field_name in self.field_names:
+                if field_name == "LAST_EDITED_DATE" and self.latest_first and oid == first_oid:
+                    row.append(f"2019-01-01 00:00:{generation:02d}")
+                elif field_name == "*":
+                    row.extend([oid, get_field_value(self.name, self.dataset, generation, oid, "NAME"), oid * 1.5])
+                else:
+                    row.append(get_field_value(self.name, self.dataset, generation, oid, field_name))
+            self.call.rows += 1
+            if self.call.rows % 1000 == 0:
+                time.sleep(1000 / read_rows_per_second)
+            yield tuple(row)
+
+
+class StandInLayer:
+    def __init__(self, layer_dict: dict):
+        self.layer_dict = layer_dict
+        self.name = layer_dict["name"]
+        self.longName = layer_dict["longName"]
+        self.isGroupLayer = False
+        self.isFeatureLayer = True
+        self.isBasemapLayer = False
+        self.isWebLayer = False
+
+    def __str__(self):
+        return self.name
+
+    def supports(self, layer_property):
+        return True
+
+    @property
+    def symbology(self):
+        return types.SimpleNamespace(renderer=types.SimpleNamespace(type="SimpleRenderer"))
+
+    def getDefinition(self, cim_version):
+        field_infos = [types.SimpleNamespace(fieldName=name, visible=True)
+                       for name in self.layer_dict.get("popupFields", [])]
+        return types.SimpleNamespace(popupInfo=types.SimpleNamespace(title="", mediaInfos=[], expressionInfos=[],
+                                                                     fieldInfos=field_infos))
+
+    def listLabelClasses(self, wildcard=None):
+        if not self.layer_dict.get("labelExpression"):
+            return []
+        return [types.SimpleNamespace(name="Default", expression=self.layer_dict["labelExpression"], SQLQuery="")]
+
+    @property
+    def definitionQuery(self):
+        return self.layer_dict.get("definitionQuery", "")
+
+    @definitionQuery.setter
+    def definitionQuery(self, value):
+        self.layer_dict["definitionQuery"] = value
+
+    @property
+    def connectionProperties(self):
+        return json.loads(json.dumps(self.layer_dict["connectionProperties"]))
+
+    @property
+    def dataSource(self):
+        return self.layer_dict["dataSource"]
+
+    def updateConnectionProperties(self, current_connection_info, new_connection_info):
+        self.layer_dict["connectionProperties"] = json.loads(json.dumps(new_connection_info))
+        self.layer_dict["dataSource"] = os.path.join(new_connection_info["connection_info"]["database"],
+                                                     new_connection_info["dataset"])
+
+
+class StandInSharingDraft:
+    def __init__(self, prj_map):
+        self.prj_map = prj_map
+
+    def exportToSDDraft(self, out_sddraft):
+        with StandInCall("stage", "exportToSDDraft"):
+            with open(out_sddraft, "w") as draft_writer:
+                json.dump({"sources": [layer.dataSource for layer in self.prj_map.listLayers()],
+                           "layers": [[layer.name, layer.dataSource] for layer in self.prj_map.listLayers()]},
+                          draft_writer)
+
+
+class StandInMap:
+    def __init__(self, map_dict: dict):
+        self.map_dict = map_dict
+        self.spatialReference = None
+        self.layers = [StandInLayer(layer_dict) for layer_dict in map_dict["layers"]]
+
+    def listLayers(self, wildcard=None):
+        return self.layers
+
+    def getWebLayerSharingDraft(self, server_type, service_type, service_name, layers_and_tables=None):
+        return StandInSharingDraft(self)
+
+
+# A project is a JSON file of maps and layers
+class StandInArcGISProject:
+    def __init__(self, aprx_path: str):
+        self.aprx_path = aprx_path
+        with open(aprx_path, "r") as project_reader:
+            self.project_dict = json.load(project_reader)
+        self.maps = [StandInMap(map_dict) for map_dict in self.project_dict["maps"]]
+
+    def listMaps(self, wildcard=None):
+        return self.maps
+
+    def save(self):
+        with open(self.aprx_path, "w") as project_writer:
+            json.dump(self.project_dict, project_writer)
+
+
+stand_in_env = types.SimpleNamespace(extent=None)
+
+
+def stand_in_clear_environment(environment_name):
+    setattr(stand_in_env, environment_name, None)
+
+
+def stand_in_exists(path):
+    return os.path.exists(str(path)) or get_dataset(path)[0] is not None
+
+
+def stand_in_get_count(path):
+    return StandInResult(get_dataset(path)[1]["rows"])
+
+
+def stand_in_list_fields(dataset, wild_card=None, field_type=None):
+    return get_source_fields(dataset)
+
+
+class StandInFieldMap:
+    def __init__(self, field_name: str):
+        self.field_name = field_name
+
+    def getInputFieldName(self, index):
+        return self.field_name
+
+
+class StandInFieldMappings:
+    def __init__(self):
+        self.field_maps = []
+
+    @property
+    def fieldCount(self):
+        return len(self.field_maps)
+
+    def addTable(self, table_dataset):
+        self.field_maps += [StandInFieldMap(field.name) for field in get_source_fields(table_dataset)
+                            if not field.required]
+
+    def getFieldMap(self, index):
+        return self.field_maps[index]
+
+    def removeFieldMap(self, index):
+        del self.field_maps[index]
+
+
+def stand_in_create_file_gdb(out_folder_path, out_name, out_version=None):
+    os.makedirs(os.path.join(out_folder_path, out_name), exist_ok=True)
+
+
+def stand_in_feature_class_to_feature_class(in_features, out_path, out_name, where_clause=None, field_mapping=None,
+                                            config_keyword=None):
+    with StandInCall("extract", "FeatureClassToFeatureClass") as call:
+        name, dataset = get_dataset(in_features)
+        field_names = [field.name for field in stand_in_fields if not field.required]
+        if field_mapping is not None:
+            field_names = [field_map.field_name for field_map in field_mapping.field_maps]
+        time.sleep(dataset["rows"] / extract_rows_per_second)
+        call.rows = dataset["rows"]
+        call.byte_count = write_size(os.path.join(out_path, out_name),
+                                     int(dataset["rows"] * get_row_bytes(dataset, field_names) * (1 + fragment_share)),
+                                     {"dataset": name, "generation": dataset["generation"],
+                                      "fields": field_names if field_mapping is not None else None,
+                                      "indexes": [], "fragmented": True})
+
+
+def stand_in_copy(in_data, out_data, data_type=None):
+    with StandInCall("extract", "Copy") as call:
+        shutil.copyfile(in_data, out_data)
+        call.byte_count = os.path.getsize(out_data)
+        time.sleep(call.byte_count / 1048576 / copy_mb_per_second)
+
+
+# Rewrite an extract with changes to its header, and a new size when one is given
+def update_extract(path, size: int = None, **changes):
+    header = read_header(path)
+    header.update(changes)
+    return write_size(path, size if size is not None else os.path.getsize(path), header)
+
+
+class StandInIndex:
+    def __init__(self, name: str, field_name: str):
+        self.name = name
+        self.fields = [StandInField(field_name, "String")]
+
+
+def stand_in_list_indexes(dataset, wild_card=None):
+    return [StandInIndex(f"IX_{field_name}", field_name) for field_name in read_header(dataset).get("indexes", [])]
+
+
+def stand_in_add_spatial_index(in_features, spatial_grid_1=None, spatial_grid_2=None, spatial_grid_3=None):
+    with StandInCall("optimize", "AddSpatialIndex") as call:
+        call.rows = get_dataset(in_features)[1]["rows"]
+        time.sleep(call.rows / index_rows_per_second)
+
+
+def stand_in_add_index(in_table, fields, index_name=None, unique=None, ascending=None):
+    with StandInCall("optimize", "AddIndex") as call:
+        call.rows = get_dataset(in_table)[1]["rows"]
+        time.sleep(call.rows / index_rows_per_second)
+        update_extract(in_table, indexes=read_header(in_table)["indexes"] + [fields])
+
+
+# Compacting a GDB frees the fragmented share of each extract written since it was last compacted
+def stand_in_compact(in_workspace):
+    with StandInCall("optimize", "Compact") as call:
+        for file_name in os.listdir(in_workspace):
+            path = os.path.join(in_workspace, file_name)
+            if (read_header(path) or {}).get("fragmented"):
+                call.byte_count += update_extract(path, int(os.path.getsize(path) / (1 + fragment_share)),
+                                                  fragmented=False)
+        time.sleep(call.byte_count / 1048576 / compact_mb_per_second)
+
+
+def stand_in_sign_in_to_portal(portal_url, username=None, password=None):
+    with StandInCall("portal", "SignInToPortal"):
+        time.sleep(sign_in_seconds)
+
+
+def stand_in_stage_service(in_service_definition_draft, out_service_definition, staging_version=None):
+    with StandInCall("stage", "StageService") as call:
+        with open(in_service_definition_draft, "r") as draft_reader:
+            draft = json.load(draft_reader)
+        data_bytes = sum(os.path.getsize(source) for source in draft["sources"] if os.path.isfile(source))
+        time.sleep(stage_seconds + data_bytes / 1048576 / stage_mb_per_second)
+
+        # The header names the extract behind each layer, the stand-in portal builds the hosted layers from it
+        layers = []
+        for layer_name, source in draft["layers"]:
+            header = read_header(source)
+            if header:
+                layers.append({"name": layer_name, "dataset": header["dataset"], "generation": header["generation"]})
+        call.byte_count = write_size(out_service_definition, int(data_bytes * sd_ratio), {"layers": layers})
+
+
+# Rows of a map, and the share of the data extent inside arcpy.env.extent
+def get_map_rows(in_map):
+    rows = 0
+    for layer in in_map.listLayers():
+        name, dataset = get_dataset(layer.connectionProperties["dataset"])
+        if dataset:
+            rows += dataset["rows"]
+    share = 1.0
+    if stand_in_env.extent is not None:
+        extent = stand_in_env.extent
+        width = max(0.0, min(extent.XMax, scheme_origin[0] + data_size) - max(extent.XMin, scheme_origin[0]))
+        height = max(0.0, min(extent.YMax, scheme_origin[1]) - max(extent.YMin, scheme_origin[1] - data_size))
+        share = width * height / (data_size * data_size)
+    return rows, share
+
+
+def stand_in_create_vector_tile_index(in_map, out_featureclass, service_type=None, tiling_scheme=None,
+                                      vertex_count=None):
+    with StandInCall("tiles", "CreateVectorTileIndex") as call:
+        rows, share = get_map_rows(in_map)
+        time.sleep(rows / read_rows_per_second)
+        with open(out_featureclass, "w") as index_writer:
+            json.dump({"extent": [scheme_origin[0], scheme_origin[1] - data_size, scheme_origin[0] + data_size,
+                                  scheme_origin[1]]}, index_writer)
+        call.rows = rows
+
+
+# Writes a package with real compact cache bundles, sized and timed by the rows and levels it covers
+# Each level holds up to 8 x 8 tiles spread over the data extent, only those inside arcpy.env.extent, and the tile map
+# marks the cells of an 8 x 8 grid over the data extent the package covers; a tile is the same in every build
+def stand_in_create_vector_tile_package(in_map, output_file, service_type=None, tiling_scheme=None,
+                                        tile_structure=None, min_cached_scale=None, max_cached_scale=None,
+                                        index_polygons=None, summary=None, tags=None):
+    import vector_tile_package
+    with StandInCall("tiles", "CreateVectorTilePackage") as call:
+        rows, share = get_map_rows(in_map)
+        lods = vector_tile_package.read_tiling_scheme(tiling_scheme)["lods"]
+        cached = [lod for lod in lods if max_cached_scale is None or lod[1] >= float(max_cached_scale) / 1.5]
+        built = [lod for lod in cached if min_cached_scale is None or lod[1] <= float(min_cached_scale) * 1.5]
+        level_weights = {lod[0]: 4 ** lod[0] for lod in cached}
+        total_weight = sum(level_weights.values())
+        built_weight = sum(level_weights[lod[0]] for lod in built) / total_weight
+        time.sleep(tile_seconds + rows * share * built_weight * len(cached) / tile_rows_per_second)
+
+        extent = stand_in_env.extent
+        scheme_weight = sum(4 ** level for level in range(scheme_cached_levels))
+        header = struct.pack("<II", 3, 16384) + bytes(56)
+        bundle_dim = vector_tile_package.vtpk_bundle_dim
+        os.makedirs(os.path.dirname(output_file), exist_ok=True)
+        with zipfile.ZipFile(output_file, "w") as package_writer:
+            for level, scale, resolution in built:
+                side = 2 ** level
+                step = max(1, side // 8)
+                tile_size = data_size / side
+                tile = bytes(max(1, int(rows * tile_bytes_per_row * 4 ** level / scheme_weight) // min(side, 8) ** 2))
+                bundles = {}
+                for row in range(0, side, step):
+                    for col in range(0, side, step):
+                        if extent_overlaps(extent, scheme_origin[0] + col * tile_size,
+                                           scheme_origin[1] - (row + 1) * tile_size, tile_size):
+                            bundle = (row - row % bundle_dim, col - col % bundle_dim)
+                            position = (row - bundle[0]) * bundle_dim + col - bundle[1]
+                            bundles.setdefault(bundle, {})[position] = tile
+                for (bundle_row, bundle_col), tiles in bundles.items():
+                    package_writer.writestr(f"p12/tile/L{level:02d}/R{bundle_row:04x}C{bundle_col:04x}.bundle",
+                                            vector_tile_package.write_bundle(header, tiles))
+            package_writer.writestr(vector_tile_package.vtpk_style_member, json.dumps(
+                {"version": 8, "sprite": "", "glyphs": "", "sources": {"esri": {"type": "vector", "url": ""}}}))
+            package_writer.writestr(vector_tile_package.vtpk_root_member, json.dumps(
+                {"name": summary, "fullExtent": {"xmin": 0, "ymin": 0, "xmax": 1, "ymax": 1},
+                 "initialExtent": {"xmin": 0, "ymin": 0, "xmax": 1, "ymax": 1}}))
+            package_writer.writestr(vector_tile_package.vtpk_tilemap_member,
+                                    json.dumps({"index": get_tile_map_node(extent, 0, 0, data_size)}))
+        call.rows = rows
+        call.byte_count = os.path.getsize(output_file)
+
+
+# True when a square of the data extent, from its lower left corner, overlaps an extent; every square overlaps None
+def extent_overlaps(extent, xmin: float, ymin: float, size: float):
+    return extent is None or (xmin < extent.XMax and xmin + size > extent.XMin and ymin < extent.YMax and
+                              ymin + size > extent.YMin)
+
+
+# Tile map node of a square of the data extent, from its upper left corner, down to an 8 x 8 grid of cells
+# Children are upper left, upper right, lower left, lower right; 1 for a cell the extent overlaps, 0 for none
+def get_tile_map_node(extent, x: float, y: float, size: float):
+    if size <= data_size / 8:
+        return 1 if extent_overlaps(extent, scheme_origin[0] + x, scheme_origin[1] - y - size, size) else 0
+    half = size / 2
+    children = [get_tile_map_node(extent, x + col * half, y + row * half, half) for row in (0, 1) for col in (0, 1)]
+    return children if any(children) else 0
+
+
+# Stand-in arcgis.gis #################################################################################################
+
+class StandInConnection:
+    def __init__(self, url: str):
+        self.url = url
+        self.token = None
+
+    def post(self, path: str, params: dict = None, **kwargs):
+        data = urllib.parse.urlencode(params or {}).encode("utf-8")
+        with urllib.request.urlopen(f"{self.url}/sharing/rest/{path}", data=data, timeout=600) as response:
+            result = json.loads(response.read().decode("utf-8"))
+        if "error" in result:
+            raise RuntimeError(result["error"])
+        return result
+
+    def relogin(self):
+        self.token = self.post("generateToken", {"f": "json"})["token"]
+
+
+class StandInResources:
+    def __init__(self, item):
+        self.item = item
+
+    def add(self, file=None, folder_name=None, file_name=None, **kwargs):
+        return self.item.gis._con.post(f"content/items/{self.item.id}/addResource",
+                                       {"size": os.path.getsize(file), "name": f"{folder_name}/{file_name}"})
+
+    def update(self, file=None, folder_name=None, file_name=None, **kwargs):
+        return self.item.gis._con.post(f"content/items/{self.item.id}/updateResource",
+                                       {"size": os.path.getsize(file), "name": f"{folder_name}/{file_name}"})
+
+
+class StandInItem:
+    def __init__(self, gis, itemid: str, itemdict: dict = None):
+        self.gis = gis
+        self.id = itemid
+        if itemdict is None:
+            itemdict = gis._con.post(f"content/items/{itemid}", {"f": "json"})
+        self.title = itemdict.get("title")
+        self.type = itemdict.get("type")
+        self.owner = itemdict.get("owner")
+        self.url = itemdict.get("url")
+        self.resources = StandInResources(self)
+
+    @property
+    def homepage(self):
+        return f"{self.gis.url}/home/item.html?id={self.id}"
+
+    def delete(self, **kwargs):
+        return self.gis._con.post(f"content/items/{self.id}/delete", {"f": "json"})["success"]
+
+    def share(self, everyone=False, org=False, groups=None, **kwargs):
+        return self.gis._con.post(f"content/items/{self.id}/share", {"everyone": everyone, "org": org})
+
+    def update(self, item_properties=None, data=None, **kwargs):
+        return self.gis._con.post(f"content/items/{self.id}/update", item_properties or {})["success"]
+
+    def publish(self, publish_parameters=None, address_fields=None, output_type=None, overwrite=False,
+                file_type=None, **kwargs):
+        result = self.gis._con.post(f"content/items/{self.id}/publish", {"overwrite": overwrite})
+        return StandInItem(self.gis, result["serviceItemId"])
+
+    def copy(self, title=None, **kwargs):
+        result = self.gis._con.post(f"content/items/{self.id}/copy", {"title": title or self.title})
+        return StandInItem(self.gis, result["id"])
+
+
+class StandInContentManager:
+    def __init__(self, gis):
+        self.gis = gis
+
+    def search(self, query: str, item_type: str = None, max_items: int = 10, **kwargs):
+        result = self.gis._con.post("search", {"q": query, "type": item_type or "", "start": 1, "num": 10000})
+        return [StandInItem(self.gis, item_dict["id"], item_dict) for item_dict in result["results"]]
+
+    def advanced_search(self, query: str, max_items: int = 100, start: int = 1, sort_field: str = "title",
+                        **kwargs):
+        result = self.gis._con.post("search", {"q": query, "start": start, "num": max_items, "sortField": sort_field})
+        result["results"] = [StandInItem(self.gis, item_dict["id"], item_dict) for item_dict in result["results"]]
+        return result
+
+    def get(self, itemid: str):
+        try:
+            return StandInItem(self.gis, itemid)
+        except RuntimeError:
+            return None
+
+    def create_folder(self, folder: str, owner: str = None):
+        return self.gis._con.post(f"content/users/{owner}/createFolder", {"title": folder})["folder"]
+
+
+class StandInUser:
+    def __init__(self, gis, username: str):
+        self.gis = gis
+        self.username = username
+
+    @property
+    def folders(self):
+        return self.gis._con.post(f"community/users/{self.username}", {"f": "json"})["folders"]
+
+
+class StandInUserManager:
+    def __init__(self, gis):
+        self.gis = gis
+
+    def get(self, username: str):
+        return StandInUser(self.gis, username)
+
+
+class StandInGIS:
+    def __init__(self, url: str = None, username: str = None, password: str = None, verify_cert: bool = True,
+                 **kwargs):
+        self.url = url.rstrip("/")
+        self._con = StandInConnection(self.url)
+        self._con.relogin()
+        self.content = StandInContentManager(self)
+        self.users = StandInUserManager(self)
+
+
+# Register the stand-ins as the arcpy and arcgis.gis modules
+def install_stand_ins():
+    arcpy = types.ModuleType("arcpy")
+    arcpy.mp = types.ModuleType("arcpy.mp")
+    arcpy.mp.ArcGISProject = StandInArcGISProject
+    arcpy.da = types.ModuleType("arcpy.da")
+    arcpy.da.SearchCursor = StandInSearchCursor
+    arcpy.env = stand_in_env
+    arcpy.Extent = StandInExtent
+    arcpy.Describe = StandInDescribe
+    arcpy.ClearEnvironment = stand_in_clear_environment
+    arcpy.Exists = stand_in_exists
+    arcpy.GetCount_management = stand_in_get_count
+    arcpy.ListFields = stand_in_list_fields
+    arcpy.FieldMappings = StandInFieldMappings
+    arcpy.ListIndexes = stand_in_list_indexes
+    arcpy.AddSpatialIndex_management = stand_in_add_spatial_index
+    arcpy.AddIndex_management = stand_in_add_index
+    arcpy.Compact_management = stand_in_compact
+    arcpy.CreateFileGDB_management = stand_in_create_file_gdb
+    arcpy.FeatureClassToFeatureClass_conversion = stand_in_feature_class_to_feature_class
+    arcpy.Copy_management = stand_in_copy
+    arcpy.SignInToPortal = stand_in_sign_in_to_portal
+    arcpy.StageService_server = stand_in_stage_service
+    arcpy.CreateVectorTileIndex_management = stand_in_create_vector_tile_index
+    arcpy.CreateVectorTilePackage_management = stand_in_create_vector_tile_package
+    arcgis = types.ModuleType("arcgis")
+    arcgis.gis = types.ModuleType("arcgis.gis")
+    arcgis.gis.GIS = StandInGIS
+    arcgis.gis.Item = StandInItem
+    sys.modules.update({"arcpy": arcpy, "arcpy.mp": arcpy.mp, "arcpy.da": arcpy.da, "arcgis": arcgis,
+                        "arcgis.gis": arcgis.gis})
+
+
+# Stand-in portal #####################################################################################################
+
+portal_items = {}   # id: item dict
+portal_folders = {}   # owner: [folder dicts]
+hosted_services = {}   # feature service title: [hosted layer dicts]
+portal_records = []   # Calls handled by the stand-in portal, recorded like the stand-in arcpy calls
+portal_lock = threading.Lock()
+
+
+# Fields of a urlencoded or multipart/form-data body, file parts are replaced by their size
+# A file part starting with a JSON header line (a stand-in Service Definition) keeps it as the file_header field
+def parse_form(body: bytes, content_type: str):
+    if not content_type.startswith("multipart/form-data"):
+        return {key: values[0] for key, values in urllib.parse.parse_qs(body.decode("utf-8")).items()}, 0
+    boundary = content_type.split("boundary=")[1].encode("utf-8")
+    fields = {}
+    file_bytes = 0
+    for part in body.split(b"--" + boundary):
+        if b"\r\n\r\n" not in part:
+            continue
+        part_headers, part_value = part.split(b"\r\n\r\n", 1)
+        part_value = part_value[:-2] if part_value.endswith(b"\r\n") else part_value
+        name = re.search(rb'name="([^"]*)"', part_headers).group(1).decode("utf-8")
+        if b"filename=" in part_headers:
+            file_bytes = len(part_value)
+            if part_value.startswith(b"{"):
+                fields["file_header"] = part_value.split(b"\n", 1)[0].decode("utf-8")
+        else:
+            fields[name] = part_value.decode("utf-8")
+    return fields, file_bytes
+
+
+# Item dicts matching a search query of owner:, title: and name: terms
+def search_items(query: str, item_type: str):
+    terms = re.findall(r"(owner|title|name):(\S+)", query)
+    results = []
+    for item in portal_items.values():
+        if item_type and item["type"] != item_type:
+            continue
+        owners = [value for key, value in terms if key == "owner"]
+        titles = [value.lower() for key, value in terms if key in ("title", "name")]
+        if owners and item["owner"] not in owners:
+            continue
+        if titles and (item["title"] or "").lower() not in titles:
+            continue
+        results.append(item)
+    return results
+
+
+class StandInPortalHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        start = time.time()
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        fields, file_bytes = parse_form(body, self.headers.get("Content-Type", ""))
+        url_path = urllib.parse.urlsplit(self.path).path
+        if "/rest/services/" in url_path:
+            segments = url_path.split("/rest/services/", 1)[1].strip("/").split("/")
+        else:
+            segments = url_path.split("/sharing/rest/", 1)[1].strip("/").split("/")
+        self.portal_base = f"http://{self.headers['Host']}{url_path.split('/sharing/rest/', 1)[0]}"
+        operation = segments[-1]
+        stage = "portal"
+        byte_count = file_bytes
+        rows = 0
+        try:
+            if "/rest/services/" in url_path:
+                result = self.handle_service_operation(segments, fields)
+            else:
+                result = self.handle_operation(segments, operation, fields, file_bytes)
+            if operation == "applyEdits":
+                stage = "publish"
+                rows = result.pop("edits")
+                time.sleep(portal_seconds + rows / apply_rows_per_second)
+            elif operation in ("addPart", "addResource", "updateResource"):
+                stage = "upload"
+                byte_count = file_bytes or int(fields.get("size", 0))
+                time.sleep(byte_count / 1048576 / upload_mb_per_second)
+            elif operation == "publish":
+                stage = "publish"
+                time.sleep(publish_seconds + result.pop("source_size") / 1048576 / publish_mb_per_second)
+            elif operation == "generateToken":
+                time.sleep(sign_in_seconds)
+            else:
+                time.sleep(portal_seconds)
+        except Exception as error:
+            result = {"error": {"code": 400, "message": str(error)}}
+        with portal_lock:
+            portal_records.append({"run": load_config()["run"], "pid": "portal", "stage": stage, "op": operation,
+                                   "start": start, "end": time.time(), "bytes": byte_count, "rows": rows})
+        response = json.dumps(result).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def handle_operation(self, segments: list, operation: str, fields: dict, file_bytes: int):
+        with portal_lock:
+            if operation == "generateToken":
+                return {"token": uuid.uuid4().hex}
+            if operation == "search":
+                results = search_items(fields.get("q", ""), fields.get("type"))
+                start = int(fields.get("start", 1))
+                page = results[start - 1:start - 1 + int(fields.get("num", 100))]
+                next_start = start + len(page) if start - 1 + len(page) < len(results) else -1
+                return {"results": page, "nextStart": next_start}
+            if segments[0] == "community":
+                return {"folders": portal_folders.get(segments[-1], [])}
+            if operation == "createFolder":
+                folder = {"id": uuid.uuid4().hex, "title": fields["title"]}
+                portal_folders.setdefault(segments[2], []).append(folder)
+                return {"success": True, "folder": folder}
+            if operation == "addItem":
+                item = {"id": uuid.uuid4().hex, "owner": segments[2], "type": fields.get("type"),
+                        "title": fields.get("title"), "parts": {}, "size": file_bytes}
+                portal_items[item["id"]] = item
+                return {"success": True, "id": item["id"]}
+            item = portal_items.get(segments[-1] if segments[-2] == "items" else segments[-2])
+            if item is None:
+                raise KeyError("Item does not exist or is inaccessible.")
+            if len(segments) > 1 and segments[-2] == "items":
+                return {key: value for key, value in item.items() if key not in ("parts", "header")}
+            if operation == "addPart":
+                item["parts"][int(fields["partNum"])] = file_bytes
+                if int(fields["partNum"]) == 1 and "file_header" in fields:
+                    item["header"] = json.loads(fields["file_header"])
+                return {"success": True}
+            if operation == "commit":
+                item["size"] = sum(item["parts"].values())
+                item.update({key: value for key, value in fields.items() if key in ("title", "type", "tags")})
+                return {"success": True}
+            if operation == "status":
+                return {"status": "completed"}
+            if operation == "delete":
+                del portal_items[item["id"]]
+                return {"success": True}
+            if operation == "update":
+                item.update({key: value for key, value in fields.items() if key in ("title", "tags")})
+                return {"success": True}
+            if operation == "publish":
+                service_type = "Vector Tile Service" if item["type"] == "Vector Tile Package" else "Feature Service"
+                title = os.path.splitext(item["title"] or "")[0]
+                service = None
+                if fields.get("overwrite") == "True":
+                    for candidate in portal_items.values():
+                        if candidate["type"] == service_type and candidate["title"] == title:
+                            service = candidate
+                if service is None:
+                    service = {"id": uuid.uuid4().hex, "owner": item["owner"], "type": service_type, "title": title,
+                               "parts": {}, "size": 0}
+                    portal_items[service["id"]] = service
+
+                # Publishing replaces every row of the hosted layers with the extracts the SD was staged from
+                if service_type == "Feature Service":
+                    service["url"] = f"{self.portal_base}/rest/services/{title}/FeatureServer"
+                    hosted_services[title] = [{"id": layer_id, "name": layer["name"], "dataset": layer["dataset"],
+                                               "generation": layer["generation"], "edits": {}, "object_ids": {},
+                                               "next_oid": 1000000000, "duplicate_adds": 0}
+                                              for layer_id, layer in enumerate(item.get("header", {}).get("layers",
+                                                                                                          []))]
+                return {"serviceItemId": service["id"], "source_size": item["size"]}
+            if operation == "copy":
+                copy_item = dict(item, id=uuid.uuid4().hex, title=fields.get("title"), parts={})
+                portal_items[copy_item["id"]] = copy_item
+                return {"success": True, "id": copy_item["id"]}
+            return {"success": True}
+
+
+    # Feature service REST endpoints: service and layer info, query by key and applyEdits
+    def handle_service_operation(self, segments: list, fields: dict):
+        with portal_lock:
+            layers = hosted_services.get(segments[0])
+            if layers is None:
+                raise KeyError("Service not found.")
+            if len(segments) == 2:
+                return {"layers": [{"id": layer["id"], "name": layer["name"]} for layer in layers], "tables": []}
+            layer = layers[int(segments[2])]
+            if len(segments) == 3:
+                return {"id": layer["id"], "name": layer["name"], "objectIdField": "OBJECTID"}
+            if segments[3] == "query":
+                key_field, values = re.match(r"(\w+) IN \((.*)\)$", fields["where"]).groups()
+                features = []
+                for key in [value.replace("''", "'") for value in re.findall(r"'((?:[^']|'')*)'", values)]:
+                    attributes = get_hosted_row(layer, key)
+                    if attributes is not None:
+                        features.append({"attributes": {"OBJECTID": attributes["OBJECTID"], key_field: key}})
+                return {"features": features}
+            if segments[3] == "applyEdits":
+                add_results = []
+                for feature in json.loads(fields.get("adds", "[]")):
+                    key = feature["attributes"][stand_in_key_field]
+                    if get_hosted_row(layer, key) is not None:
+                        layer["duplicate_adds"] += 1
+                    object_id = layer["next_oid"]
+                    layer["next_oid"] += 1
+                    layer["object_ids"][object_id] = key
+                    layer["edits"][key] = dict(feature["attributes"], OBJECTID=object_id)
+                    add_results.append({"objectId": object_id, "success": True})
+                update_results = []
+                for feature in json.loads(fields.get("updates", "[]")):
+                    object_id = feature["attributes"]["OBJECTID"]
+                    key = get_hosted_key(layer, object_id)
+                    if key is None:
+                        update_results.append({"objectId": object_id, "success": False,
+                                               "error": {"code": 1019, "description": "Object is missing."}})
+                        continue
+                    layer["edits"][key] = dict(feature["attributes"])
+                    update_results.append({"objectId": object_id, "success": True})
+                delete_results = []
+                for object_id in [int(value) for value in fields.get("deletes", "").split(",") if value]:
+                    key = get_hosted_key(layer, object_id)
+                    if key is not None:
+                        layer["edits"][key] = None
+                    delete_results.append({"objectId": object_id, "success": key is not None})
+                return {"addResults": add_results, "updateResults": update_results, "deleteResults": delete_results,
+                        "edits": len(add_results) + len(update_results) + len(delete_results)}
+            raise KeyError(f"Unknown operation {segments[3]}")
+
+
+# Attributes of a hosted layer row by key, None when the layer has no such row
+# Rows come from the extract it was published from, then the edits applied since
+def get_hosted_row(layer: dict, key: str):
+    if key in layer["edits"]:
+        return layer["edits"][key]
+    dataset_name, separator, oid = key.rpartition("-")
+    dataset = load_config()["datasets"].get(dataset_name)
+    if dataset_name != layer["dataset"] or not oid.isdigit() or dataset is None or \
+            not layer["generation"] < int(oid) <= layer["generation"] + dataset["rows"]:
+        return None
+    attributes = {field_name: get_field_value(dataset_name, dataset, layer["generation"], int(oid), field_name)
+                  for field_name in stand_in_attributes}
+    attributes["OBJECTID"] = int(oid)
+    return attributes
+
+
+# Key of a hosted layer row by object id, None when the layer has no such row
+def get_hosted_key(layer: dict, object_id: int):
+    key = layer["object_ids"].get(object_id, f"{layer['dataset']}-{object_id}")
+    return key if get_hosted_row(layer, key) is not None else None
+
+
+# Rows of the hosted layers that differ from their extracts' sources as they are now, and adds of keys a layer
+# already had; both are 0 when every publish, overwrite or row edits, left the layers matching their sources
+def check_hosted_layers():
+    datasets = load_config()["datasets"]
+    mismatched = 0
+    duplicate_adds = 0
+    with portal_lock:
+        for layers in hosted_services.values():
+            for layer in layers:
+                duplicate_adds += layer["duplicate_adds"]
+                dataset = datasets[layer["dataset"]]
+                generation = dataset["generation"]
+                expected_keys = set()
+                for oid in range(generation + 1, generation + dataset["rows"] + 1):
+                    key = f"{layer['dataset']}-{oid}"
+                    expected_keys.add(key)
+                    hosted_row = get_hosted_row(layer, key) or {}
+                    for field_name in stand_in_attributes:
+                        if hosted_row.get(field_name) != get_field_value(layer["dataset"], dataset, generation, oid,
+                                                                         field_name):
+                            mismatched += 1
+                            break
+
+                # Rows the layer has that its source no longer has
+                hosted_keys = set(key for key, row in layer["edits"].items() if row is not None)
+                for oid in range(layer["generation"] + 1, layer["generation"] + dataset["rows"] + 1):
+                    key = f"{layer['dataset']}-{oid}"
+                    if key not in layer["edits"]:
+                        hosted_keys.add(key)
+                mismatched += len(hosted_keys - expected_keys)
+    return {"rows_mismatched": mismatched, "duplicate_adds": duplicate_adds}
+
+
+class StandInPortalServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+# Benchmark run #######################################################################################################
+
+# Write the tiling scheme, projects and .ini files of the synthetic services
+def build_services(local_path: str, target_folder_path: str, portal_url: str, config: dict):
+    resolutions = [data_size / 512 / 2 ** level for level in range(scheme_levels)]
+    lod_infos = "".join(f"<LODInfo><LevelID>{level}</LevelID><Scale>{resolution * 96 / 0.0254}</Scale>"
+                        f"<Resolution>{resolution}</Resolution></LODInfo>"
+                        for level, resolution in enumerate(resolutions))
+    with open(os.path.join(local_path, "tiling_scheme_SP.xml"), "w") as scheme_writer:
+        scheme_writer.write(f"<?xml version=\"1.0\" encoding=\"utf-8\"?><TileCacheInfo><SpatialReference><WKID>2926"
+                            f"</WKID></SpatialReference><TileOrigin><X>{scheme_origin[0]}</X><Y>{scheme_origin[1]}</Y>"
+                            f"</TileOrigin><TileCols>512</TileCols><TileRows>512</TileRows><DPI>96</DPI><LODInfos>"
+                            f"{lod_infos}</LODInfos></TileCacheInfo>")
+    max_cache = int(resolutions[scheme_cached_levels - 1] * 96 / 0.0254)
+
+    list_path = f"{target_folder_path}\\list"
+    os.makedirs(list_path)
+    projects_path = os.path.join(local_path, "projects")
+    os.makedirs(projects_path)
+    for service_number in range(config["services"]):
+        service_name = f"BENCH_{service_number:02d}"
+        vector_tiles = service_number < config["vector_tile_services"]
+        layers = []
+        shared_layers = int(config["layers"] * config.get("shared_layers", 0))
+        for layer_number in range(config["layers"]):
+            dataset = f"GISUSER.{service_name}_L{layer_number:02d}"
+            if layer_number < shared_layers:
+                dataset = f"GISUSER.SHARED_L{layer_number:02d}"
+            config["datasets"][dataset] = {"rows": config["rows"], "row_bytes": config["row_bytes"], "generation": 0}
+            connection_info = {"user": "gisuser", "server": "spugisp.world",
+                               "instance": "sde:oracle$sde:oracle11g:spugisp"}
+            layers.append({"name": f"Layer {layer_number}", "longName": f"Group\\Layer {layer_number}",
+                           "dataSource": f"USER=GISUSER,DATASET={dataset}", "hiddenFields": stand_in_hidden_fields,
+                           "labelExpression": stand_in_label_expression,
+                           "popupFields": stand_in_popup_fields if layer_number == config["layers"] - 1 else [],
+                           "connectionProperties": {"dataset": dataset, "workspace_factory": "SDE",
+                                                    "connection_info": connection_info}})
+        project_path = os.path.join(projects_path, f"{service_name}.aprx")
+        with open(project_path, "w") as project_writer:
+            json.dump({"maps": [{"name": "Map", "layers": layers}]}, project_writer)
+        init_values = {"SERVICETYPE": "Vector Tile" if vector_tiles else "Feature", "SERVICENAME": service_name,
+                       "SERVICEID": "None", "FOLDERNAME": "Benchmark", "APRX": project_path, "TAGS": "benchmark",
+                       "DESCRIPTION": service_name, "COPYDATA": "False", "EDITING": "False", "EXPORTING": "False",
+                       "SYNC": "False", "EVERYONE": "False", "ORG": "True", "GROUPS": "None",
+                       "PORTALURL": portal_url, "ADMINUSER": "benchmark", "ADMINPASS": "benchmark",
+                       "MAXCACHE": str(max_cache), "DELTAKEY": config.get("delta_key") or "None"}
+        init_path = os.path.join(list_path, f"{service_name}.ini")
+        with open(init_path, "w") as init_writer:
+            for key, value in init_values.items():
+                init_writer.write(f"{key} = {value}\n")
+
+        # Python.py joins paths with backslashes, which are only separators on Windows
+        if os.sep != "\\":
+            os.link(init_path, f"{list_path}\\{service_name}.ini")
+
+
+# Length of the union of (start, end) intervals
+def union_seconds(intervals: list):
+    total = 0.0
+    current_start = current_end = None
+    for start, end in sorted(intervals):
+        if current_end is None or start > current_end:
+            if current_end is not None:
+                total += current_end - current_start
+            current_start, current_end = start, end
+        else:
+            current_end = max(current_end, end)
+    if current_end is not None:
+        total += current_end - current_start
+    return total
+
+
+# Bytes of every file under a folder, leaving out subfolders with the excluded names
+def folder_bytes(folder_path: str, exclude: tuple = ()):
+    total = 0
+    for root, dirs, files in os.walk(folder_path):
+        dirs[:] = [dir_name for dir_name in dirs if dir_name.lower() not in exclude]
+        for file_name in files:
+            total += os.path.getsize(os.path.join(root, file_name))
+    return total
+
+
+# Wall time per stage, process utilization and I/O volume of one run
+def summarize_run(run_number: int, changed: bool, wall_seconds: float, stats_dir: str, target_folder_path: str,
+                  cpu_seconds, config: dict):
+    records = []
+    for file_name in os.listdir(stats_dir):
+        with open(os.path.join(stats_dir, file_name), "r") as stats_reader:
+            records.extend(json.loads(line) for line in stats_reader if line.strip())
+    with portal_lock:
+        records.extend(portal_records)
+    records = [entry for entry in records if entry["run"] == run_number]
+
+    stages = {}
+    for stage in sorted(set(entry["stage"] for entry in records)):
+        stage_records = [entry for entry in records if entry["stage"] == stage]
+        stages[stage] = {"wall_seconds": round(union_seconds([(entry["start"], entry["end"])
+                                                              for entry in stage_records]), 3),
+                         "busy_seconds": round(sum(entry["end"] - entry["start"] for entry in stage_records), 3),
+                         "calls": len(stage_records), "bytes": sum(entry["bytes"] for entry in stage_records),
+                         "rows": sum(entry["rows"] for entry in stage_records)}
+
+    # Pipeline processes are busy while they are inside a stand-in call
+    processes = {}
+    for pid in sorted(set(entry["pid"] for entry in records if entry["pid"] != "portal")):
+        busy = union_seconds([(entry["start"], entry["end"]) for entry in records if entry["pid"] == pid])
+        processes[str(pid)] = {"busy_seconds": round(busy, 3),
+                               "utilization": round(busy / wall_seconds, 3) if wall_seconds else 0}
+    utilization = sum(process["busy_seconds"] for process in processes.values()) / \
+        (wall_seconds * len(processes)) if processes and wall_seconds else 0
+
+    data_path = f"{target_folder_path}\\data"
+    history_bytes = folder_bytes(f"{data_path}\\history")
+    data_bytes = folder_bytes(data_path, ("history",))
+    written_bytes = sum(entry["bytes"] for entry in records if entry["pid"] != "portal")
+    uploaded_bytes = sum(entry["bytes"] for entry in records if entry["pid"] == "portal" and entry["stage"] == "upload")
+    return {"run": run_number, "changed": changed, "wall_seconds": round(wall_seconds, 3), "cpu_seconds": cpu_seconds,
+            "stages": stages, "processes": processes, "utilization": round(utilization, 3),
+            "hosted_layers": check_hosted_layers(),
+            "data_folder": {"services_missing": check_data_folder(target_folder_path, config)},
+            "io": {"written_bytes": written_bytes, "uploaded_bytes": uploaded_bytes,
+                   "rows_read": stages.get("read", {}).get("rows", 0),
+                   "data_folder_bytes": data_bytes, "history_bytes": history_bytes}}
+
+
+# Services whose outputs are missing from the network data folder after a run: a feature service keeps its extract
+# GDBs and project, a vector tile service its package, whether the run rebuilt or skipped it
+def check_data_folder(target_folder_path: str, config: dict):
+    data_path = f"{target_folder_path}\\data"
+    names = [name.upper() for name in os.listdir(data_path)] if os.path.exists(data_path) else []
+    missing = []
+    for service_number in range(config["services"]):
+        service_name = f"BENCH_{service_number:02d}"
+        if service_number < config["vector_tile_services"]:
+            kept = any(name.startswith(f"{service_name}_") and name.endswith(".VTPK") for name in names)
+        else:
+            kept = f"{service_name}.APRX" in names and f"{service_name}_DATA" in names and \
+                folder_bytes(os.path.join(data_path, f"{service_name}_data")) > 0
+        if not kept:
+            missing.append(service_name)
+    return missing
+
+
+# Correctness failures of a run: hosted rows that differ from their sources, duplicate adds and services whose
+# outputs are missing from the data folder
+def check_run(run: dict):
+    failures = []
+    for check, value in (("hosted_layers.rows_mismatched", run["hosted_layers"]["rows_mismatched"]),
+                         ("hosted_layers.duplicate_adds", run["hosted_layers"]["duplicate_adds"]),
+                         ("data_folder.services_missing", run["data_folder"]["services_missing"])):
+        if value:
+            failures.append({"run": run["run"], "check": check, "value": value})
+    return failures
+
+
+# Version of the tree being measured
+def get_version():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode("utf-8").strip()
+    except Exception:
+        return None
+
+
+# Regressions of a result against a baseline result, per run: total wall time and wall time per stage
+def compare_results(results: dict, baseline: dict, tolerance: float):
+    regressions = []
+    for run, base_run in zip(results["runs"], baseline["runs"]):
+        metrics = [("wall_seconds", run["wall_seconds"], base_run["wall_seconds"])]
+        for stage, stage_result in run["stages"].items():
+            if stage in base_run["stages"]:
+                metrics.append((f"stages.{stage}.wall_seconds", stage_result["wall_seconds"],
+                                base_run["stages"][stage]["wall_seconds"]))
+        for metric, value, base_value in metrics:
+            if value > base_value * (1 + tolerance) and value - base_value > regression_floor_seconds:
+                regressions.append({"run": run["run"], "metric": metric, "value": value, "baseline": base_value})
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Python.py with stand-in arcpy and portal")
+    parser.add_argument("--services", type=int, default=bench_services)
+    parser.add_argument("--vector-tile-services", type=int, default=bench_vector_tile_services)
+    parser.add_argument("--layers", type=int, default=bench_layers)
+    parser.add_argument("--rows", type=int, default=bench_rows)
+    parser.add_argument("--row-bytes", type=int, default=bench_row_bytes)
+    parser.add_argument("--runs", type=int, default=bench_runs)
+    parser.add_argument("--changed-layers", type=float, default=bench_changed_layers)
+    parser.add_argument("--unchanged-runs", type=int, default=bench_unchanged_runs)
+    parser.add_argument("--delta-key", default=bench_delta_key, help="DELTAKEY of the feature services, "
+                                                                     "None to publish them by overwriting")
+    parser.add_argument("--shared-layers", type=float, default=bench_shared_layers)
+    parser.add_argument("--work-dir", default="benchmark_work")
+    parser.add_argument("--output", help="JSON results file, printed when left out")
+    parser.add_argument("--compare", help="Baseline JSON results, exits 1 on a regression")
+    parser.add_argument("--tolerance", type=float, default=regression_tolerance)
+    args = parser.parse_args()
+
+    # Only a folder this benchmark made is ever removed
+    work_dir = os.path.abspath(args.work_dir)
+    if os.path.exists(work_dir):
+        if not os.path.exists(os.path.join(work_dir, ".benchmark")):
+            sys.exit(f"{work_dir} exists and was not made by this benchmark")
+        shutil.rmtree(work_dir)
+    local_path = os.path.join(work_dir, "pipeline")
+    stats_dir = os.path.join(work_dir, "stats")
+    os.makedirs(local_path)
+    os.makedirs(stats_dir)
+    open(os.path.join(work_dir, ".benchmark"), "w").close()
+    os.chdir(local_path)
+
+    server = StandInPortalServer(("127.0.0.1", 0), StandInPortalHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    portal_url = f"http://127.0.0.1:{server.server_port}/portal"
+
+    config = {"run": 0, "stats_dir": stats_dir, "services": args.services,
+              "vector_tile_services": args.vector_tile_services, "layers": args.layers, "rows": args.rows,
+              "row_bytes": args.row_bytes, "delta_key": None if args.delta_key.upper() == "NONE" else args.delta_key,
+              "shared_layers": args.shared_layers, "settings": bench_settings, "datasets": {}}
+    target_folder_path = "benchmark\\portal\\folder"
+    build_services(local_path, target_folder_path, portal_url, config)
+
+    import Python
+    results = {"version": get_version(), "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+               "python": platform.python_version(), "platform": platform.platform(), "cpu_count": mp.cpu_count(),
+               "config": {key: value for key, value in config.items() if key not in ("datasets", "stats_dir", "run")},
+               "runs": []}
+    results["config"]["changed_layers"] = args.changed_layers
+    results["config"]["unchanged_runs"] = args.unchanged_runs
+    dataset_names = sorted(config["datasets"])
+    for run_number in range(1, args.runs + args.unchanged_runs + 1):
+        # Edit a share of the layers before every run after the first, then leave them for the unchanged runs
+        changed = run_number == 1 or (run_number <= args.runs and args.changed_layers > 0)
+        if 1 < run_number <= args.runs:
+            for dataset_name in dataset_names[::max(1, int(round(1 / args.changed_layers)))] \
+                    if args.changed_layers > 0 else []:
+                config["datasets"][dataset_name]["generation"] += 1
+        config["run"] = run_number
+        os.environ[config_variable] = json.dumps(config)
+        apply_settings()
+
+        sys.argv = ["Python.py", target_folder_path]
+        times_before = os.times()
+        run_start = time.time()
+        Python.main()
+        wall_seconds = time.time() - run_start
+        times_after = os.times()
+        cpu_seconds = None
+        if platform.system() != "Windows":
+            cpu_seconds = round(sum(times_after[:4]) - sum(times_before[:4]), 3)
+        results["runs"].append(summarize_run(run_number, changed, wall_seconds, stats_dir, target_folder_path,
+                                              cpu_seconds, config))
+    server.shutdown()
+
+    results["failures"] = [failure for run in results["runs"] for failure in check_run(run)]
+    exit_code = 1 if results["failures"] else 0
+    if args.compare:
+        with open(args.compare, "r") as baseline_reader:
+            results["regressions"] = compare_results(results, json.load(baseline_reader), args.tolerance)
+        exit_code = 1 if results["regressions"] or results["failures"] else 0
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as output_writer:
+            output_writer.write(output)
+    else:
+        print(output)
+    sys.exit(exit_code)
+
+
+# Spawned pipeline processes import this module first, so they get the stand-ins before Python.py imports arcpy
+install_stand_ins()
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+if __name__ != "__main__":
+    apply_settings()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+## Shared fixtures for the Python.py tests
+## Python.py imports arcpy and arcgis.gis at the top, install_stubs registers empty modules for them so it imports
+## without ArcGIS Pro; each test hands Python.py a stand-in for the arcpy calls it makes
+
+import os
+import sys
+import copy
+import types
+import importlib
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+# Register empty arcpy and arcgis.gis modules
+def install_stubs():
+    arcpy = types.ModuleType("arcpy")
+    arcgis = types.ModuleType("arcgis")
+    arcgis.gis = types.ModuleType("arcgis.gis")
+    arcgis.gis.GIS = None
+    arcgis.gis.Item = None
+    sys.modules.update({"arcpy": arcpy, "arcgis": arcgis, "arcgis.gis": arcgis.gis})
+
+
+# Python.py, imported once over the stubs
+@pytest.fixture(scope="session")
+def pipeline_module():
+    install_stubs()
+    return importlib.import_module("Python")
+
+
+# Python.py with its paths in a temporary folder, logging to a file there and its own copy of config
+@pytest.fixture
+def pipeline(pipeline_module, tmp_path, monkeypatch):
+    for folder_name in ("state", "history", "data"):
+        os.makedirs(tmp_path / folder_name)
+    monkeypatch.setattr(pipeline_module, "config", copy.deepcopy(pipeline_module.config))
+    monkeypatch.setattr(pipeline_module, "log_file", str(tmp_path / "log.txt"), raising=False)
+    monkeypatch.setattr(pipeline_module, "cur_log_file_path", None, raising=False)
+    monkeypatch.setattr(pipeline_module, "local_path", str(tmp_path), raising=False)
+    monkeypatch.setattr(pipeline_module, "state_path", str(tmp_path / "state"), raising=False)
+    monkeypatch.setattr(pipeline_module, "history_path", str(tmp_path / "history"), raising=False)
+    monkeypatch.setattr(pipeline_module, "local_data_path", str(tmp_path / "data"), raising=False)
+    monkeypatch.setattr(pipeline_module, "local_hisotry_path", str(tmp_path / "history"), raising=False)
+    monkeypatch.setattr(pipeline_module, "log_queue", None)
+    monkeypatch.setattr(pipeline_module, "trace_file", None)
+    pipeline_module.retry_stats.clear()
+    return pipeline_module
@@ -0,0 +1,111 @@
+import datetime
+import sqlite3
+import types
+import pytest
+
+
+class FakeField:
+    def __init__(self, name, field_type, length=0):
+        self.name = name
+        self.type = field_type
+        self.length = length
+
+
+class FakeCursor:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def __enter__(self):
+        return iter(self.rows)
+
+    def __exit__(self, *args):
+        return False
+
+
+# arcpy with one table of ASSET_ID and NAME, read from rows
+@pytest.fixture
+def table(pipeline, monkeypatch):
+    rows = [(1, "one"), (2, "two"), (3, "three")]
+    fields = [FakeField("OBJECTID", "OID"), FakeField("ASSET_ID", "Integer"), FakeField("NAME", "String", 50)]
+    fake_arcpy = types.SimpleNamespace(
+        ListFields=lambda fc_path: fields,
+        da=types.SimpleNamespace(SearchCursor=lambda fc_path, field_names, spatial_reference=None: FakeCursor(rows)))
+    monkeypatch.setattr(pipeline, "arcpy", fake_arcpy)
+    return rows
+
+
+def plan(pipeline, unchanged_layers=()):
+    manifest = pipeline.LayerManifest("Assets", "assets", "Assets", "data.gdb", {}, 0, 0, 0.0)
+    prj_map = types.SimpleNamespace(spatialReference=None)
+    return pipeline.plan_delta_edits("service", {None: "ASSET_ID"}, [manifest], set(unchanged_layers), prj_map)
+
+
+def read_edits(pipeline):
+    snapshot_db = sqlite3.connect(f"{pipeline.get_row_snapshot_path('service')}.new")
+    try:
+        return sorted(snapshot_db.execute("SELECT operation, key FROM edits").fetchall())
+    finally:
+        snapshot_db.close()
+
+
+def test_get_delta_keys(pipeline):
+    assert pipeline.get_delta_keys({}) is None
+    assert pipeline.get_delta_keys({"DELTAKEY": "None"}) is None
+    assert pipeline.get_delta_keys({"DELTAKEY": "ASSET_ID"}) == {None: "ASSET_ID"}
+    assert pipeline.get_delta_keys({"DELTAKEY": "ASSET_ID, Layer A: OTHER"}) == {None: "ASSET_ID", "Layer A": "OTHER"}
+    pipeline.config["delta"]["publish"] = False
+    assert pipeline.get_delta_keys({"DELTAKEY": "ASSET_ID"}) is None
+
+
+def test_delta_key_values_match_by_type(pipeline):
+    assert pipeline.get_delta_key_value(1, "Double") == pipeline.get_delta_key_value(1.0, "Double")
+    assert pipeline.get_delta_key_value(7.0, "Integer") == "7"
+    assert pipeline.get_delta_key_value("A-1", "String") == "A-1"
+    key_date = datetime.datetime(2024, 3, 5, 10, 30)
+    assert pipeline.get_delta_key_value(key_date, "Date") == \
+        pipeline.get_delta_key_value(pipeline.get_epoch_milliseconds(key_date), "Date")
+
+
+def test_key_literals_by_type(pipeline):
+    assert pipeline.get_key_literal("O'Brien", "String") == "'O''Brien'"
+    assert pipeline.get_key_literal("7", "Integer") == "7"
+    assert pipeline.get_key_literal("2.5", "Double") == "2.5"
+    key = pipeline.get_delta_key_value(datetime.datetime(2024, 3, 5, 10, 30), "Date")
+    assert pipeline.get_key_literal(key, "Date") == "DATE '2024-03-05 10:30:00'"
+    key = pipeline.get_delta_key_value(datetime.datetime(2024, 3, 5, 10, 30, 0, 250000), "Date")
+    assert pipeline.get_key_literal(key, "Date") == "TIMESTAMP '2024-03-05 10:30:00.250'"
+
+
+def test_plan_delta_edits(pipeline, table):
+    # The first publish has no snapshot to compare with
+    assert plan(pipeline) is None
+    pipeline.commit_row_snapshot("service")
+
+    pipeline.config["delta"]["max_share"] = 1
+    table[1] = (2, "second")
+    table[2] = (4, "four")
+    assert plan(pipeline) == 3
+    assert read_edits(pipeline) == [("add", "4"), ("delete", "3"), ("update", "2")]
+
+
+def test_unchanged_layers_keep_their_snapshot(pipeline, table):
+    plan(pipeline)
+    pipeline.commit_row_snapshot("service")
+    table[0] = (1, "changed")
+    assert plan(pipeline, ["assets"]) == 0
+
+
+def test_too_many_edits_overwrite(pipeline, table):
+    plan(pipeline)
+    pipeline.commit_row_snapshot("service")
+    pipeline.config["delta"]["max_share"] = 0.5
+    table[:] = [(1, "a"), (2, "b"), (3, "c")]
+    assert plan(pipeline) is None
+    assert read_edits(pipeline) == []
+
+
+def test_repeated_keys_overwrite(pipeline, table):
+    plan(pipeline)
+    pipeline.commit_row_snapshot("service")
+    table.append((1, "again"))
+    assert plan(pipeline) is None
@@ -0,0 +1,88 @@
+import types
+import pytest
+
+
+class FakeField:
+    def __init__(self, name, required=False):
+        self.name = name
+        self.required = required
+
+
+class FakeFieldInfo:
+    def __init__(self, visibility: dict):
+        self.names = list(visibility)
+        self.visibility = visibility
+        self.count = len(self.names)
+
+    def getFieldName(self, index):
+        return self.names[index]
+
+    def getVisible(self, index):
+        return "VISIBLE" if self.visibility[self.names[index]] else "HIDDEN"
+
+
+# Layer with a unique value renderer on ZONE, a label class and a pop-up
+class FakeLayer:
+    def __init__(self, popup_info=None):
+        self.symbology = types.SimpleNamespace(renderer=types.SimpleNamespace(fields=["Zone"]))
+        self.popup_info = popup_info
+
+    def __str__(self):
+        return "Assets"
+
+    def supports(self, property_name):
+        return property_name in ("SYMBOLOGY", "SHOWLABELS")
+
+    def listLabelClasses(self):
+        return [types.SimpleNamespace(expression="$feature.LABEL_TEXT", SQLQuery="STATUS = 'A'")]
+
+    def getDefinition(self, version):
+        return types.SimpleNamespace(popupInfo=self.popup_info)
+
+
+@pytest.fixture
+def source(pipeline, monkeypatch):
+    fields = [FakeField("OBJECTID", True), FakeField("Shape", True), FakeField("ASSET_ID"), FakeField("NAME"),
+              FakeField("Zone"), FakeField("LABEL_TEXT"), FakeField("STATUS"), FakeField("OWNER"),
+              FakeField("NOTES"), FakeField("INSPECTED"), FakeField("PHOTO_COUNT"), FakeField("UNUSED")]
+    field_info = FakeFieldInfo({field.name: field.name in ("NAME", "OBJECTID") for field in fields})
+    fake_arcpy = types.SimpleNamespace(ListFields=lambda fc_path: fields,
+                                       Describe=lambda layer: types.SimpleNamespace(fieldInfo=field_info))
+    monkeypatch.setattr(pipeline, "arcpy", fake_arcpy)
+    return pipeline
+
+
+def test_layer_keeps_the_fields_it_uses(source):
+    field_names = source.get_layer_fields(FakeLayer(), "SDE.ASSETS", "OWNER = 'CITY'",
+                                          {None: ["ASSET_ID"], "Other": ["NOTES"]})
+    assert field_names == ["ASSET_ID", "LABEL_TEXT", "NAME", "OBJECTID", "OWNER", "STATUS", "Shape", "Zone"]
+
+
+def test_popup_fields_are_kept(source):
+    popup_info = types.SimpleNamespace(
+        title="{NOTES}", mediaInfos=[types.SimpleNamespace(fields=["PHOTO_COUNT"], text="")], expressionInfos=[],
+        fieldInfos=[types.SimpleNamespace(fieldName="INSPECTED", visible=True),
+                    types.SimpleNamespace(fieldName="UNUSED", visible=False)])
+    field_names = source.get_layer_fields(FakeLayer(popup_info), "SDE.ASSETS", "", {None: []})
+    assert {"NOTES", "PHOTO_COUNT", "INSPECTED"} <= set(field_names)
+    assert "UNUSED" not in field_names
+
+
+def test_every_field_is_kept_without_pruning(source):
+    assert source.get_layer_fields(FakeLayer(), "SDE.ASSETS", "", None) is None
+
+
+# A layer that cannot be read is extracted whole
+def test_unreadable_layer_keeps_every_field(source):
+    layer = FakeLayer()
+    layer.listLabelClasses = None
+    assert source.get_layer_fields(layer, "SDE.ASSETS", "", {None: []}) is None
+
+
+def test_get_keep_fields(pipeline):
+    assert pipeline.get_keep_fields({"KEEPFIELDS": "ALL"}) is None
+    assert pipeline.get_keep_fields({}) == {None: []}
+    assert pipeline.get_keep_fields({"KEEPFIELDS": "NAME, Layer A: CODE", "DELTAKEY": "ASSET_ID"}) == \
+        {None: ["NAME", "ASSET_ID"], "Layer A": ["CODE"]}
+    pipeline.config["extract"]["prune_fields"] = False
+    assert pipeline.get_keep_fields({"KEEPFIELDS": "NAME"}) is None
@@ -0,0 +1,89 @@
+import re
+import types
+import pytest
+
+
+class FakeField:
+    def __init__(self, name, field_type, length=0):
+        self.name = name
+        self.type = field_type
+        self.length = length
+
+
+# Cursor over rows of {field: value}, with the where clauses and order get_source_fingerprint asks for
+# A descending order sorts nulls first, as Oracle does
+class FakeCursor:
+    def __init__(self, rows, field_names, where_clause=None, sql_clause=(None, None)):
+        self.rows = [row for row in rows if matches(row, where_clause)]
+        if sql_clause and sql_clause[1]:
+            order_field = sql_clause[1].split()[2]
+            self.rows.sort(key=lambda row: (row[order_field] is not None, row[order_field] or ""), reverse=True)
+        self.field_names = field_names
+
+    def __enter__(self):
+        return iter([tuple(row.get(name) for name in self.field_names) for row in self.rows])
+
+    def __exit__(self, *args):
+        return False
+
+
+def matches(row, where_clause):
+    for condition in re.split(r" AND ", where_clause or ""):
+        condition = condition.strip("() ")
+        if condition.endswith(" IS NOT NULL"):
+            if row[condition.split()[0]] is None:
+                return False
+        elif condition.endswith(" IS NULL"):
+            if row[condition.split()[0]] is not None:
+                return False
+        elif condition:
+            field_name, value = condition.split(" = ")
+            if str(row[field_name]) != value:
+                return False
+    return True
+
+
+# arcpy with one editor tracked table, read from rows
+@pytest.fixture
+def table(pipeline, monkeypatch):
+    rows = [{"OBJECTID": 1, "ZONE": 1, "EDITED": "2024-01-01"}, {"OBJECTID": 2, "ZONE": 1, "EDITED": None},
+            {"OBJECTID": 3, "ZONE": 2, "EDITED": "2024-01-02"}]
+    desc = types.SimpleNamespace(fields=[FakeField("OBJECTID", "OID"), FakeField("ZONE", "Integer"),
+                                         FakeField("EDITED", "Date")],
+                                 editorTrackingEnabled=True, editedAtFieldName="EDITED", OIDFieldName="OBJECTID")
+    fake_arcpy = types.SimpleNamespace(
+        Describe=lambda fc_path: desc,
+        GetCount_management=lambda fc_path: types.SimpleNamespace(getOutput=lambda index: str(len(rows))),
+        da=types.SimpleNamespace(SearchCursor=lambda fc_path, field_names, where_clause=None, sql_clause=(None, None):
+                                 FakeCursor(rows, field_names, where_clause, sql_clause)))
+    monkeypatch.setattr(pipeline, "arcpy", fake_arcpy)
+    return rows
+
+
+@pytest.mark.parametrize("definition_query", ["", "ZONE = 1"])
+def test_edit_next_to_a_row_without_edit_date(pipeline, table, definition_query):
+    fingerprint, row_count = pipeline.get_source_fingerprint("SDE.ASSETS", definition_query)
+    assert row_count == (3 if definition_query == "" else 2)
+
+    # The latest edit date is read past the row without one, which a descending order puts first
+    table[0]["EDITED"] = "2024-02-01"
+    changed_fingerprint, row_count = pipeline.get_source_fingerprint("SDE.ASSETS", definition_query)
+    assert changed_fingerprint != fingerprint
+    assert pipeline.get_source_fingerprint("SDE.ASSETS", definition_query)[0] == changed_fingerprint
+
+
+# A row given an edit date older than the latest one changes only the count of rows without one
+def test_rows_without_edit_date_are_counted(pipeline, table):
+    fingerprint = pipeline.get_source_fingerprint("SDE.ASSETS", "")[0]
+    table[1]["EDITED"] = "2023-12-31"
+    assert pipeline.get_source_fingerprint("SDE.ASSETS", "")[0] != fingerprint
+
+
+def test_is_unchanged(pipeline):
+    prior_state = {"published": True, "project": "project hash", "layers": {"Assets": {"fingerprint": "a"}}}
+    assert pipeline.is_unchanged(prior_state, {"Assets": "a"}, "project hash")
+    assert not pipeline.is_unchanged(prior_state, {"Assets": "b"}, "project hash")
+    assert not pipeline.is_unchanged(prior_state, {"Assets": "a", "Parcels": "c"}, "project hash")
+    # A project edited on its own, symbology or labels, is published again
+    assert not pipeline.is_unchanged(prior_state, {"Assets": "a"}, "edited project hash")
+    assert not pipeline.is_unchanged(dict(prior_state, published=False), {"Assets": "a"}, "project hash")
@@ -0,0 +1,66 @@
+import os
+import time
+
+
+# Write files into a data folder, {relative path: text}
+def write_files(data_dir, files: dict):
+    for rel_path, text in files.items():
+        file_path = os.path.join(data_dir, rel_path)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, "w") as file_writer:
+            file_writer.write(text)
+
+
+# Add a generation, waiting out the second the last one was named for
+def add_generation(pipeline, data_dir):
+    generations = pipeline.list_history_generations()
+    while generations and time.strftime('%Y%m%d_%H%M%S') <= generations[-1]:
+        time.sleep(0.1)
+    return pipeline.add_history_generation(str(data_dir))
+
+
+def count_objects(pipeline):
+    return sum(len(files) for root, dirs, files in os.walk(os.path.join(pipeline.history_path, "objects")))
+
+
+def test_store_object_once(pipeline, tmp_path):
+    write_files(tmp_path / "src", {"a.txt": "same", "b.txt": "same"})
+    file_hash = pipeline.get_file_hash(str(tmp_path / "src" / "a.txt"))
+    assert pipeline.store_history_object(str(tmp_path / "src" / "a.txt"), file_hash) > 0
+    assert pipeline.store_history_object(str(tmp_path / "src" / "b.txt"), file_hash) == 0
+
+
+def test_add_and_restore(pipeline, tmp_path):
+    write_files(tmp_path / "src", {"a.txt": "alpha", os.path.join("gdb", "b.txt"): "beta", "c.txt": "alpha",
+                                   os.path.join("history", "old.txt"): "skipped"})
+    generation = add_generation(pipeline, tmp_path / "src")
+    files = pipeline.read_history_generation(generation)
+    assert set(files) == {"a.txt", os.path.join("gdb", "b.txt"), "c.txt"}
+    # Files with the same contents share one object
+    assert count_objects(pipeline) == 2
+
+    pipeline.restore_history_generation("latest", str(tmp_path / "restored"))
+    for rel_path in files:
+        with open(tmp_path / "src" / rel_path) as source, open(tmp_path / "restored" / rel_path) as restored:
+            assert source.read() == restored.read()
+        assert int(os.path.getmtime(tmp_path / "restored" / rel_path)) == files[rel_path][2]
+
+
+def test_evict_oldest_generations(pipeline, tmp_path):
+    pipeline.config["history"]["generations"] = 2
+    generations = []
+    for text in ("one", "two", "three"):
+        write_files(tmp_path / "src", {"a.txt": text, "b.txt": "kept"})
+        generations.append(add_generation(pipeline, tmp_path / "src"))
+    assert pipeline.list_history_generations() == generations[1:]
+    # Only the contents the kept generations use remain
+    assert count_objects(pipeline) == 3
+
+
+def test_evict_over_byte_budget_keeps_newest(pipeline, tmp_path):
+    pipeline.config["history"]["byte_budget"] = 1
+    write_files(tmp_path / "src", {"a.txt": "one"})
+    add_generation(pipeline, tmp_path / "src")
+    write_files(tmp_path / "src", {"a.txt": "two"})
+    newest = add_generation(pipeline, tmp_path / "src")
+    assert pipeline.list_history_generations() == [newest]
@@ -0,0 +1,57 @@
+import datetime
+import struct
+import zipfile
+import pytest
+
+from vector_tile_package import read_bundle_tiles, write_bundle
+
+bundle_member = "p12/tile/L00/R0000C0000.bundle"
+header = struct.pack("<II", 3, 16384) + bytes(56)
+tiling_scheme_xml = ("<TileCacheInfo><TileOrigin><X>0</X><Y>1024</Y></TileOrigin><TileCols>256</TileCols>"
+                     "<TileRows>256</TileRows><LODInfos><LODInfo><LevelID>0</LevelID><Scale>1000</Scale>"
+                     "<Resolution>1</Resolution></LODInfo></LODInfos></TileCacheInfo>")
+
+
+# A last package with tiles 0 and 1 of level 0, and build_partial_vtpk building the given tiles of level 0
+@pytest.fixture
+def packages(pipeline, tmp_path, monkeypatch):
+    with zipfile.ZipFile(tmp_path / "history" / "prior.vtpk", "w") as prior_zip:
+        prior_zip.writestr("p12/root.json", "{}")
+        prior_zip.writestr(bundle_member, write_bundle(header, {0: b"old tile 0", 1: b"old tile 1"}))
+    (tmp_path / "scheme.xml").write_text(tiling_scheme_xml)
+    new_tiles = {0: b"new tile 0"}
+
+    def build_partial_vtpk(prj_map, tiling_scheme, tiling_scheme_path, level, tiles, partial_path, description,
+                           tags):
+        with zipfile.ZipFile(partial_path, "w") as partial_zip:
+            partial_zip.writestr(bundle_member, write_bundle(header, new_tiles))
+    monkeypatch.setattr(pipeline, "build_partial_vtpk", build_partial_vtpk)
+    return pipeline, new_tiles
+
+
+def build(pipeline, tmp_path, changed_extents):
+    prior_state = {"package": "prior.vtpk", "project": "hash",
+                   "full_build": datetime.datetime.now().strftime("%m_%d_%Y")}
+    return pipeline.build_incremental_vtpk(None, "service", prior_state, changed_extents, "hash",
+                                           str(tmp_path / "today.vtpk"), str(tmp_path / "scheme.xml"), 1000, "", "")
+
+
+def test_changed_tile_is_replaced(packages, tmp_path):
+    pipeline, new_tiles = packages
+    assert build(pipeline, tmp_path, [(10, 1000, 20, 1010)])
+    with zipfile.ZipFile(tmp_path / "today.vtpk") as today_zip:
+        assert read_bundle_tiles(today_zip.read(bundle_member)) == {0: b"new tile 0", 1: b"old tile 1"}
+        assert today_zip.read("p12/root.json") == b"{}"
+
+
+# A tile that is now empty is still in the last package's tile map, so the package is built in full
+def test_emptied_tile_needs_a_full_build(packages, tmp_path):
+    pipeline, new_tiles = packages
+    assert not build(pipeline, tmp_path, [(300, 1000, 310, 1010)])
+    assert not (tmp_path / "today.vtpk").exists()
+
+
+def test_new_tile_needs_a_full_build(packages, tmp_path):
+    pipeline, new_tiles = packages
+    new_tiles[2] = b"new tile 2"
+    assert not build(pipeline, tmp_path, [(520, 1000, 530, 1010)])
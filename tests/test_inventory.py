@@ -0,0 +1,56 @@
+import types
+import pytest
+
+
+def make_item(item_id, title, item_type="Feature Service"):
+    return types.SimpleNamespace(id=item_id, title=title, type=item_type)
+
+
+# gis whose content is searched a page at a time, as advanced_search pages with start and nextStart
+class FakeGIS:
+    def __init__(self, items):
+        self.url = "https://portal.example.com/portal"
+        self.items = items
+        self.pages = []
+        self.content = types.SimpleNamespace(advanced_search=self.advanced_search, search=self.search)
+
+    def advanced_search(self, query, max_items, start, sort_field):
+        self.pages.append(start)
+        results = self.items[start - 1:start - 1 + max_items]
+        next_start = start + max_items if start - 1 + max_items < len(self.items) else -1
+        return {"results": results, "nextStart": next_start}
+
+    def search(self, query, item_type=None):
+        return [item for item in self.items if f"title:{item.title} " in query and item.type == item_type]
+
+
+@pytest.fixture
+def gis(pipeline, monkeypatch):
+    monkeypatch.setattr(pipeline, "portal_inventories", {})
+    pipeline.config["portal"]["inventory_page_size"] = 2
+    return FakeGIS([make_item(f"id{index}", f"Service {index}") for index in range(5)])
+
+
+def test_inventory_is_read_a_page_at_a_time(pipeline, gis):
+    inventory = pipeline.get_portal_inventory(gis, "admin")
+    assert gis.pages == [1, 3, 5]
+    assert sorted(inventory["ids"]) == ["id0", "id1", "id2", "id3", "id4"]
+    # Later lookups use the inventory
+    assert [item.id for item in pipeline.find_items(gis, "admin", "service 3", "Feature Service")] == ["id3"]
+    assert pipeline.find_item_by_id(gis, "admin", "id4").title == "Service 4"
+    assert gis.pages == [1, 3, 5]
+
+
+def test_inventory_follows_adds_and_deletes(pipeline, gis):
+    pipeline.add_inventory_item(gis, "admin", make_item("id5", "Service 5"))
+    assert [item.id for item in pipeline.find_items(gis, "admin", "Service 5", "Feature Service")] == ["id5"]
+    pipeline.remove_inventory_item(gis, "admin", gis.items[0])
+    assert pipeline.find_items(gis, "admin", "Service 0", "Feature Service") == []
+
+
+# An item the pipeline did not add is found by asking the portal again
+def test_refresh_finds_items_added_elsewhere(pipeline, gis):
+    pipeline.get_portal_inventory(gis, "admin")
+    gis.items.append(make_item("id9", "Service 9"))
+    assert pipeline.find_items(gis, "admin", "Service 9", "Feature Service") == []
+    assert [item.id for item in pipeline.find_items(gis, "admin", "Service 9", "Feature Service", True)] == ["id9"]
@@ -0,0 +1,67 @@
+import os
+import pytest
+
+
+@pytest.fixture
+def journals(pipeline, monkeypatch):
+    monkeypatch.setattr(pipeline, "run_journal", None)
+    monkeypatch.setattr(pipeline, "service_journal", None)
+    monkeypatch.setattr(pipeline, "service_journal_position", 0)
+    monkeypatch.setattr(pipeline, "trace_run_id", "first run")
+    return pipeline
+
+
+# A run interrupted after its first stage, and the service it was running after its extract checkpoint
+def interrupt_run(pipeline, tmp_path):
+    assert not pipeline.start_run_journal()
+    pipeline.complete_run_stage("sync")
+    assert not pipeline.start_service_journal("service", {"RESUME": "True"})
+    package_path = tmp_path / "data" / "service.vtpk"
+    package_path.write_bytes(b"package")
+    pipeline.checkpoint("extract", {"layers": []})
+    pipeline.checkpoint("package", pipeline.get_file_artifact(str(package_path)))
+    return package_path
+
+
+def test_resume_continues_the_interrupted_run(journals, tmp_path, monkeypatch):
+    interrupt_run(journals, tmp_path)
+    monkeypatch.setattr(journals, "trace_run_id", "second run")
+    journals.config["checkpoints"]["resume"] = True
+    assert journals.start_run_journal()
+    assert journals.run_stage_done("sync")
+    assert journals.run_journal["run"] == "first run"
+
+    assert not journals.start_service_journal("service", {"RESUME": "True"})
+    assert journals.resume_stage("extract", lambda artifacts: True) == {"layers": []}
+    assert journals.resume_stage("package", journals.file_intact)["path"].endswith("service.vtpk")
+    # A stage past the checkpoints is done
+    assert journals.resume_stage("publish", lambda artifacts: True) is None
+
+
+def test_changed_artifact_is_done_again(journals, tmp_path):
+    package_path = interrupt_run(journals, tmp_path)
+    package_path.write_bytes(b"other package")
+    journals.config["checkpoints"]["resume"] = True
+    journals.start_run_journal()
+    journals.start_service_journal("service", {"RESUME": "True"})
+    assert journals.resume_stage("extract", lambda artifacts: True) is not None
+    assert journals.resume_stage("package", journals.file_intact) is None
+    assert [stage for stage, artifacts in journals.read_journal("service")["stages"]] == ["extract"]
+
+
+# Without resume an interrupted run starts over, its journals cleared
+def test_run_starts_over_without_resume(journals, tmp_path, monkeypatch):
+    interrupt_run(journals, tmp_path)
+    monkeypatch.setattr(journals, "trace_run_id", "second run")
+    assert not journals.start_run_journal()
+    assert not journals.run_stage_done("sync")
+    assert journals.read_journal("service") is None
+
+
+def test_finished_service_is_not_run_again(journals, tmp_path):
+    interrupt_run(journals, tmp_path)
+    journals.finish_service_journal(0)
+    journals.complete_run_journal()
+    assert journals.start_service_journal("service", {"RESUME": "True"})
+    assert not journals.start_service_journal("service", {"RESUME": "False"})
+    assert not os.path.exists(f"{journals.get_journal_path('service')}.{os.getpid()}.tmp")
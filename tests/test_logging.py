@@ -0,0 +1,47 @@
+import queue
+
+
+# Log queue that notes what the log file held each time the writer waited on it
+class RecordingQueue(queue.Queue):
+    def __init__(self, log_path):
+        super().__init__()
+        self.log_path = log_path
+        self.seen = []
+
+    def get(self, *args, **kwargs):
+        try:
+            with open(self.log_path) as log_reader:
+                self.seen.append(log_reader.read())
+        except FileNotFoundError:
+            self.seen.append("")
+        return super().get(*args, **kwargs)
+
+
+def test_lines_are_written_in_batches(pipeline, tmp_path):
+    log_path = str(tmp_path / "run.txt")
+    temp_log_path = str(tmp_path / "service.txt")
+    log_queue = RecordingQueue(log_path)
+    ack_queue = queue.Queue()
+    for record in [(log_path, "1\n", None, False), (log_path, "2\n", None, False),
+                   (log_path, "3\n", temp_log_path, False), "FLUSH", (log_path, "4\n", None, False), None]:
+        log_queue.put(record)
+
+    # The writer goes by the settings it is handed, not the config of the process it runs in
+    pipeline.config["logging"]["batch_lines"] = 1000
+    pipeline.log_writer(log_queue, ack_queue, {"batch_lines": 2, "flush_seconds": 3600, "echo": False})
+    assert log_queue.seen == ["", "", "1\n2\n", "1\n2\n", "1\n2\n3\n", "1\n2\n3\n"]
+    with open(log_path) as log_reader:
+        assert log_reader.read() == "1\n2\n3\n4\n"
+    with open(temp_log_path) as log_reader:
+        assert log_reader.read() == "3\n"
+    assert ack_queue.get_nowait() is True
+    assert ack_queue.empty()
+
+
+def test_echo_prints_lines(pipeline, tmp_path, capsys):
+    log_path = str(tmp_path / "run.txt")
+    log_queue = queue.Queue()
+    for record in [(log_path, "shown\n", None, True), (log_path, "hidden\n", None, False), None]:
+        log_queue.put(record)
+    pipeline.log_writer(log_queue, queue.Queue(), {"batch_lines": 200, "flush_seconds": 3600, "echo": True})
+    assert capsys.readouterr().out == "shown\n"
@@ -0,0 +1,65 @@
+import os
+import types
+import pytest
+
+
+class FakeField:
+    def __init__(self, name, field_type):
+        self.name = name
+        self.type = field_type
+
+
+# arcpy over one extract GDB holding Assets, ASSET_ID already indexed, recording the calls that change it
+@pytest.fixture
+def gdb(pipeline, tmp_path, monkeypatch):
+    gdb_path = tmp_path / "data" / "service_data" / "service_1.gdb"
+    os.makedirs(gdb_path)
+    (gdb_path / "a00000001.gdbtable").write_bytes(bytes(4096))
+    calls = []
+    desc = types.SimpleNamespace(dataType="FeatureClass", shapeType="Polygon",
+                                 fields=[FakeField("OBJECTID", "OID"), FakeField("Shape", "Geometry"),
+                                         FakeField("ASSET_ID", "Integer"), FakeField("Zone", "String")])
+
+    def compact(compact_path):
+        calls.append(("Compact", os.path.basename(compact_path)))
+        (gdb_path / "a00000001.gdbtable").write_bytes(bytes(1024))
+    fake_arcpy = types.SimpleNamespace(
+        Exists=lambda fc_path: os.path.basename(fc_path) == "Assets",
+        Describe=lambda fc_path: desc,
+        ListIndexes=lambda fc_path: [types.SimpleNamespace(fields=[FakeField("ASSET_ID", "Integer")])],
+        AddSpatialIndex_management=lambda fc_path: calls.append(("AddSpatialIndex", os.path.basename(fc_path))),
+        AddIndex_management=lambda fc_path, field_name, index_name: calls.append(("AddIndex", field_name)),
+        Compact_management=compact)
+    monkeypatch.setattr(pipeline, "arcpy", fake_arcpy)
+    return pipeline, str(gdb_path), calls
+
+
+def test_optimize_gdb(gdb):
+    pipeline, gdb_path, calls = gdb
+    result = pipeline.optimize_gdb((gdb_path, {"Assets": ["ZONE", "ASSET_ID", "AND"], "Missing": ["ZONE"]},
+                                    pipeline.log_file, None))
+    assert result == (gdb_path, 4096, 1024, 0)
+    assert calls == [("AddSpatialIndex", "Assets"), ("AddIndex", "Zone"), ("Compact", "service_1.gdb")]
+
+
+# A failed index leaves the GDB to be compacted and published
+def test_failed_index_still_compacts(gdb):
+    pipeline, gdb_path, calls = gdb
+
+    def add_index(fc_path, field_name, index_name):
+        raise RuntimeError("ERROR 000464: Cannot get exclusive schema lock")
+    pipeline.arcpy.AddIndex_management = add_index
+    assert pipeline.optimize_gdb((gdb_path, {"Assets": ["ZONE"]}, pipeline.log_file, None))[3] == 0
+    assert calls[-1] == ("Compact", "service_1.gdb")
+
+
+def test_optimize_tasks_index_queries_and_delta_keys(pipeline):
+    manifests = [pipeline.LayerManifest("Assets", "Group\\Assets", "Assets", "a.gdb", {}, 0, 0, 0.0),
+                 pipeline.LayerManifest("Roads", "Roads", "Roads", "a.gdb", {}, 0, 0, 0.0),
+                 pipeline.LayerManifest("Failed", "Failed", "Failed", "b.gdb", {}, 1, 0, 0.0)]
+    extract_tasks = [[0, "Assets", "Group\\Assets", "", "Assets", "ZONE = 3 AND STATUS IS NULL"],
+                     [0, "Roads", "Roads", "", "Roads", ""]]
+    assert pipeline.get_optimize_tasks(manifests, extract_tasks, {None: "ASSET_ID", "Roads": "ROAD_ID"}, "log",
+                                       None) == \
+        [("a.gdb", {"Assets": ["AND", "ASSET_ID", "IS", "NULL", "STATUS", "ZONE"], "Roads": ["ROAD_ID"]}, "log",
+          None)]
@@ -0,0 +1,35 @@
+import pytest
+
+
+# GIS and generateToken stand-ins that count the sign ins
+@pytest.fixture
+def portal(pipeline, monkeypatch):
+    sign_ins = []
+
+    def post_portal_form(url, fields, file_name=None, file_part=None):
+        sign_ins.append(url)
+        return {"token": f"token {len(sign_ins)}"}
+    monkeypatch.setattr(pipeline, "GIS", lambda url, user, password, verify_cert=True: (url, user))
+    monkeypatch.setattr(pipeline, "post_portal_form", post_portal_form)
+    monkeypatch.setattr(pipeline, "portal_sessions", {})
+    return pipeline, sign_ins
+
+
+def test_session_is_reused(portal):
+    pipeline, sign_ins = portal
+    session = pipeline.get_portal_session("https://portal.example.com/portal", "admin", "secret")
+    assert session["token"] == "token 1"
+    assert session["rest_url"] == "https://portal.example.com/portal/sharing/rest"
+    assert pipeline.get_portal_session("https://PORTAL.example.com/portal", "ADMIN", "secret") is session
+    assert sign_ins == ["https://portal.example.com/portal/sharing/rest/generateToken"]
+
+
+# A session is signed in again before its token expires
+def test_token_is_refreshed(portal):
+    pipeline, sign_ins = portal
+    session = pipeline.get_portal_session("https://portal.example.com/portal", "admin", "secret")
+    session["signed_in"] -= pipeline.get_token_refresh_seconds() - 60
+    assert pipeline.get_portal_session("https://portal.example.com/portal", "admin", "secret")["token"] == "token 1"
+    session["signed_in"] -= 120
+    assert pipeline.get_portal_session("https://portal.example.com/portal", "admin", "secret")["token"] == "token 2"
+    assert len(sign_ins) == 2
@@ -0,0 +1,57 @@
+import json
+import pytest
+
+
+# Callable that raises the given errors in turn, then returns "done"
+def failing(*errors):
+    calls = []
+
+    def call():
+        calls.append(len(calls))
+        if len(calls) <= len(errors):
+            raise errors[len(calls) - 1]
+        return "done"
+    call.calls = calls
+    return call
+
+
+@pytest.fixture
+def policy(pipeline):
+    pipeline.config["retry"]["test"] = {"attempts": 3, "delay": 0.001, "max_delay": 0.004, "deadline": 600}
+    return pipeline
+
+
+def test_retries_until_success(policy):
+    call = failing(ConnectionError("reset"), TimeoutError("slow"))
+    assert policy.retry_call("test", call) == "done"
+    assert len(call.calls) == 3
+    assert policy.retry_stats["test"][0] == 2
+
+
+def test_raises_after_last_attempt(policy):
+    call = failing(*[ConnectionError(str(attempt)) for attempt in range(5)])
+    with pytest.raises(ConnectionError, match="2"):
+        policy.retry_call("test", call)
+    assert len(call.calls) == 3
+
+
+def test_fatal_errors_are_not_retried(policy):
+    call = failing(KeyError("missing"))
+    with pytest.raises(KeyError):
+        policy.retry_call("test", call)
+    assert len(call.calls) == 1
+
+
+# An HTML gateway error page fails to parse as JSON, a ValueError, and is retried all the same
+def test_json_parse_errors_are_retried(policy):
+    call = failing(json.JSONDecodeError("Expecting value", "<html>", 0))
+    assert policy.retry_call("test", call) == "done"
+    assert len(call.calls) == 2
+
+
+def test_gives_up_at_the_deadline(policy):
+    policy.config["retry"]["test"]["deadline"] = 0
+    call = failing(ConnectionError("reset"))
+    with pytest.raises(ConnectionError):
+        policy.retry_call("test", call)
+    assert len(call.calls) == 1
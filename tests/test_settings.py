@@ -0,0 +1,29 @@
+import sys
+
+
+def test_settings_file_then_arguments(pipeline, tmp_path, monkeypatch):
+    (tmp_path / "settings.ini").write_text("# Run settings\n[services]\nmax_concurrent = 3\n\n"
+                                           "[portal]\nverify_cert = False\ntoken_minutes = 30\n"
+                                           "[retry.portal]\nattempts = 7\n")
+    monkeypatch.setattr(sys, "argv", ["Python.py", "services.ini", "--set", "services.max_concurrent=5",
+                                      "--profile"])
+    assert pipeline.read_settings() == []
+    assert pipeline.config["services"]["max_concurrent"] == 5
+    assert pipeline.config["portal"]["verify_cert"] is False
+    assert pipeline.config["portal"]["token_minutes"] == 30
+    assert pipeline.config["retry"]["portal"]["attempts"] == 7
+    assert pipeline.config["profiling"]["run"] is True
+
+
+def test_invalid_settings_are_returned(pipeline, monkeypatch):
+    monkeypatch.setattr(sys, "argv", ["Python.py", "services.ini", "--set", "services.max_concurrent=many",
+                                      "--set", "services.missing=1", "--set", "retry.portal=1"])
+    assert pipeline.read_settings() == ["services.max_concurrent", "services.missing", "retry.portal"]
+
+
+def test_parse_setting_by_default_type(pipeline):
+    assert pipeline.parse_setting("true", False) is True
+    assert pipeline.parse_setting("2.5", 1.0) == 2.5
+    assert pipeline.parse_setting("a, b,", ()) == ("a", "b")
+    assert pipeline.parse_setting("None", None) is None
+    assert pipeline.parse_setting("text", "default") == "text"
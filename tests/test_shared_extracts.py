@@ -0,0 +1,95 @@
+import os
+import sys
+import json
+import types
+import subprocess
+import pytest
+
+
+# arcpy that makes an extract by creating its GDB folder, recording each extraction
+@pytest.fixture
+def store(pipeline, tmp_path, monkeypatch):
+    extractions = []
+
+    def create_file_gdb(folder_path, gdb_name):
+        os.makedirs(os.path.join(folder_path, gdb_name))
+    fake_arcpy = types.SimpleNamespace(
+        CreateFileGDB_management=create_file_gdb,
+        FeatureClassToFeatureClass_conversion=lambda fc_path, gdb_path, fc_name, where_clause, field_mapping:
+        extractions.append(fc_path))
+    monkeypatch.setattr(pipeline, "arcpy", fake_arcpy)
+    monkeypatch.setattr(pipeline, "get_field_mappings", lambda fc_path, field_names: None)
+    monkeypatch.setattr(pipeline, "extract_store_path", str(tmp_path / "extract_store"), raising=False)
+    os.makedirs(tmp_path / "extract_store")
+    pipeline.config["extract"]["store_poll_seconds"] = 0.01
+    return pipeline, extractions
+
+
+def get_extract(pipeline):
+    return pipeline.get_shared_extract("key", 2, "SDE.ASSETS", "Assets", "", None, pipeline.log_file)
+
+
+# Id of a process that has exited
+def get_exited_pid():
+    process = subprocess.Popen([sys.executable, "-c", ""])
+    process.wait()
+    return process.pid
+
+
+def test_extract_is_made_once(store):
+    pipeline, extractions = store
+    extract_path = get_extract(pipeline)
+    assert extract_path == os.path.join(pipeline.extract_store_path, "key.gdb", "Assets")
+    assert get_extract(pipeline) == extract_path
+    assert extractions == ["SDE.ASSETS"]
+    assert not os.path.exists(os.path.join(pipeline.extract_store_path, "key.lock"))
+
+
+def test_claim_of_an_exited_process_is_broken(store):
+    pipeline, extractions = store
+    with open(os.path.join(pipeline.extract_store_path, "key.lock"), "w") as lock_writer:
+        lock_writer.write(str(get_exited_pid()))
+    assert get_extract(pipeline).endswith("Assets")
+    assert extractions == ["SDE.ASSETS"]
+    assert sorted(os.listdir(pipeline.extract_store_path)) == ["key.gdb", "key.json"]
+
+
+# A claim held by a running process is waited on until store_wait_seconds
+def test_claim_of_a_running_process_times_out(store):
+    pipeline, extractions = store
+    with open(os.path.join(pipeline.extract_store_path, "key.lock"), "w") as lock_writer:
+        lock_writer.write(str(os.getpid()))
+    pipeline.config["extract"]["store_wait_seconds"] = 0.05
+    with pytest.raises(TimeoutError, match="SDE.ASSETS"):
+        get_extract(pipeline)
+    assert extractions == []
+
+
+def test_claim_being_written_is_not_broken(store):
+    pipeline, extractions = store
+    lock_file = os.path.join(pipeline.extract_store_path, "key.lock")
+    open(lock_file, "w").close()
+    assert not pipeline.break_stale_claim(lock_file)
+    assert os.path.exists(lock_file)
+
+
+# Services extracted before are counted from the extract keys they kept, without opening their projects
+def test_shared_sources_are_counted_from_kept_keys(store, tmp_path):
+    pipeline, extractions = store
+    jobs = []
+    for service_name, keys in (("first", ["a", "b"]), ("second", ["b", "c"])):
+        project_path = tmp_path / f"{service_name}.aprx"
+        project_path.write_text(service_name)
+        init_dict = {"SERVICETYPE": "Feature", "SERVICENAME": service_name, "APRX": str(project_path)}
+        pipeline.write_extract_keys(service_name, pipeline.get_file_hash(str(project_path)),
+                                    pipeline.get_keep_fields(init_dict), [(None,) * 8 + (key,) for key in keys])
+        jobs.append((f"{service_name}.ini", init_dict))
+    pipeline.arcpy.mp = types.SimpleNamespace(ArcGISProject=None)
+    assert pipeline.count_shared_extracts(jobs) == {"b": 2}
+    with open(os.path.join(pipeline.extract_store_path, "shared.json")) as shared_reader:
+        assert json.load(shared_reader) == {"b": 2}
+
+    # An edited project is read again
+    (tmp_path / "second.aprx").write_text("edited")
+    assert pipeline.read_extract_keys("second", pipeline.get_file_hash(str(tmp_path / "second.aprx")),
+                                      pipeline.get_keep_fields(jobs[1][1])) is None
@@ -0,0 +1,70 @@
+import os
+
+
+# Write files into a folder, {relative path: text}
+def write_files(folder_dir, files: dict):
+    for rel_path, text in files.items():
+        file_path = os.path.join(folder_dir, rel_path)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, "w") as file_writer:
+            file_writer.write(text)
+
+
+# {relative path: text} of every file in a folder
+def read_files(folder_dir):
+    files = {}
+    for root, dirs, file_names in os.walk(folder_dir):
+        for file_name in file_names:
+            file_path = os.path.join(root, file_name)
+            with open(file_path) as file_reader:
+                files[os.path.relpath(file_path, folder_dir)] = file_reader.read()
+    return files
+
+
+def test_mirror_copies_changes_and_removes_extra_files(pipeline, tmp_path):
+    write_files(tmp_path / "src", {"a.txt": "alpha", os.path.join("gdb", "b.txt"): "beta"})
+    write_files(tmp_path / "dst", {"a.txt": "old", os.path.join("gdb", "gone.txt"): "gone",
+                                   os.path.join("old_gdb", "c.txt"): "gone"})
+    assert pipeline.sync_folder(str(tmp_path / "src"), str(tmp_path / "dst")) == 0
+    assert read_files(tmp_path / "dst") == {"a.txt": "alpha", os.path.join("gdb", "b.txt"): "beta"}
+    assert not os.path.exists(tmp_path / "dst" / "old_gdb")
+
+
+def test_unchanged_files_are_not_copied(pipeline, tmp_path):
+    write_files(tmp_path / "src", {"a.txt": "alpha"})
+    pipeline.sync_folder(str(tmp_path / "src"), str(tmp_path / "dst"))
+    dst_file = tmp_path / "dst" / "a.txt"
+    os.utime(dst_file, (0, os.path.getmtime(tmp_path / "src" / "a.txt")))
+    dst_inode = os.stat(dst_file).st_ino
+    pipeline.sync_folder(str(tmp_path / "src"), str(tmp_path / "dst"))
+    assert os.stat(dst_file).st_ino == dst_inode
+
+
+# Excluded folders and files are neither copied nor removed
+def test_excluded_names_are_left_alone(pipeline, tmp_path):
+    write_files(tmp_path / "src", {"a.txt": "alpha", os.path.join("History", "new.txt"): "new",
+                                   "Failed.aprx": "new project"})
+    write_files(tmp_path / "dst", {os.path.join("history", "old.txt"): "old", "failed.aprx": "last project"})
+    pipeline.sync_folder(str(tmp_path / "src"), str(tmp_path / "dst"), ("history", "Failed.aprx"))
+    assert read_files(tmp_path / "dst") == {"a.txt": "alpha", os.path.join("history", "old.txt"): "old",
+                                            "failed.aprx": "last project"}
+
+
+def test_nothing_is_removed_after_a_failed_copy(pipeline, tmp_path, monkeypatch):
+    write_files(tmp_path / "src", {"a.txt": "alpha"})
+    write_files(tmp_path / "dst", {"extra.txt": "extra"})
+
+    def sync_file(src_file, dst_file):
+        raise OSError("network name no longer available")
+    monkeypatch.setattr(pipeline, "sync_file", sync_file)
+    assert pipeline.sync_folder(str(tmp_path / "src"), str(tmp_path / "dst")) == 1
+    assert read_files(tmp_path / "dst") == {"extra.txt": "extra"}
+
+
+def test_get_service_outputs(pipeline, tmp_path):
+    write_files(tmp_path / "out", {os.path.join("Parcels_data", "a.gdb"): "", "Parcels.aprx": "",
+                                   "Parcels_10_18_2026.sd": "", "Parcels_10_18_2026.vtpk": "",
+                                   "Parcels_Extra.aprx": "", "Roads.aprx": ""})
+    assert sorted(pipeline.get_service_outputs(str(tmp_path / "out"), "Parcels")) == \
+        ["Parcels.aprx", "Parcels_10_18_2026.sd", "Parcels_10_18_2026.vtpk", "Parcels_data"]
+    assert pipeline.get_service_outputs(str(tmp_path / "missing"), "Parcels") == []
@@ -0,0 +1,101 @@
+import os
+import json
+import hashlib
+import pytest
+
+
+# post_portal_form that answers the upload calls and records the URLs it was sent
+class FakePortal:
+    def __init__(self, item_gone=False):
+        self.urls = []
+        self.item_gone = item_gone
+
+    def __call__(self, url, fields, file_name=None, file_part=None):
+        self.urls.append(url)
+        if url.endswith("/addItem"):
+            return {"id": "new_item"}
+        if url.endswith("/status"):
+            return {"status": "completed"}
+        if "/content/items/" in url and self.item_gone:
+            raise ConnectionError(f"{url} returned HTTP 404")
+        return {"success": True}
+
+
+@pytest.fixture
+def upload(pipeline, tmp_path, monkeypatch):
+    pipeline.config["upload"]["part_bytes"] = 4
+    pipeline.config["upload"]["threads"] = 1
+    file_path = tmp_path / "package.vtpk"
+    file_path.write_bytes(b"partpartpa")
+    portal = FakePortal()
+    monkeypatch.setattr(pipeline, "post_portal_form", portal)
+    return pipeline, str(file_path), portal
+
+
+def get_journal_path(pipeline):
+    return os.path.join(pipeline.state_path, "uploads", "package.vtpk.json")
+
+
+def write_journal(pipeline, file_path, parts):
+    pipeline.write_upload_journal(get_journal_path(pipeline),
+                                  {"item": "old_item", "size": os.path.getsize(file_path),
+                                   "mtime": os.path.getmtime(file_path),
+                                   "part_bytes": pipeline.config["upload"]["part_bytes"], "parts": parts})
+
+
+def test_journal_of_a_changed_file_is_ignored(upload):
+    pipeline, file_path, portal = upload
+    assert pipeline.read_upload_journal(get_journal_path(pipeline), file_path) is None
+    write_journal(pipeline, file_path, {})
+    assert pipeline.read_upload_journal(get_journal_path(pipeline), file_path)["item"] == "old_item"
+    pipeline.config["upload"]["part_bytes"] = 8
+    assert pipeline.read_upload_journal(get_journal_path(pipeline), file_path) is None
+    pipeline.config["upload"]["part_bytes"] = 4
+    with open(file_path, "ab") as file_writer:
+        file_writer.write(b"more")
+    assert pipeline.read_upload_journal(get_journal_path(pipeline), file_path) is None
+
+
+def test_upload_in_parts(upload):
+    pipeline, file_path, portal = upload
+    assert pipeline.upload_file_parts("https://portal/sharing/rest", "token", "owner", file_path,
+                                      {"type": "Vector Tile Package"}) == "new_item"
+    assert sum(url.endswith("/addPart") for url in portal.urls) == 3
+    assert not os.path.exists(get_journal_path(pipeline))
+
+
+def test_resume_sends_only_unconfirmed_parts(upload):
+    pipeline, file_path, portal = upload
+    write_journal(pipeline, file_path, {"1": hashlib.sha1(b"part").hexdigest(), "2": "stale checksum"})
+    assert pipeline.upload_file_parts("https://portal/sharing/rest", "token", "owner", file_path,
+                                      {"type": "Vector Tile Package"}) == "old_item"
+    assert not any(url.endswith("/addItem") for url in portal.urls)
+    assert sum(url.endswith("/addPart") for url in portal.urls) == 2
+    assert not os.path.exists(get_journal_path(pipeline))
+
+
+def test_resume_starts_over_when_the_item_is_gone(upload):
+    pipeline, file_path, portal = upload
+    portal.item_gone = True
+    write_journal(pipeline, file_path, {"1": hashlib.sha1(b"part").hexdigest()})
+    assert pipeline.upload_file_parts("https://portal/sharing/rest", "token", "owner", file_path,
+                                      {"type": "Vector Tile Package"}) == "new_item"
+    assert sum(url.endswith("/addPart") for url in portal.urls) == 3
+
+
+def test_empty_file_is_not_uploaded(upload, tmp_path):
+    pipeline, file_path, portal = upload
+    empty_path = tmp_path / "empty.vtpk"
+    empty_path.write_bytes(b"")
+    with pytest.raises(ValueError, match="empty"):
+        pipeline.upload_item({"gis": None, "rest_url": "https://portal/sharing/rest", "token": "token"}, "owner",
+                             str(empty_path), {"type": "Vector Tile Package"})
+    assert portal.urls == []
+
+
+def test_journal_is_written_atomically(upload):
+    pipeline, file_path, portal = upload
+    write_journal(pipeline, file_path, {"1": "checksum"})
+    with open(get_journal_path(pipeline)) as journal_reader:
+        assert json.load(journal_reader)["parts"] == {"1": "checksum"}
+    assert not os.path.exists(f"{get_journal_path(pipeline)}.tmp")
@@ -0,0 +1,121 @@
+import json
+import types
+import struct
+import zipfile
+import pytest
+
+import vector_tile_package
+from vector_tile_package import read_bundle_tiles, write_bundle, merge_tile_map_nodes, get_changed_tiles, \
+    count_tile_map_node_differences, get_vtpk_shards, merge_vtpk_shards, list_package_bundles, \
+    count_tile_differences, count_tile_map_differences
+
+header = struct.pack("<II", 3, 16384) + bytes(56)
+tiling_scheme = {"origin": (0.0, 1024.0), "cols": 256, "rows": 256, "lods": [(0, 1000.0, 1.0), (1, 500.0, 0.5)]}
+
+
+def test_bundle_round_trip():
+    tiles = {0: b"first", 5: b"second tile", vector_tile_package.vtpk_bundle_dim ** 2 - 1: bytes(300)}
+    bundle_bytes = write_bundle(header, tiles)
+    assert read_bundle_tiles(bundle_bytes) == tiles
+    # The header keeps the bundle's own fields and records the largest tile
+    assert bundle_bytes[:8] == header[:8]
+    assert struct.unpack_from("<I", bundle_bytes, 8)[0] == 300
+
+
+def test_empty_bundle_round_trip():
+    assert read_bundle_tiles(write_bundle(header, {})) == {}
+
+
+def test_corrupt_bundle_index_is_rejected():
+    bundle_bytes = bytearray(write_bundle(header, {3: b"tile"}))
+    struct.pack_into("<Q", bundle_bytes, 64 + 3 * 8, 70 | (4 << 40))
+    with pytest.raises(ValueError):
+        read_bundle_tiles(bytes(bundle_bytes))
+
+
+def test_merge_tile_map_nodes():
+    assert merge_tile_map_nodes(0, 1) == 1
+    assert merge_tile_map_nodes(1, 0) == 1
+    # A node with children wins over a leaf
+    assert merge_tile_map_nodes(0, [1, 0, 0, 1]) == [1, 0, 0, 1]
+    assert merge_tile_map_nodes([1, 0, 0, 1], 1) == [1, 0, 0, 1]
+    assert merge_tile_map_nodes([1, [0, 1, 0, 0], 0, 0], [0, [1, 0, 0, 0], 0, 1]) == [1, [1, 1, 0, 0], 0, 1]
+
+
+def test_count_tile_map_node_differences():
+    assert count_tile_map_node_differences([1, 0, 0, 1], [1, 0, 0, 1]) == 0
+    assert count_tile_map_node_differences([1, 0, 0, 1], 1) == 2
+
+
+def test_changed_tiles_by_bundle():
+    changed_tiles = get_changed_tiles([(10, 1000, 20, 1010)], tiling_scheme, 500, 0, 100)
+    assert changed_tiles == {(0, 0, 0): {(0, 0)}, (1, 0, 0): {(0, 0)}}
+    # Levels finer than the largest cached scale are not in the package
+    assert get_changed_tiles([(10, 1000, 20, 1010)], tiling_scheme, 1000, 0, 100) == {(0, 0, 0): {(0, 0)}}
+
+
+def test_changed_tiles_buffer_reaches_next_tile():
+    changed_tiles = get_changed_tiles([(250, 1000, 254, 1010)], tiling_scheme, 1000, 0.25, 100)
+    assert changed_tiles[(0, 0, 0)] == {(0, 0), (0, 1)}
+
+
+def test_changed_tiles_over_limit():
+    assert get_changed_tiles([(0, 0, 1024, 1024)], tiling_scheme, 1000, 0, 5) is None
+
+
+# Write a package of {(level, bundle row, bundle column): {position: tile}} with its tile map and extent
+def write_package(vtpk_path, bundles: dict, tile_map_index, xmin, xmax):
+    with zipfile.ZipFile(vtpk_path, "w") as vtpk_zip:
+        vtpk_zip.writestr(vector_tile_package.vtpk_root_member,
+                          json.dumps({"fullExtent": {"xmin": xmin, "ymin": 1, "xmax": xmax, "ymax": 32767}}))
+        vtpk_zip.writestr(vector_tile_package.vtpk_tilemap_member, json.dumps({"index": tile_map_index}))
+        vtpk_zip.writestr(vector_tile_package.vtpk_style_member, "{}")
+        for (level, bundle_row, bundle_col), tiles in bundles.items():
+            vtpk_zip.writestr(f"p12/tile/L{level:02d}/R{bundle_row:04x}C{bundle_col:04x}.bundle",
+                              write_bundle(header, tiles))
+
+
+# Tiles of every bundle of a package, {(level, bundle row, bundle column): {position: tile}}
+def read_package_tiles(vtpk_path):
+    with zipfile.ZipFile(vtpk_path) as vtpk_zip:
+        return {bundle_key: read_bundle_tiles(vtpk_zip.read(member_name))
+                for bundle_key, member_name in list_package_bundles(vtpk_zip).items()}
+
+
+# A package built in two strips and a seam build of the coarser levels holds the tiles of a one-shot build
+def test_merged_shards_match_one_shot_build(tmp_path):
+    lods = [(0, 4000.0, 2.0), (1, 2000.0, 1.0), (2, 1000.0, 0.5)]
+    sharded_scheme = {"origin": (0.0, 32768.0), "cols": 256, "rows": 256, "lods": lods}
+    split_level, strips = get_vtpk_shards(types.SimpleNamespace(XMin=0, XMax=65535, YMin=1, YMax=32767),
+                                          sharded_scheme, lods, 2)
+    assert split_level == 1
+    assert strips == [(0, 128, 0, 128), (128, 256, 0, 128)]
+
+    one_shot = {(0, 0, 0): {0: b"L0 west", 1: b"L0 east"},
+                (1, 0, 0): {0: b"L1 west"}, (1, 0, 128): {0: b"L1 east"},
+                (2, 0, 0): {3: b"L2 0"}, (2, 0, 128): {3: b"L2 1"}, (2, 0, 256): {3: b"L2 2"},
+                (2, 0, 384): {3: b"L2 3"}}
+    write_package(tmp_path / "one_shot.vtpk", one_shot, [1, [1, 1, 0, 0], 0, 0], 0, 65535)
+    # Each strip's build has the coarse bundle with only its half, and a sliver of its neighbour's bundles
+    write_package(tmp_path / "shard_0.vtpk",
+                  {(0, 0, 0): {0: b"L0 west"}, (1, 0, 0): one_shot[(1, 0, 0)], (1, 0, 128): {0: b"L1 sliver"},
+                   (2, 0, 0): one_shot[(2, 0, 0)], (2, 0, 128): one_shot[(2, 0, 128)],
+                   (2, 0, 256): {3: b"L2 sliver"}},
+                  [1, [1, 0, 0, 0], 0, 0], 0, 32767)
+    write_package(tmp_path / "shard_1.vtpk",
+                  {(0, 0, 0): {1: b"L0 east"}, (1, 0, 0): {0: b"L1 sliver"}, (1, 0, 128): one_shot[(1, 0, 128)],
+                   (2, 0, 256): one_shot[(2, 0, 256)], (2, 0, 384): one_shot[(2, 0, 384)]},
+                  [1, [0, 1, 0, 0], 0, 0], 32768, 65535)
+    write_package(tmp_path / "seam.vtpk", {(0, 0, 0): one_shot[(0, 0, 0)]}, [1, 0, 0, 0], 0, 65535)
+
+    merge_vtpk_shards(str(tmp_path / "merged.vtpk"), [str(tmp_path / "shard_0.vtpk"), str(tmp_path / "shard_1.vtpk")],
+                      strips, split_level, str(tmp_path / "seam.vtpk"), lods)
+    assert read_package_tiles(tmp_path / "merged.vtpk") == one_shot
+    assert count_tile_differences(str(tmp_path / "merged.vtpk"), str(tmp_path / "one_shot.vtpk")) == 0
+    assert count_tile_map_differences(str(tmp_path / "merged.vtpk"), str(tmp_path / "one_shot.vtpk")) == 0
+    with zipfile.ZipFile(tmp_path / "merged.vtpk") as merged_zip, \
+            zipfile.ZipFile(tmp_path / "one_shot.vtpk") as one_shot_zip:
+        assert sorted(merged_zip.namelist()) == sorted(one_shot_zip.namelist())
+        assert json.loads(merged_zip.read(vector_tile_package.vtpk_root_member)) == \
+            json.loads(one_shot_zip.read(vector_tile_package.vtpk_root_member))
+    assert not (tmp_path / "merged.vtpk.partial").exists()
@@ -0,0 +1,56 @@
+import os
+import queue
+import pytest
+
+
+# A pool worker run in this process, its globals restored afterwards
+@pytest.fixture
+def worker(pipeline, monkeypatch):
+    for name in ("extract_slot", "trace_service", "profile_folder", "worker_profiler", "worker_projects",
+                 "worker_connections"):
+        monkeypatch.setattr(pipeline, name, getattr(pipeline, name))
+    monkeypatch.setattr(pipeline, "init_worker", lambda cur_log_queue: None)
+    task_queue = queue.Queue()
+    reply_queues = [queue.Queue(), queue.Queue()]
+    running = [-1, -1]
+
+    def run(*tasks):
+        for task_id, task_function, args in tasks:
+            task_queue.put((1, task_id, task_function, args, "service", None))
+        task_queue.put(None)
+        pipeline.pool_worker(0, task_queue, reply_queues, running, None)
+        replies = []
+        while not reply_queues[1].empty():
+            replies.append(reply_queues[1].get())
+        return replies, task_queue.qsize()
+    return pipeline, run, running
+
+
+def test_worker_runs_tasks_until_stopped(worker):
+    pipeline, run, running = worker
+    replies, left = run((1, abs, -1), (2, abs, -2))
+    assert replies == [(1, 1, None), (2, 2, None)]
+    assert left == 0
+    assert running == [1, -1]
+
+
+def test_failed_task_is_replied_with_its_error(worker):
+    pipeline, run, running = worker
+    replies, left = run((1, int, "not a number"), (2, abs, -2))
+    assert replies[0][:2] == (1, None)
+    assert "ValueError" in replies[0][2]
+    assert replies[1] == (2, 2, None)
+
+
+# A worker holding more memory than the limit after a task exits, leaving the next task to its replacement
+def test_worker_is_recycled_over_its_memory_limit(worker):
+    pipeline, run, running = worker
+    pipeline.config["pool"]["memory_limit_mb"] = 0
+    replies, left = run((1, abs, -1), (2, abs, -2))
+    assert replies == [(1, 1, None)]
+    assert left == 2
+
+
+@pytest.mark.skipif(os.name != "nt" and not os.path.exists("/proc/self/statm"), reason="no memory counters")
+def test_get_process_memory(pipeline):
+    assert pipeline.get_process_memory() > 1048576
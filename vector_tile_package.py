@@ -0,0 +1,275 @@
+## Version: Python 3.6
+## Description:
+### Vector tile package (.vtpk) format helpers for Python.py
+### Reads tiling schemes, compact cache bundles and tile maps, and merges packages built in parts
+
+import os
+import re
+import json
+import math
+import shutil
+import struct
+import zipfile
+from xml.etree import ElementTree
+
+vtpk_style_member = "p12/resources/styles/root.json"   # Style file inside a .vtpk
+vtpk_root_member = "p12/root.json"   # Service description inside a .vtpk
+vtpk_tilemap_member = "p12/tilemap/root.json"   # Tile map (which tiles exist) inside a .vtpk
+vtpk_tilemap_folder = "p12/tilemap/"   # Folder of the tile map and the pages a large package splits it into
+vtpk_bundle_dim = 128   # Tiles per side of a compact cache bundle
+
+
+# Read the tile origin, tile size and levels of detail of a tiling scheme .xml
+def read_tiling_scheme(tiling_scheme_path: str):
+    elements = {}
+    lods = []
+    for element in ElementTree.parse(tiling_scheme_path).getroot().iter():
+        tag = element.tag.split("}")[-1]
+        if tag == "LODInfo":
+            lod = {child.tag.split("}")[-1]: child.text for child in element}
+            lods.append((int(lod["LevelID"]), float(lod["Scale"]), float(lod["Resolution"])))
+        elif tag not in elements:
+            elements[tag] = element
+    origin = {child.tag.split("}")[-1]: float(child.text) for child in elements["TileOrigin"]}
+    return {"origin": (origin["X"], origin["Y"]), "cols": int(elements["TileCols"].text),
+            "rows": int(elements["TileRows"].text), "lods": lods}
+
+
+# Tiles touched by the changed extents at each cached level, {(level, bundle row, bundle column): {(row, column)}}
+# Each changed extent is widened by tile_buffer of a tile; returns None when there are more than max_tiles
+def get_changed_tiles(changed_extents: list, tiling_scheme: dict, max_cached_scale: int, tile_buffer: float,
+                      max_tiles: int):
+    origin_x, origin_y = tiling_scheme["origin"]
+    changed_tiles = {}
+    tile_count = 0
+    for level, scale, resolution in tiling_scheme["lods"]:
+        # Scales halve at each level, anything well below the largest cached scale is not in the package
+        if scale < max_cached_scale / 1.5:
+            continue
+        tile_width = resolution * tiling_scheme["cols"]
+        tile_height = resolution * tiling_scheme["rows"]
+        level_tiles = set()
+        for xmin, ymin, xmax, ymax in changed_extents:
+            first_col = max(0, int(math.floor((xmin - tile_width * tile_buffer - origin_x) / tile_width)))
+            last_col = int(math.floor((xmax + tile_width * tile_buffer - origin_x) / tile_width))
+            first_row = max(0, int(math.floor((origin_y - ymax - tile_height * tile_buffer) / tile_height)))
+            last_row = int(math.floor((origin_y - ymin + tile_height * tile_buffer) / tile_height))
+            if tile_count + (last_col - first_col + 1) * (last_row - first_row + 1) > max_tiles:
+                return None
+            for row in range(first_row, last_row + 1):
+                for col in range(first_col, last_col + 1):
+                    level_tiles.add((row, col))
+        tile_count += len(level_tiles)
+        for row, col in level_tiles:
+            bundle_key = (level, row - row % vtpk_bundle_dim, col - col % vtpk_bundle_dim)
+            changed_tiles.setdefault(bundle_key, set()).add((row, col))
+    return changed_tiles
+
+
+# Compact cache bundles of a package, {(level, bundle row, bundle column): member name}
+def list_package_bundles(vtpk_zip):
+    bundles = {}
+    for member_name in vtpk_zip.namelist():
+        match = re.search(r"/L(\d+)/R([0-9a-fA-F]+)C([0-9a-fA-F]+)\.bundle$", member_name)
+        if match:
+            bundles[(int(match.group(1)), int(match.group(2), 16), int(match.group(3), 16))] = member_name
+    return bundles
+
+
+# Tiles of a compact cache bundle, {position in bundle: tile bytes}
+# A 64 byte header is followed by an index of 8 byte entries, 5 bytes of offset and 3 bytes of size
+def read_bundle_tiles(bundle_bytes: bytes):
+    tiles = {}
+    for position in range(vtpk_bundle_dim * vtpk_bundle_dim):
+        entry = struct.unpack_from("<Q", bundle_bytes, 64 + position * 8)[0]
+        tile_offset = entry & 0xFFFFFFFFFF
+        tile_size = entry >> 40
+        if tile_size:
+            if tile_offset < 4 or tile_offset + tile_size > len(bundle_bytes) or \
+                    struct.unpack_from("<I", bundle_bytes, tile_offset - 4)[0] != tile_size:
+                raise ValueError(f"Bundle index entry {position} does not match its tile")
+            tiles[position] = bundle_bytes[tile_offset:tile_offset + tile_size]
+    return tiles
+
+
+# Write a compact cache bundle from its tiles, keeping the header of the bundle it replaces
+def write_bundle(header: bytes, tiles: dict):
+    index = bytearray(vtpk_bundle_dim * vtpk_bundle_dim * 8)
+    body = bytearray()
+    tile_offset = 64 + len(index)
+    for position in sorted(tiles):
+        tile = tiles[position]
+        tile_offset += 4
+        body += struct.pack("<I", len(tile))
+        struct.pack_into("<Q", index, position * 8, tile_offset | (len(tile) << 40))
+        body += tile
+        tile_offset += len(tile)
+    header = bytearray(header[:64])
+    struct.pack_into("<I", header, 8, max([len(tile) for tile in tiles.values()] or [0]))
+    struct.pack_into("<Q", header, 24, tile_offset)
+    return bytes(header + index + body)
+
+
+# Split a map extent into strips of whole bundles at the coarsest level wide enough for shard_count strips
+# Returns (level, [(first column, end column, first row, end row)] in tiles of that level) or None
+def get_vtpk_shards(extent, tiling_scheme: dict, lods: list, shard_count: int):
+    origin_x, origin_y = tiling_scheme["origin"]
+    for level, scale, resolution in lods:
+        tile_width = resolution * tiling_scheme["cols"]
+        tile_height = resolution * tiling_scheme["rows"]
+        first_bundle_col = max(0, int(math.floor((extent.XMin - origin_x) / tile_width))) // vtpk_bundle_dim
+        end_bundle_col = int(math.floor((extent.XMax - origin_x) / tile_width)) // vtpk_bundle_dim + 1
+        first_bundle_row = max(0, int(math.floor((origin_y - extent.YMax) / tile_height))) // vtpk_bundle_dim
+        end_bundle_row = int(math.floor((origin_y - extent.YMin) / tile_height)) // vtpk_bundle_dim + 1
+        bundle_cols = end_bundle_col - first_bundle_col
+        bundle_rows = end_bundle_row - first_bundle_row
+        if max(bundle_cols, bundle_rows) < shard_count:
+            continue
+
+        # Strips run across the longer side of the extent
+        strips = []
+        for shard_number in range(shard_count):
+            if bundle_cols >= bundle_rows:
+                first_col = first_bundle_col + bundle_cols * shard_number // shard_count
+                end_col = first_bundle_col + bundle_cols * (shard_number + 1) // shard_count
+                strips.append((first_col * vtpk_bundle_dim, end_col * vtpk_bundle_dim,
+                               first_bundle_row * vtpk_bundle_dim, end_bundle_row * vtpk_bundle_dim))
+            else:
+                first_row = first_bundle_row + bundle_rows * shard_number // shard_count
+                end_row = first_bundle_row + bundle_rows * (shard_number + 1) // shard_count
+                strips.append((first_bundle_col * vtpk_bundle_dim, end_bundle_col * vtpk_bundle_dim,
+                               first_row * vtpk_bundle_dim, end_row * vtpk_bundle_dim))
+        return level, strips
+    return None
+
+
+# Merge shard packages into one package
+# Bundles at and below the split level come from the shard whose strip holds them, coarser bundles from the seam
+# build; the tile maps of every build are merged and the package extent covers every shard
+def merge_vtpk_shards(vtpk_path: str, shard_paths: list, strips: list, split_level: int, seam_path: str, lods: list):
+    resolutions = {lod[0]: lod[2] for lod in lods}
+    merged_path = f"{vtpk_path}.partial"
+    package_zips = [zipfile.ZipFile(shard_path, "r") for shard_path in shard_paths]
+    seam_zip = zipfile.ZipFile(seam_path, "r") if seam_path else None
+    try:
+        # Bundles kept from each package, {member name: package}
+        bundle_sources = {}
+        for package_zip, (first_col, end_col, first_row, end_row) in zip(package_zips, strips):
+            for (level, bundle_row, bundle_col), member_name in list_package_bundles(package_zip).items():
+                if level < split_level:
+                    continue
+                factor = int(round(resolutions[split_level] / resolutions[level]))
+                if first_col * factor <= bundle_col < end_col * factor and \
+                        first_row * factor <= bundle_row < end_row * factor:
+                    bundle_sources[member_name] = package_zip
+        if seam_zip:
+            for (level, bundle_row, bundle_col), member_name in list_package_bundles(seam_zip).items():
+                if level < split_level:
+                    bundle_sources[member_name] = seam_zip
+
+        # Members other than bundles from every build: tile map pages are merged, package extents cover every build
+        # and the rest are taken from the first build that has them
+        members = {}
+        tile_maps = {}
+        service_info = None
+        all_bundles = set(bundle_sources)
+        for package_zip in package_zips + ([seam_zip] if seam_zip else []):
+            package_bundles = set(list_package_bundles(package_zip).values())
+            all_bundles.update(package_bundles)
+            for info in package_zip.infolist():
+                if info.filename in package_bundles:
+                    continue
+                members.setdefault(info.filename, (package_zip, info))
+                if info.filename.startswith(vtpk_tilemap_folder) and info.filename.endswith(".json"):
+                    shard_map = json.loads(package_zip.read(info).decode("utf-8"))
+                    tile_map = tile_maps.get(info.filename)
+                    tile_maps[info.filename] = shard_map if tile_map is None else \
+                        dict(tile_map, index=merge_tile_map_nodes(tile_map["index"], shard_map["index"]))
+                elif info.filename == vtpk_root_member:
+                    shard_info = json.loads(package_zip.read(info).decode("utf-8"))
+                    if service_info is None:
+                        service_info = shard_info
+                        continue
+                    for extent_key in ("fullExtent", "initialExtent"):
+                        if extent_key in service_info and extent_key in shard_info:
+                            extent = service_info[extent_key]
+                            extent["xmin"] = min(extent["xmin"], shard_info[extent_key]["xmin"])
+                            extent["ymin"] = min(extent["ymin"], shard_info[extent_key]["ymin"])
+                            extent["xmax"] = max(extent["xmax"], shard_info[extent_key]["xmax"])
+                            extent["ymax"] = max(extent["ymax"], shard_info[extent_key]["ymax"])
+
+        with zipfile.ZipFile(merged_path, "w", allowZip64=True) as merged_zip:
+            for member_name, (package_zip, info) in members.items():
+                if member_name in all_bundles:
+                    continue
+                if member_name in tile_maps:
+                    merged_zip.writestr(info, json.dumps(tile_maps[member_name]))
+                elif member_name == vtpk_root_member and service_info is not None:
+                    merged_zip.writestr(info, json.dumps(service_info))
+                elif info.is_dir():
+                    merged_zip.writestr(info, b"")
+                else:
+                    with package_zip.open(info) as member_reader, merged_zip.open(info, "w") as member_writer:
+                        shutil.copyfileobj(member_reader, member_writer, 1048576)
+            for member_name in sorted(bundle_sources):
+                info = bundle_sources[member_name].getinfo(member_name)
+                with bundle_sources[member_name].open(info) as member_reader, \
+                        merged_zip.open(info, "w", force_zip64=info.file_size > 0x7FFFFFFF) as member_writer:
+                    shutil.copyfileobj(member_reader, member_writer, 1048576)
+        os.replace(merged_path, vtpk_path)
+    finally:
+        for package_zip in package_zips:
+            package_zip.close()
+        if seam_zip:
+            seam_zip.close()
+        if os.path.exists(merged_path):
+            os.remove(merged_path)
+
+
+# Union of two tile map nodes: 0 for no tile, a number for a tile, four child nodes for a tile with children
+def merge_tile_map_nodes(node, other_node):
+    if isinstance(node, list) and isinstance(other_node, list):
+        return [merge_tile_map_nodes(child, other_child) for child, other_child in zip(node, other_node)]
+    if isinstance(node, list) or isinstance(other_node, list):
+        return node if isinstance(node, list) else other_node
+    return max(node, other_node)
+
+
+# Number of tiles that are missing from one package or differ between two packages
+def count_tile_differences(vtpk_path: str, other_vtpk_path: str):
+    differences = 0
+    with zipfile.ZipFile(vtpk_path, "r") as vtpk_zip, zipfile.ZipFile(other_vtpk_path, "r") as other_zip:
+        bundles = list_package_bundles(vtpk_zip)
+        other_bundles = list_package_bundles(other_zip)
+        for bundle_key in set(bundles) | set(other_bundles):
+            tiles = read_bundle_tiles(vtpk_zip.read(bundles[bundle_key])) if bundle_key in bundles else {}
+            other_tiles = read_bundle_tiles(other_zip.read(other_bundles[bundle_key])) \
+                if bundle_key in other_bundles else {}
+            for position in set(tiles) | set(other_tiles):
+                if tiles.get(position) != other_tiles.get(position):
+                    differences += 1
+    return differences
+
+
+# Number of tile map nodes that differ between two packages, over every page of their tile maps
+def count_tile_map_differences(vtpk_path: str, other_vtpk_path: str):
+    differences = 0
+    with zipfile.ZipFile(vtpk_path, "r") as vtpk_zip, zipfile.ZipFile(other_vtpk_path, "r") as other_zip:
+        tile_maps = [{member_name: json.loads(package_zip.read(member_name).decode("utf-8"))["index"]
+                      for member_name in package_zip.namelist()
+                      if member_name.startswith(vtpk_tilemap_folder) and member_name.endswith(".json")}
+                     for package_zip in (vtpk_zip, other_zip)]
+    for member_name in set(tile_maps[0]) | set(tile_maps[1]):
+        differences += count_tile_map_node_differences(tile_maps[0].get(member_name, 0),
+                                                       tile_maps[1].get(member_name, 0))
+    return differences
+
+
+# Leaves of two tile map nodes that differ, a node without children is compared with each leaf of the other
+def count_tile_map_node_differences(node, other_node):
+    if not isinstance(node, list) and not isinstance(other_node, list):
+        return 0 if node == other_node else 1
+    children = node if isinstance(node, list) else [node] * len(other_node)
+    other_children = other_node if isinstance(other_node, list) else [other_node] * len(node)
+    return sum(count_tile_map_node_differences(child, other_child)
+               for child, other_child in zip(children, other_children))